@@ -0,0 +1,4 @@
+import os
+from connectpy.connectpy_asgi import create_app
+
+app = create_app()
\ No newline at end of file
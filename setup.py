@@ -36,8 +36,12 @@ setup(
     package_dir={'connectpy': 'src'},
     scripts=[
         'bin/connectpy_app.py',
+        'bin/connectpy_asgi_app.py',
     ],
     install_requires=requirements,
+    extras_require={
+        'batch': ['numpy'],
+    },
     dependency_links=[],
     test_suite='tests',
     include_package_data=True,
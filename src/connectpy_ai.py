@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import copy
+import random
+import time
+
+from threading import Lock, local
+from concurrent.futures import ProcessPoolExecutor, \
+    TimeoutError as ResultTimeout
+
+# Scores beyond WIN_SCORE - cells are forced wins, sooner wins score higher
+WIN_SCORE = 1 << 40
+EXACT, LOWER, UPPER = 0, 1, 2
+
+_WINDOWS = {}
+# Per worker process AIPlayer for `search_subtree`
+_WORKER_BOT = None
+
+
+class SearchTimeout(Exception):
+    pass
+
+
+def popcount(n):
+    return bin(n).count('1')
+
+
+def chain_length(board, origin, shift, win_zone):
+    """
+    Returns the length (capped at `win_zone`) of the chain of set bits in
+    `board` through bit `origin`, walking `shift` bits at a time both ways
+    """
+    length = 1
+    idx = origin + shift
+    while length < win_zone and board >> idx & 1:
+        length += 1
+        idx += shift
+    idx = origin - shift
+    while length < win_zone and idx >= 0 and board >> idx & 1:
+        length += 1
+        idx -= shift
+    return length
+
+
+def center_order(columns):
+    """Returns the column indexes ordered from the center outwards"""
+    center = (columns - 1) / 2.0
+    return sorted(range(columns), key=lambda c: (abs(c - center), c))
+
+
+def board_windows(columns, rows, win_zone):
+    """
+    Returns the bitboard masks of every line of `win_zone` cells on the
+    board, shared between all searches on the same board size
+    """
+    key = (columns, rows, win_zone)
+    if key not in _WINDOWS:
+        stride = rows + 1
+        windows = []
+        for column in range(columns):
+            for row in range(rows):
+                for d_column, d_row in ((1, 0), (0, 1), (1, 1), (1, -1)):
+                    end_column = column + d_column * (win_zone - 1)
+                    end_row = row + d_row * (win_zone - 1)
+                    if end_column < columns and 0 <= end_row < rows:
+                        mask = 0
+                        for i in range(win_zone):
+                            mask |= 1 << ((column + d_column * i) * stride +
+                                          row + d_row * i)
+                        windows.append(mask)
+        _WINDOWS[key] = windows
+    return _WINDOWS[key]
+
+
+class TranspositionTable(object):
+    """
+    Fixed-size table of search results keyed by Zobrist hash. Only results
+    from the current search are returned, and a slot is replaced when it's
+    empty, left over from an earlier search, or holds a result searched no
+    deeper than the new one
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = [None] * size
+        self.generation = 0
+
+    def new_search(self):
+        self.generation += 1
+
+    def get(self, key):
+        entry = self.entries[key % self.size]
+        if entry is not None and entry[0] == key and \
+                entry[5] == self.generation:
+            return entry
+        return None
+
+    def put(self, key, depth, score, flag, move):
+        idx = key % self.size
+        entry = self.entries[idx]
+        if entry is None or entry[5] != self.generation or depth >= entry[1]:
+            self.entries[idx] = (
+                key, depth, score, flag, move, self.generation)
+
+
+class Position(object):
+    """
+    Search bitboards, laid out as in ConnectPyGame, for the player to move
+    (`current`) and their opponent, with an incrementally updated hash
+    """
+
+    def __init__(self, columns, rows, win_zone, current, opponent, heights,
+                 zobrist, color=0):
+        self.columns = columns
+        self.rows = rows
+        self.win_zone = win_zone
+        self.stride = rows + 1
+        self.shifts = (1, self.stride, self.stride - 1, self.stride + 1)
+        self.order = center_order(columns)
+        self.current = current
+        self.opponent = opponent
+        self.heights = list(heights)
+        self.moves = sum(self.heights)
+        self.zobrist = zobrist
+        # Zobrist colors are absolute, `color` is the player to move
+        self.color = color
+        self.hash = 0
+        for idx in range(columns * self.stride):
+            if current >> idx & 1:
+                self.hash ^= zobrist[color][idx]
+            elif opponent >> idx & 1:
+                self.hash ^= zobrist[color ^ 1][idx]
+
+    @classmethod
+    def from_game(cls, game, player_id, zobrist):
+        """Returns the Position of `game` with `player_id` to move"""
+        indicator = game.get_player_indicator(player_id)
+        current = game.boards.get(indicator, 0)
+        opponent = 0
+        for other, board in game.boards.items():
+            if other != indicator:
+                opponent |= board
+        return cls(game.columns, game.rows, game.win_zone, current,
+                   opponent, game.heights, zobrist)
+
+    def can_play(self, column):
+        return self.heights[column] < self.rows
+
+    def is_winning_move(self, column):
+        """Returns True if playing `column` wins for the player to move"""
+        idx = column * self.stride + self.heights[column]
+        board = self.current | 1 << idx
+        for shift in self.shifts:
+            if chain_length(board, idx, shift, self.win_zone) == \
+                    self.win_zone:
+                return True
+        return False
+
+    def play(self, column):
+        idx = column * self.stride + self.heights[column]
+        self.current |= 1 << idx
+        self.hash ^= self.zobrist[self.color][idx]
+        self.heights[column] += 1
+        self.moves += 1
+        self.current, self.opponent = self.opponent, self.current
+        self.color ^= 1
+
+    def undo(self, column):
+        self.color ^= 1
+        self.current, self.opponent = self.opponent, self.current
+        self.moves -= 1
+        self.heights[column] -= 1
+        idx = column * self.stride + self.heights[column]
+        self.current ^= 1 << idx
+        self.hash ^= self.zobrist[self.color][idx]
+
+
+class AIPlayer(object):
+    """
+    Alpha-beta negamax ConnectPy bot with center-first move ordering,
+    iterative deepening under a time budget and a transposition table.
+    `choose_move` is safe to call from many threads at once, each thread
+    searching with its own table. The `search` methods use the bot's own
+    table and are for one thread at a time
+    """
+
+    def __init__(self, config):
+        """
+        Expect a `config` of the form:
+            ai_time_budget: 0.5
+            ai_max_depth: 42
+            ai_tt_size: 262144
+            ai_seed: 0
+        """
+        self.config = config
+        self.time_budget = config.get('ai_time_budget', 0.5)
+        self.max_depth = config.get('ai_max_depth', 42)
+        self.tt = TranspositionTable(config.get('ai_tt_size', 1 << 18))
+        self.rng = random.Random(config.get('ai_seed', 0))
+        self.zobrist = {}
+        # Guards the shared Zobrist keys, and the pool of a ParallelAIPlayer
+        self.lock = Lock()
+        # Per thread search state, see `searcher`
+        self.local = local()
+        self.owner = self
+        self.nodes = 0
+        self.deadline = None
+        self.stats = {}
+        # (columns, rows, win_zone): opening book, see connectpy_book
+        self.books = {}
+
+    def zobrist_keys(self, columns, rows):
+        """Returns the per-color random keys for each bit of a board size"""
+        cells = columns * (rows + 1)
+        keys = self.zobrist.get(cells)
+        if keys is None:
+            with self.lock:
+                if cells not in self.zobrist:
+                    self.zobrist[cells] = [
+                        [self.rng.getrandbits(64) for _ in range(cells)]
+                        for color in range(2)]
+                keys = self.zobrist[cells]
+        return keys
+
+    def position(self, game, player_id):
+        return Position.from_game(
+            game, player_id, self.zobrist_keys(game.columns, game.rows))
+
+    def searcher(self):
+        """
+        Returns the calling thread's copy of the bot, with its own
+        transposition table and search state. The Zobrist keys, opening
+        books and, for a ParallelAIPlayer, the process pool are shared
+        """
+        searcher = getattr(self.local, 'searcher', None)
+        if searcher is None:
+            searcher = copy.copy(self)
+            searcher.tt = TranspositionTable(self.tt.size)
+            searcher.nodes, searcher.deadline, searcher.stats = 0, None, {}
+            self.local.searcher = searcher
+        # Books may be loaded after the bot is made
+        searcher.books = self.books
+        return searcher
+
+    def choose_move(self, game, player_id):
+        """
+        Returns the column to play for `player_id` in `game`, or None if the
+        board is full. Bot games on different threads search concurrently
+        """
+        searcher = self.searcher()
+        move = searcher.best_move(game, player_id)
+        # Stats of the latest move from any thread
+        self.stats = searcher.stats
+        return move
+
+    def best_move(self, game, player_id):
+        position = self.position(game, player_id)
+        move = self.book_move(position)
+        if move is not None:
+            self.stats = {
+                "depth": 0, "nodes": 0, "time": 0, "nps": 0, "book": True
+            }
+            return move
+        return self.iterative_deepening(
+            position, time.monotonic() + self.time_budget)
+
+    def book_move(self, position):
+        """Returns the opening book move for `position`, if there is one"""
+        book = self.books.get(
+            (position.columns, position.rows, position.win_zone))
+        if book is None:
+            return None
+        move = book.lookup(position.current, position.opponent)
+        if move is not None and 0 <= move < position.columns and \
+                position.can_play(move):
+            return move
+        return None
+
+    def iterative_deepening(self, position, deadline, max_depth=None):
+        """
+        Searches `position` one ply deeper at a time until `deadline`,
+        returning the best move of the deepest completed search
+        """
+        legal = [c for c in position.order if position.can_play(c)]
+        if not legal:
+            return None
+
+        self.tt.new_search()
+        self.nodes = 0
+        self.deadline = deadline
+        started = time.monotonic()
+        empty = position.columns * position.rows - position.moves
+        best, depth_reached = legal[0], 0
+        for depth in range(1, min(max_depth or self.max_depth, empty) + 1):
+            try:
+                move, score = self.search_root(position, depth, best)
+            except SearchTimeout:
+                # Note the aborted search leaves `position` mid-line
+                break
+            best, depth_reached = move, depth
+            if abs(score) > WIN_SCORE - position.columns * position.rows:
+                break
+
+        elapsed = time.monotonic() - started
+        self.stats = {
+            "depth": depth_reached,
+            "nodes": self.nodes,
+            "time": elapsed,
+            "nps": self.nodes / elapsed if elapsed else 0,
+            "book": False
+        }
+        return best
+
+    def search(self, position, depth):
+        """
+        Returns (move, score) of a fixed `depth` search of `position`, with
+        no time limit
+        """
+        self.tt.new_search()
+        self.nodes = 0
+        self.deadline = None
+        return self.search_root(position, depth)
+
+    def search_root(self, position, depth, first=None, moves=None):
+        """
+        Returns (move, score) for the best of `moves` (default all columns
+        in center-first order, with `first` tried before the rest)
+        """
+        order = moves or position.order
+        if first is not None:
+            order = [first] + [c for c in order if c != first]
+
+        for column in order:
+            if position.can_play(column) and \
+                    position.is_winning_move(column):
+                return column, WIN_SCORE - position.moves - 1
+
+        alpha, beta = -WIN_SCORE - 1, WIN_SCORE + 1
+        best_move, best_score = None, -WIN_SCORE - 1
+        for column in order:
+            if not position.can_play(column):
+                continue
+            position.play(column)
+            score = -self.negamax(position, depth - 1, -beta, -alpha)
+            position.undo(column)
+            if score > best_score:
+                best_move, best_score = column, score
+            alpha = max(alpha, score)
+        return best_move, best_score
+
+    def negamax(self, position, depth, alpha, beta):
+        self.nodes += 1
+        if self.deadline is not None and not self.nodes & 1023 and \
+                time.monotonic() > self.deadline:
+            raise SearchTimeout()
+
+        order = position.order
+        playable = False
+        for column in order:
+            if position.can_play(column):
+                playable = True
+                if position.is_winning_move(column):
+                    return WIN_SCORE - position.moves - 1
+        if not playable:
+            return 0
+        if depth <= 0:
+            return self.evaluate(position)
+
+        alpha_orig = alpha
+        entry = self.tt.get(position.hash)
+        if entry is not None:
+            key, entry_depth, score, flag, move, generation = entry
+            if entry_depth >= depth:
+                if flag == EXACT:
+                    return score
+                elif flag == LOWER:
+                    alpha = max(alpha, score)
+                else:
+                    beta = min(beta, score)
+                if alpha >= beta:
+                    return score
+            if move is not None:
+                order = [move] + [c for c in order if c != move]
+
+        best_move, best_score = None, -WIN_SCORE - 1
+        for column in order:
+            if not position.can_play(column):
+                continue
+            position.play(column)
+            score = -self.negamax(position, depth - 1, -beta, -alpha)
+            position.undo(column)
+            if score > best_score:
+                best_move, best_score = column, score
+                if score > alpha:
+                    alpha = score
+                    if alpha >= beta:
+                        break
+
+        if best_score <= alpha_orig:
+            flag = UPPER
+        elif best_score >= beta:
+            flag = LOWER
+        else:
+            flag = EXACT
+        self.tt.put(position.hash, depth, best_score, flag, best_move)
+        return best_score
+
+    def evaluate(self, position):
+        """
+        Scores `position` for the player to move by the open lines each
+        player has started, weighted by the square of their discs in them
+        """
+        current, opponent = position.current, position.opponent
+        score = 0
+        for window in board_windows(
+                position.columns, position.rows, position.win_zone):
+            mine = current & window
+            theirs = opponent & window
+            if mine and not theirs:
+                count = popcount(mine)
+                score += count * count
+            elif theirs and not mine:
+                count = popcount(theirs)
+                score -= count * count
+        return score
+
+
+def search_subtree(args):
+    """
+    Process pool task returning (score, nodes) for the root move `column`
+    of a `depth` ply search, searched with a full window so the score is
+    exact. Raises SearchTimeout once it has run for `budget` seconds, if
+    set. A budget rather than a deadline, as the worker's clock needn't be
+    the caller's
+    """
+    global _WORKER_BOT
+    (columns, rows, win_zone, current, opponent, heights, column, depth,
+     budget, generation, tt_size) = args
+    if _WORKER_BOT is None or _WORKER_BOT.tt.size != tt_size:
+        _WORKER_BOT = AIPlayer({"ai_tt_size": tt_size})
+    bot = _WORKER_BOT
+    bot.tt.generation = generation
+    bot.nodes = 0
+    bot.deadline = None if budget is None else time.monotonic() + budget
+
+    position = Position(columns, rows, win_zone, current, opponent, heights,
+                        bot.zobrist_keys(columns, rows))
+    position.play(column)
+    score = -bot.negamax(position, depth - 1, -WIN_SCORE - 1, WIN_SCORE + 1)
+    return score, bot.nodes
+
+
+class ParallelAIPlayer(AIPlayer):
+    """
+    AIPlayer splitting each root search across a process pool, one task per
+    root move. Every root move gets an exact score, so the best move is the
+    same one the serial search picks at a fixed depth
+    """
+
+    def __init__(self, config):
+        """
+        Expect a `config` of the form:
+            ai_workers: 4
+        plus any AIPlayer config. `ai_tt_size` sizes each worker's table
+        """
+        super(ParallelAIPlayer, self).__init__(config)
+        self.workers = config.get('ai_workers', 4)
+        self.tt_size = config.get('ai_tt_size', 1 << 18)
+        self.pool = None
+
+    def close(self):
+        """Shuts down the worker processes"""
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
+                atexit.unregister(self.close)
+
+    def executor(self):
+        """
+        Returns the process pool shared by the bot's searchers, shut down at
+        exit if the bot isn't closed first
+        """
+        owner = self.owner
+        with owner.lock:
+            if owner.pool is None:
+                owner.pool = ProcessPoolExecutor(max_workers=self.workers)
+                atexit.register(owner.close)
+            return owner.pool
+
+    def remaining(self):
+        """Returns the seconds left to search, or None without a deadline"""
+        if self.deadline is None:
+            return None
+        return max(0, self.deadline - time.monotonic())
+
+    def search_root(self, position, depth, first=None, moves=None):
+        order = moves or position.order
+        if first is not None:
+            order = [first] + [c for c in order if c != first]
+
+        for column in order:
+            if position.can_play(column) and \
+                    position.is_winning_move(column):
+                return column, WIN_SCORE - position.moves - 1
+
+        pool = self.executor()
+        legal = [c for c in order if position.can_play(c)]
+        futures = [pool.submit(search_subtree, (
+            position.columns, position.rows, position.win_zone,
+            position.current, position.opponent, position.heights, column,
+            depth, self.remaining(), self.tt.generation, self.tt_size))
+            for column in legal]
+
+        best_move, best_score = None, -WIN_SCORE - 1
+        try:
+            for column, future in zip(legal, futures):
+                try:
+                    # Tasks queued behind others start their budget late
+                    score, nodes = future.result(timeout=self.remaining())
+                except ResultTimeout:
+                    raise SearchTimeout()
+                self.nodes += nodes
+                # Ties go to the earlier move in `order`, as in the serial
+                # search
+                if score > best_score:
+                    best_move, best_score = column, score
+        except SearchTimeout:
+            for future in futures:
+                future.cancel()
+            raise
+        return best_move, best_score
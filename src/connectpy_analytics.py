@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import os
+import time
+import connectpy.connectpy_ai as conn_ai
+import connectpy.connectpy_archive as conn_archive
+import connectpy.connectpy_game as conn_py
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from itertools import cycle
+
+# Blocks per pool task, small enough to spread an archive over the pool and
+# large enough that a task outweighs its round trip
+TASK_BLOCKS = 8
+
+
+class GameStats(object):
+    """
+    Aggregate stats over archived games, per board config: game lengths,
+    how often the first player wins by the column they opened in, and the
+    axis each game was won along. Partial stats from shards are combined
+    with `merge`
+    """
+
+    def __init__(self):
+        self.games = 0
+        self.moves = 0
+        # (columns, rows, win_zone): [games, moves, games won]
+        self.boards = {}
+        # (columns, rows, win_zone, first column): [games, first player wins]
+        self.openings = {}
+        # axis: wins along it
+        self.axes = {}
+
+    def add(self, board, moves, first_column, first_won, axis):
+        """
+        Counts a game on `board` of `moves` moves, opened in `first_column`
+        and won along `axis`, by the first player if `first_won`. `axis` is
+        None for a game without a winner
+        """
+        self.games += 1
+        self.moves += moves
+        counts = self.boards.get(board)
+        if counts is None:
+            counts = self.boards[board] = [0, 0, 0]
+        counts[0] += 1
+        counts[1] += moves
+        if first_column is not None:
+            opening = board + (first_column,)
+            counts = self.openings.get(opening)
+            if counts is None:
+                counts = self.openings[opening] = [0, 0]
+            counts[0] += 1
+            counts[1] += first_won
+        if axis is not None:
+            self.boards[board][2] += 1
+            self.axes[axis] = self.axes.get(axis, 0) + 1
+
+    def merge(self, other):
+        self.games += other.games
+        self.moves += other.moves
+        for board, counts in other.boards.items():
+            mine = self.boards.setdefault(board, [0, 0, 0])
+            for idx, count in enumerate(counts):
+                mine[idx] += count
+        for opening, counts in other.openings.items():
+            mine = self.openings.setdefault(opening, [0, 0])
+            for idx, count in enumerate(counts):
+                mine[idx] += count
+        for axis, count in other.axes.items():
+            self.axes[axis] = self.axes.get(axis, 0) + count
+        return self
+
+    def report(self, elapsed):
+        """Returns a dict of the stats and the throughput"""
+        boards = {}
+        for (columns, rows, win_zone), counts in sorted(self.boards.items()):
+            games, moves, won = counts
+            boards['{}x{}-{}'.format(columns, rows, win_zone)] = {
+                "games": games,
+                "won": won,
+                "average_length": moves / games,
+                "first_column_win_rate": {
+                    str(opening[3]): wins / count
+                    for opening, (count, wins) in sorted(
+                        self.openings.items())
+                    if opening[:3] == (columns, rows, win_zone)}
+            }
+        won = sum(self.axes.values())
+        return {
+            "elapsed": elapsed,
+            "games": self.games,
+            "moves": self.moves,
+            "throughput": self.games / elapsed if elapsed else 0,
+            "boards": boards,
+            "winning_axes": {axis: count / won
+                             for axis, count in sorted(self.axes.items())}
+        }
+
+
+def replay_axis(columns, rows, win_zone, moves):
+    """
+    Returns the axis the last of `moves` won along, or None, replaying them
+    on a pair of bitboards rather than a ConnectPyGame
+    """
+    if not moves:
+        return None
+    stride = rows + 1
+    boards = [0, 0]
+    heights = [0] * columns
+    bit = 0
+    player = 0
+    for column in moves:
+        bit = column * stride + heights[column]
+        heights[column] += 1
+        boards[player] |= 1 << bit
+        player ^= 1
+    board = boards[player ^ 1]
+    for axis, shift in conn_py.axis_shifts(stride):
+        if conn_ai.chain_length(board, bit, shift, win_zone) == win_zone:
+            return axis
+    return None
+
+
+def engine_axis(columns, rows, win_zone, moves):
+    """Returns the same as `replay_axis`, replaying through ConnectPyGame"""
+    if not moves:
+        return None
+    game = conn_py.ConnectPyGame({
+        "game_columns": columns,
+        "game_rows": rows,
+        "win_zone": win_zone
+    })
+    game.players = {1: 1, 2: 2}
+    game.reset_game()
+    game.player_cycle = cycle((1, 2))
+    game.current_turn = game.next_player()
+    for column in moves:
+        player = game.current_turn
+        game.drop_disc(player, column)
+    return game.winning_axis(player, game.last_drop)
+
+
+def block_stats(block, engine=False, stats=None):
+    """Adds the games of the ArchiveBlock `block` to `stats`"""
+    stats = GameStats() if stats is None else stats
+    find_axis = engine_axis if engine else replay_axis
+    offsets, all_moves = block.move_offsets, block.moves
+    for idx in range(len(block)):
+        board = (block.columns[idx], block.rows[idx], block.win_zone[idx])
+        moves = all_moves[offsets[idx]:offsets[idx + 1]]
+        winner = block.winner[idx]
+        axis = find_axis(board[0], board[1], board[2], moves) \
+            if winner else None
+        stats.add(board, len(moves), moves[0] if moves else None,
+                  winner == block.first[idx], axis)
+    return stats
+
+
+def shard_stats(path, start, stop, engine=False):
+    """Returns the GameStats of blocks `start` up to `stop` of an archive"""
+    stats = GameStats()
+    with conn_archive.ArchiveReader(path) as archive:
+        for block in archive.blocks(start, stop):
+            block_stats(block, engine, stats)
+    return stats
+
+
+def run_analytics(path, workers=None, engine=False, task_blocks=TASK_BLOCKS):
+    """
+    Returns the GameStats report of the archive in `path`, sharded over a
+    pool of `workers` processes by ranges of `task_blocks` blocks. Each
+    worker maps the archive itself and holds one block at a time, and
+    shards are merged as they finish
+    """
+    started = time.monotonic()
+    with conn_archive.ArchiveReader(path) as archive:
+        blocks = archive.block_count
+    stats = GameStats()
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+        futures = [pool.submit(shard_stats, path, start,
+                               start + task_blocks, engine)
+                   for start in range(0, blocks, task_blocks)]
+        for future in as_completed(futures):
+            stats.merge(future.result())
+    return stats.report(time.monotonic() - started)
+
+
+def print_report(report):
+    print("{} games, {} moves in {:.2f}s ({:.0f} games/s)".format(
+        report["games"], report["moves"], report["elapsed"],
+        report["throughput"]))
+    for board, stats in report["boards"].items():
+        print("{}: {} games, {} won, {:.1f} moves on average".format(
+            board, stats["games"], stats["won"], stats["average_length"]))
+        print("  first player win rate by first column: {}".format(' '.join(
+            '{}={:.3f}'.format(column, rate) for column, rate in
+            stats["first_column_win_rate"].items())))
+    print("winning axes: {}".format(' '.join(
+        '{}={:.3f}'.format(axis, share)
+        for axis, share in report["winning_axes"].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ConnectPy game archive analytics')
+    parser.add_argument('path', help='Archive directory')
+    parser.add_argument(
+        '-w', dest='workers', type=int,
+        help='Worker processes, one per CPU if not set')
+    parser.add_argument(
+        '-b', dest='task_blocks', type=int, default=TASK_BLOCKS,
+        help='Archive blocks per worker task')
+    parser.add_argument(
+        '--engine', action='store_true',
+        help='Replay games through ConnectPyGame rather than bitboards')
+    parser.add_argument(
+        '--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = run_analytics(args.path, workers=args.workers,
+                           engine=args.engine, task_blocks=args.task_blocks)
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
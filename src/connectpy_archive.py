@@ -0,0 +1,454 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import fcntl
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import time
+import zlib
+import connectpy.connectpy_log as conn_log
+
+from array import array
+from bisect import bisect_right
+from queue import Queue
+from threading import Lock, Thread
+
+log = logging.getLogger('connectpy.archive')
+
+DATA_NAME = 'games.cpa'
+INDEX_NAME = 'games.cpi'
+# magic, format version
+HEADER = struct.Struct('<4sB3x')
+MAGIC = b'CPYA'
+INDEX_MAGIC = b'CPYI'
+FORMAT_VERSION = 1
+# offset of the block in the data file, number of its first game, its
+# compressed length, the games in it and the CRC-32 of its compressed bytes
+INDEX_ENTRY = struct.Struct('<QQIII')
+# Games in a block
+COUNT = struct.Struct('<I')
+# The fixed-width columns of a block, one value per game, in block order.
+# `first` and `winner` are player indicators, a `winner` of 0 is no winner
+COLUMNS = (
+    ('columns', 'H'),
+    ('rows', 'H'),
+    ('win_zone', 'H'),
+    ('first', 'B'),
+    ('winner', 'B'),
+    ('finished', 'd'),
+)
+PLAYERS = 2
+# Blocks are little-endian, arrays are read and written in native order
+SWAP = sys.byteorder != 'little'
+
+
+class ArchiveException(Exception):
+    pass
+
+
+class ArchivedGame(object):
+    """A finished game as kept in the archive"""
+
+    __slots__ = ('game_id', 'columns', 'rows', 'win_zone', 'players',
+                 'first', 'winner', 'finished', 'moves')
+
+    def __init__(self, game_id, columns, rows, win_zone, players, first,
+                 winner, finished, moves):
+        self.game_id = game_id
+        self.columns = columns
+        self.rows = rows
+        self.win_zone = win_zone
+        # Player ids by indicator, so `players[0]` is player 1
+        self.players = players
+        self.first = first
+        self.winner = winner
+        self.finished = finished
+        self.moves = moves
+
+    @classmethod
+    def from_game(cls, game):
+        """Returns the ArchivedGame of the ConnectPyGame `game` as it is"""
+        players = [''] * PLAYERS
+        for player_id, indicator in game.players.items():
+            players[indicator - 1] = player_id
+        winner = game.players[game.winner] if game.winner else 0
+        # Turns alternate, so whoever played last also played first if the
+        # number of moves is odd
+        last = winner or next(
+            (indicator for player_id, indicator in game.players.items()
+             if player_id != game.current_turn), 1)
+        first = last if len(game.moves) % 2 else PLAYERS + 1 - last
+        return cls(game.id or '', game.columns, game.rows, game.win_zone,
+                   tuple(players), first, winner, time.time(),
+                   list(game.moves))
+
+    @property
+    def winner_id(self):
+        return self.players[self.winner - 1] if self.winner else None
+
+    @property
+    def dict(self):
+        return {
+            "game_id": self.game_id,
+            "columns": self.columns,
+            "rows": self.rows,
+            "win_zone": self.win_zone,
+            "players": list(self.players),
+            "first": self.first,
+            "winner": self.winner,
+            "finished": self.finished,
+            "moves": list(self.moves)
+        }
+
+
+def to_bytes(values):
+    if SWAP:
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def read_array(data, pos, typecode, count):
+    """Returns (array of `count` values at `pos` in `data`, end position)"""
+    values = array(typecode)
+    end = pos + values.itemsize * count
+    values.frombytes(data[pos:end])
+    if SWAP:
+        values.byteswap()
+    return values, end
+
+
+def encode_block(games):
+    """
+    Returns the ArchivedGames `games` as an uncompressed block: the game
+    count, each fixed-width column in turn, the offsets of each game's moves
+    and names, then the moves (one column index each) and the names (game
+    id then player ids, UTF-8)
+    """
+    parts = [COUNT.pack(len(games))]
+    for name, typecode in COLUMNS:
+        parts.append(to_bytes(array(
+            typecode, [getattr(game, name) for game in games])))
+
+    move_offsets, moves = array('I', [0]), array('H')
+    name_offsets, names = array('I', [0]), []
+    for game in games:
+        moves.extend(game.moves)
+        move_offsets.append(len(moves))
+        for name in (game.game_id,) + tuple(game.players):
+            names.append(name.encode('utf-8'))
+            name_offsets.append(name_offsets[-1] + len(names[-1]))
+    parts.extend([to_bytes(move_offsets), to_bytes(name_offsets),
+                  to_bytes(moves), b''.join(names)])
+    return b''.join(parts)
+
+
+class ArchiveBlock(object):
+    """
+    One decoded block of the archive, held column by column. `moves` holds
+    the moves of every game in the block back to back, those of game `idx`
+    run from `move_offsets[idx]` to `move_offsets[idx + 1]`
+    """
+
+    def __init__(self, data, first_game=0):
+        (self.count,) = COUNT.unpack_from(data)
+        self.first_game = first_game
+        pos = COUNT.size
+        for name, typecode in COLUMNS:
+            values, pos = read_array(data, pos, typecode, self.count)
+            setattr(self, name, values)
+        self.move_offsets, pos = read_array(data, pos, 'I', self.count + 1)
+        self.name_offsets, pos = read_array(
+            data, pos, 'I', self.count * (PLAYERS + 1) + 1)
+        self.moves, pos = read_array(data, pos, 'H', self.move_offsets[-1])
+        self.names = data[pos:pos + self.name_offsets[-1]]
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        for idx in range(self.count):
+            yield self.game(idx)
+
+    def game_moves(self, idx):
+        return self.moves[self.move_offsets[idx]:self.move_offsets[idx + 1]]
+
+    def name(self, idx):
+        return self.names[self.name_offsets[idx]:
+                          self.name_offsets[idx + 1]].decode('utf-8')
+
+    def game(self, idx):
+        """Returns the ArchivedGame at `idx` in this block"""
+        names = [self.name(idx * (PLAYERS + 1) + n)
+                 for n in range(PLAYERS + 1)]
+        return ArchivedGame(
+            names[0], self.columns[idx], self.rows[idx], self.win_zone[idx],
+            tuple(names[1:]), self.first[idx], self.winner[idx],
+            self.finished[idx], self.game_moves(idx))
+
+
+class ArchiveWriter(object):
+    """
+    Appends finished games to the archive in `archive_path`. Games are
+    buffered and written `archive_block_games` at a time, as one block
+    compressed with zlib, followed by its entry in the index. Full blocks
+    are compressed and written by a background thread, so recording a game
+    only costs a copy of its moves and a list append.
+
+    Blocks are written under an exclusive lock on the index, so several
+    processes can append to one archive. The data is synced before its
+    index entry is written, and readers only see indexed blocks, so a crash
+    loses only the games not yet written out. `close` writes those.
+    A block that fails to write is logged and dropped, and reported by the
+    next `flush`
+    """
+
+    def __init__(self, config):
+        """
+        Expect a `config` of the form:
+            archive_path: /var/lib/connectpy/archive
+            archive_block_games: 4096
+            archive_compression: 6
+        """
+        self.path = config['archive_path']
+        self.block_games = config.get('archive_block_games', 4096)
+        self.compression = config.get('archive_compression', 6)
+        os.makedirs(self.path, exist_ok=True)
+        self.lock = Lock()
+        self.buffer = []
+        # Full blocks waiting for the writer thread, None stops it
+        self.blocks = Queue()
+        self.thread = None
+        # Games in blocks that failed to write since the last flush
+        self.failed = 0
+
+    def record(self, game):
+        """
+        Buffers the finished ConnectPyGame `game`, writing out a block if
+        the buffer is full. Call before the game is reset
+        """
+        self.append(ArchivedGame.from_game(game))
+
+    def append(self, archived):
+        with self.lock:
+            self.buffer.append(archived)
+            if len(self.buffer) < self.block_games:
+                return
+            games, self.buffer = self.buffer, []
+        self.start()
+        self.blocks.put(games)
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = Thread(target=self.run, daemon=True)
+                self.thread.start()
+
+    def run(self):
+        while True:
+            games = self.blocks.get()
+            try:
+                if games is None:
+                    return
+                self.write_block(games)
+            except Exception:
+                # Keep the thread alive for later blocks, and `flush` from
+                # waiting on a dead one
+                log.exception("Archive block write failed", extra=(
+                    conn_log.fields(path=self.path, games=len(games))))
+                with self.lock:
+                    self.failed += len(games)
+            finally:
+                self.blocks.task_done()
+
+    def write_block(self, games):
+        block = zlib.compress(encode_block(games), self.compression)
+        with open(os.path.join(self.path, INDEX_NAME), 'a+b') as index:
+            # Released when the index is closed
+            fcntl.flock(index, fcntl.LOCK_EX)
+            size = os.fstat(index.fileno()).st_size
+            if size < HEADER.size:
+                index.truncate(0)
+                index.write(HEADER.pack(INDEX_MAGIC, FORMAT_VERSION))
+                size = HEADER.size
+            # Drop a torn entry left by a crash mid-write
+            entries = (size - HEADER.size) // INDEX_ENTRY.size
+            size = HEADER.size + entries * INDEX_ENTRY.size
+            index.truncate(size)
+            first_game = 0
+            if entries:
+                index.seek(size - INDEX_ENTRY.size)
+                _, first, _, count, _ = INDEX_ENTRY.unpack(
+                    index.read(INDEX_ENTRY.size))
+                first_game = first + count
+
+            with open(os.path.join(self.path, DATA_NAME), 'ab') as data:
+                offset = os.fstat(data.fileno()).st_size
+                if offset < HEADER.size:
+                    data.truncate(0)
+                    data.write(HEADER.pack(MAGIC, FORMAT_VERSION))
+                    offset = HEADER.size
+                data.write(block)
+                data.flush()
+                os.fsync(data.fileno())
+
+            index.write(INDEX_ENTRY.pack(
+                offset, first_game, len(block), len(games),
+                zlib.crc32(block)))
+            index.flush()
+            os.fsync(index.fileno())
+
+    def flush(self):
+        """
+        Writes out the buffered games now, as a short block, and waits for
+        every block to be written. Raises ArchiveException if any games
+        failed to write since the last flush
+        """
+        with self.lock:
+            games, self.buffer = self.buffer, []
+        if games:
+            self.start()
+            self.blocks.put(games)
+        if self.thread is not None:
+            if not self.thread.is_alive():
+                raise ArchiveException("Archive writer thread has stopped")
+            self.blocks.join()
+        with self.lock:
+            failed, self.failed = self.failed, 0
+        if failed:
+            raise ArchiveException(
+                "{} games failed to archive - see the log".format(failed))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.thread is not None:
+                self.blocks.put(None)
+                self.thread.join()
+                self.thread = None
+
+
+class ArchiveReader(object):
+    """
+    Read-only view of the archive in `path`, as it was when opened. The data
+    is memory-mapped and each block decompressed as it's read, so only the
+    index and the block in hand are held in memory however many games are
+    archived. Games are numbered in the order they were archived
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, INDEX_NAME), 'rb') as f:
+            index = f.read()
+        if len(index) < HEADER.size or HEADER.unpack_from(index) != (
+                INDEX_MAGIC, FORMAT_VERSION):
+            raise ArchiveException("{} is not an archive".format(path))
+
+        with open(os.path.join(path, DATA_NAME), 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+                if size else None
+        if size and HEADER.unpack_from(self.map) != (MAGIC, FORMAT_VERSION):
+            self.close()
+            raise ArchiveException("{} is not an archive".format(path))
+
+        self.offsets, self.firsts, self.lengths, self.crcs = [], [], [], []
+        self.count = 0
+        end = HEADER.size + (len(index) - HEADER.size) // \
+            INDEX_ENTRY.size * INDEX_ENTRY.size
+        for offset, first, length, count, crc in INDEX_ENTRY.iter_unpack(
+                index[HEADER.size:end]):
+            if offset + length > size:
+                break
+            self.offsets.append(offset)
+            self.firsts.append(first)
+            self.lengths.append(length)
+            self.crcs.append(crc)
+            self.count = first + count
+        self.cached = (None, None)
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    @property
+    def block_count(self):
+        return len(self.offsets)
+
+    def block(self, idx):
+        """Returns the ArchiveBlock at `idx`"""
+        cached_idx, block = self.cached
+        if cached_idx == idx:
+            return block
+        offset, length = self.offsets[idx], self.lengths[idx]
+        data = self.map[offset:offset + length]
+        if zlib.crc32(data) != self.crcs[idx]:
+            raise ArchiveException(
+                "Block {} of {} is corrupt".format(idx, self.path))
+        block = ArchiveBlock(zlib.decompress(data), self.firsts[idx])
+        self.cached = (idx, block)
+        return block
+
+    def blocks(self, start=0, stop=None):
+        """Yields the ArchiveBlocks from `start` up to `stop`"""
+        for idx in range(start, self.block_count if stop is None
+                         else min(stop, self.block_count)):
+            yield self.block(idx)
+
+    def __iter__(self):
+        for block in self.blocks():
+            yield from block
+
+    def __getitem__(self, number):
+        """Returns game `number` as an ArchivedGame"""
+        if number < 0:
+            number += self.count
+        if not 0 <= number < self.count:
+            raise IndexError("No game {} in {}".format(number, self.path))
+        idx = bisect_right(self.firsts, number) - 1
+        return self.block(idx).game(number - self.firsts[idx])
+
+
+def new_archive(config):
+    """Returns an ArchiveWriter if `archive_path` is set, otherwise None"""
+    if not config.get('archive_path'):
+        return None
+    return ArchiveWriter(config)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ConnectPy game archive reader')
+    parser.add_argument('path', help='Archive directory')
+    parser.add_argument(
+        '-g', dest='games', type=int, nargs='*',
+        help='Print these games as JSON lines, or every game if none given')
+    args = parser.parse_args()
+
+    with ArchiveReader(args.path) as archive:
+        if args.games is None:
+            print("{} games in {} blocks".format(
+                len(archive), archive.block_count))
+            return
+        games = (archive[number] for number in args.games) \
+            if args.games else iter(archive)
+        for game in games:
+            print(json.dumps(game.dict, separators=(',', ':')))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,592 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import atexit
+import json
+import logging
+import connectpy.connectpy_game as conn_py
+import connectpy.connectpy_lobby as conn_lobby
+import connectpy.connectpy_server as conn_server
+import connectpy.connectpy_metrics as conn_metrics
+import connectpy.connectpy_log as conn_log
+import connectpy.connectpy_wire as conn_wire
+import connectpy.connectpy_archive as conn_archive
+
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial, wraps
+from time import perf_counter
+from urllib.parse import urlsplit
+
+MAX_BODY = 1 << 16
+
+log = logging.getLogger('connectpy.asgi')
+
+
+class Request(object):
+    """The parts of an ASGI HTTP request the endpoints use"""
+
+    def __init__(self, scope, body):
+        self.method = scope['method']
+        self.path = scope['path']
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                        for name, value in scope.get('headers', [])}
+        self.mimetype = self.headers.get(
+            'content-type', '').split(';')[0].strip().lower()
+        self.body = body
+        self._json = None
+
+    @property
+    def json(self):
+        """The JSON body, or {} if the body isn't JSON"""
+        if self._json is None:
+            try:
+                self._json = json.loads(self.body.decode('utf-8') or '{}')
+            except ValueError:
+                self._json = {}
+            if not isinstance(self._json, dict):
+                self._json = {}
+        return self._json
+
+    def if_none_match(self, etag):
+        """Returns True if the If-None-Match header matches `etag`"""
+        header = self.headers.get('if-none-match')
+        if not header:
+            return False
+        for tag in header.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                tag = tag[2:]
+            if tag == '*' or tag.strip('"') == etag:
+                return True
+        return False
+
+
+class Response(object):
+
+    def __init__(self, body=b'', status=200, content_type='application/json',
+                 headers=None):
+        self.body = body.encode('utf-8') if isinstance(body, str) else body
+        self.status = status
+        self.headers = [(b'content-type', content_type.encode('latin-1'))]
+        for name, value in (headers or {}).items():
+            self.headers.append(
+                (name.lower().encode('latin-1'), value.encode('latin-1')))
+
+    def set_etag(self, etag, weak=False):
+        self.headers.append((b'etag', '{}"{}"'.format(
+            'W/' if weak else '', etag).encode('latin-1')))
+
+    async def send(self, receive, send):
+        await send({
+            'type': 'http.response.start',
+            'status': self.status,
+            'headers': self.headers + [
+                (b'content-length', str(len(self.body)).encode('latin-1'))]
+        })
+        await send({'type': 'http.response.body', 'body': self.body})
+
+
+class StreamingResponse(Response):
+    """Response sending each string `chunks` yields until the client goes"""
+
+    def __init__(self, chunks, content_type, headers=None):
+        super(StreamingResponse, self).__init__(
+            status=200, content_type=content_type, headers=headers)
+        self.chunks = chunks
+
+    async def send(self, receive, send):
+        await send({'type': 'http.response.start', 'status': self.status,
+                    'headers': self.headers})
+
+        async def stream():
+            async for chunk in self.chunks:
+                await send({'type': 'http.response.body',
+                            'body': chunk.encode('utf-8'), 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        async def disconnected():
+            while (await receive())['type'] != 'http.disconnect':
+                pass
+
+        streaming = asyncio.ensure_future(stream())
+        waiting = asyncio.ensure_future(disconnected())
+        done, pending = await asyncio.wait(
+            [streaming, waiting], return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+        await self.chunks.aclose()
+
+
+def json_response(data, status=200):
+    return Response(json.dumps(data, separators=(',', ':')), status=status)
+
+
+def error_response(error_str, status=400):
+    return json_response({'error': error_str}, status=status)
+
+
+def game_started(func):
+    @wraps(func)
+    async def decorator(app, request):
+        if request.player_id == conn_server.BOT_PLAYER_ID:
+            return error_response("player_id {} is reserved".format(
+                conn_server.BOT_PLAYER_ID), status=400)
+        try:
+            request.game = await app.run_sync(pick_game, app, request)
+        except conn_lobby.LobbyFullException as e:
+            return error_response(str(e), status=503)
+        return await func(app, request)
+    return decorator
+
+
+def player_joined(func):
+    @wraps(func)
+    async def decorator(app, request):
+        try:
+            request.game = await app.run_sync(
+                app.lobby.get_game, request.json.get('game_id'))
+            player_id = request.json.get('player_id')
+            request.game.get_player_indicator(player_id)
+            request.player_id = player_id
+        except conn_lobby.GameNotFoundException as e:
+            return error_response(str(e), status=404)
+        except conn_py.PlayerInvalidException as e:
+            return error_response(str(e), status=403)
+        else:
+            resp = await func(app, request)
+        return resp
+    return decorator
+
+
+def required_fields(fields):
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(app, request):
+            missing = []
+            if request.mimetype == 'application/json':
+                for field in fields:
+                    try:
+                        setattr(request, field, request.json[field])
+                    except KeyError:
+                        missing.append(field)
+                if missing:
+                    return error_response(
+                        "{} field(s) required".format(','.join(missing)),
+                        status=400)
+            else:
+                return error_response(
+                    "Unsupported Content-Type - expected: application/json",
+                    status=415)
+            resp = await func(app, request)
+            return resp
+        return wrapper
+    return decorator
+
+
+def pick_game(app, request):
+    """Returns a new game for bot games, otherwise the waiting game"""
+    if request.json.get('opponent') == 'bot':
+        return app.lobby.new_game()
+    return app.lobby.waiting_game()
+
+
+def state_response(app, request, game):
+    """
+    Returns the full state of `game`, or only the changes since the version
+    in the request's `since` field, as `connectpy_server.state_response`
+    """
+    since = request.json.get('since')
+    if since is not None:
+        delta = game.changes_since(since)
+        if delta is not None:
+            resp = json_response(delta)
+            set_state_etag(resp, game.id, delta['version'])
+            return resp
+
+    binary, compress = conn_wire.negotiate(
+        request.headers.get('accept'), request.headers.get('accept-encoding'),
+        app.config)
+    version, body, gzipped = conn_wire.encoded_state(
+        game, binary, compress, app.config.get(
+            'wire_gzip_min_size', conn_wire.GZIP_MIN_SIZE))
+    headers = {'Content-Encoding': 'gzip'} if gzipped else None
+    resp = Response(body, content_type=conn_wire.MIMETYPE if binary
+                    else conn_wire.JSON_MIMETYPE, headers=headers)
+    set_state_etag(resp, game.id, version)
+    return resp
+
+
+def set_state_etag(resp, game_id, version):
+    """As `connectpy_server.set_state_etag`"""
+    resp.set_etag(conn_server.game_etag(game_id, version), weak=True)
+    resp.headers.append((b'vary', b'Accept, Accept-Encoding'))
+
+
+# The endpoints below run game changes, and any bot moves they trigger, on
+# the app's thread pool so they never stall the event loop. Waiting is done
+# on the loop, which is what makes an idle player cheap
+
+@required_fields(['player_id'])
+@game_started
+async def join(app, request):
+    return await app.run_sync(join_game, app, request)
+
+
+def join_game(app, request):
+    # Joins racing for the same waiting game are settled under its lock,
+    # the losers move on to the next waiting game
+    for _ in range(conn_server.JOIN_ATTEMPTS):
+        if not request.game.started and not request.game.players_ready:
+            with app.lobby.locked(request.game.id) as game:
+                if not game.started and not game.players_ready:
+                    return add_players(app, request, game)
+        try:
+            request.game = pick_game(app, request)
+        except conn_lobby.LobbyFullException as e:
+            return error_response(str(e), status=503)
+    return error_response("ConnectPy game in progress", status=503)
+
+
+def add_players(app, request, game):
+    try:
+        game.add_player(request.player_id)
+    except conn_py.AlreadyJoinedException as e:
+        return error_response(str(e), status=409)
+    else:
+        log.info("Player joined", extra=conn_log.fields(
+            player_id=request.player_id, game_id=game.id))
+
+    if request.json.get('opponent') == 'bot' and not game.players_ready:
+        game.add_player(conn_server.BOT_PLAYER_ID, bot=app.bot)
+
+    if game.players_ready:
+        game.start_game()
+        game.play_bots()
+        log.info("Game started", extra=conn_log.fields(game_id=game.id))
+
+    return state_response(app, request, game)
+
+
+@required_fields(['player_id', 'game_id'])
+@player_joined
+async def status(app, request):
+    version = request.json.get('version')
+    if version is not None:
+        # Long-poll: hold the request until the game moves past `version`
+        try:
+            wait = min(float(request.json.get('wait', 0)),
+                       app.config.get('status_max_wait', 30))
+        except (TypeError, ValueError):
+            return error_response("wait must be a number", status=400)
+        if wait > 0 and await app.wait_for_change(
+                request.game, version, wait):
+            request.game = await app.run_sync(
+                app.lobby.get_game, request.game.id)
+
+    etag = conn_server.game_etag(request.game.id, request.game.version)
+    if request.if_none_match(etag):
+        resp = Response(status=304)
+        set_state_etag(resp, request.game.id, request.game.version)
+        return resp
+    return state_response(app, request, request.game)
+
+
+@required_fields(['player_id', 'game_id'])
+@player_joined
+async def events(app, request):
+    """
+    Server-Sent Events stream of the game, as `connectpy_server.events`
+    """
+    game = request.game
+    keepalive = app.config.get('events_keepalive', 15)
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+
+    def publish(event):
+        loop.call_soon_threadsafe(queue.put_nowait, event)
+
+    async def stream():
+        # Subscribe before the snapshot so no event can be missed, clients
+        # skip any event with a version the snapshot already includes
+        app.lobby.subscribe(game, publish)
+        try:
+            state = game.dict
+            yield conn_server.sse_event(dict(
+                type='state', version=state['version'], state=state))
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), keepalive)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                yield conn_server.sse_event(event)
+                if event['type'] == 'close':
+                    break
+        finally:
+            app.lobby.unsubscribe(game, publish)
+
+    return StreamingResponse(stream(), 'text/event-stream',
+                             headers={'Cache-Control': 'no-cache'})
+
+
+@required_fields(['player_id', 'game_id'])
+@player_joined
+async def hints(app, request):
+    hints = request.game.hints(request.player_id)
+    return json_response(dict(
+        hints, game_id=request.game.id, player_id=request.player_id))
+
+
+@required_fields(['player_id', 'game_id', 'column'])
+@player_joined
+async def move(app, request):
+    return await app.run_sync(move_game, app, request)
+
+
+def move_game(app, request):
+    player_id = request.json['player_id']
+    column = request.json['column']
+
+    with app.lobby.locked(request.game.id) as game:
+        if not game.is_turn(player_id):
+            return error_response(
+                "Not your turn! - Enhance your calm", status=420)
+        try:
+            winner = game.drop_disc(player_id, column)
+        except (conn_py.FullColumnException,
+                conn_py.ColumnOutOfBoundsException) as e:
+            return error_response(str(e), status=400)
+        if not winner:
+            # Bots reply within the same request
+            winner = game.play_bots()
+
+        resp = state_response(app, request, game)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Disc dropped", extra=conn_log.fields(
+                game_id=game.id, player_id=player_id, grid=game.grid))
+        if winner:
+            log.info("Game won - resetting", extra=conn_log.fields(
+                game_id=game.id, winner=game.winner))
+            if app.archive is not None:
+                app.archive.record(game)
+            game.reset_game()
+            game.play_bots()
+        return resp
+
+
+@required_fields(['player_id', 'game_id'])
+@player_joined
+async def close(app, request):
+    return await app.run_sync(close_game, app, request)
+
+
+def close_game(app, request):
+    with app.lobby.locked(request.game.id) as game:
+        game.close(request.player_id)
+        resp = state_response(app, request, game)
+    log.info("Game closed", extra=conn_log.fields(
+        game_id=game.id, player_id=request.player_id))
+    return resp
+
+
+async def metrics(app, request):
+    body = await app.run_sync(conn_metrics.scrape, app.lobby)
+    return Response(body, content_type=conn_metrics.CONTENT_TYPE)
+
+
+ROUTES = {
+    '/join': (join, ('POST',)),
+    '/status': (status, ('GET', 'POST')),
+    '/events': (events, ('GET', 'POST')),
+    '/hints': (hints, ('GET', 'POST')),
+    '/move': (move, ('POST',)),
+    '/close': (close, ('POST',)),
+    '/metrics': (metrics, ('GET',)),
+}
+
+
+class ConnectPyASGI(object):
+    """
+    ASGI application serving the `connectpy_server` endpoints. Run it with
+    any ASGI server, e.g. `uvicorn connectpy_asgi_app:app`
+    """
+
+    def __init__(self, config):
+        """
+        Expect a `config` of the form:
+            asgi_threads: 16
+        plus any `connectpy_server` config
+        """
+        self.config = config
+        conn_log.setup_logging(config)
+        self.executor = ThreadPoolExecutor(config.get('asgi_threads', 16))
+        # game_id: Watch
+        self.watches = {}
+        conn_server.new_lobby(self)
+        self.archive = conn_archive.new_archive(config)
+        if self.archive is not None:
+            atexit.register(self.archive.close)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    self.executor.shutdown(wait=False)
+                    if self.archive is not None:
+                        self.archive.close()
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if len(body) > MAX_BODY:
+                await error_response(
+                    "Request body too large", status=413).send(receive, send)
+                return
+
+        request = Request(scope, body)
+        try:
+            handler, methods = ROUTES[request.path]
+        except KeyError:
+            resp = error_response("Not found", status=404)
+        else:
+            if request.method not in methods:
+                resp = error_response("Method not allowed", status=405)
+            else:
+                started = perf_counter()
+                resp = await self.handle(handler, request)
+                conn_metrics.observe_request(
+                    request.path, resp.status, perf_counter() - started,
+                    None if isinstance(resp, StreamingResponse)
+                    else len(resp.body))
+        await resp.send(receive, send)
+
+    async def handle(self, handler, request):
+        try:
+            return await handler(self, request)
+        except conn_lobby.GameBusyException as e:
+            return error_response(str(e), status=503)
+        except conn_lobby.GameNotFoundException as e:
+            return error_response(str(e), status=404)
+
+    async def run_sync(self, func, *args):
+        """Runs `func(*args)` on the thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, partial(func, *args))
+
+    async def wait_for_change(self, game, version, timeout):
+        """
+        Waits without a thread until `game` moves past `version` or
+        `timeout` seconds pass. Returns True if it changed
+        """
+        watch = self.watches.get(game.id)
+        if watch is None:
+            watch = self.watches[game.id] = Watch(self.lobby, game)
+        watch.waiters += 1
+        try:
+            changed = watch.changed
+            # Checked after joining the watch so a change can't slip in
+            if game.version != version:
+                return True
+            await asyncio.wait_for(changed.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            watch.waiters -= 1
+            if not watch.waiters:
+                del self.watches[game.id]
+                watch.close()
+
+
+class Watch(object):
+    """
+    One subscription to a game shared by every request waiting on it, so
+    a waiting player costs a suspended task rather than a thread or a
+    subscriber
+    """
+
+    def __init__(self, lobby, game):
+        self.lobby = lobby
+        self.game = game
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.waiters = 0
+        lobby.subscribe(game, self.notify)
+
+    def notify(self, event):
+        self.loop.call_soon_threadsafe(self.fire)
+
+    def fire(self):
+        # Wakes the current waiters, later ones wait for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def close(self):
+        self.lobby.unsubscribe(self.game, self.notify)
+
+
+class Result(object):
+    """Response captured by `call`"""
+
+    def __init__(self, status, headers, body):
+        self.status_code = status
+        self.headers = headers
+        self.data = body
+
+    @property
+    def json(self):
+        return json.loads(self.data.decode('utf-8')) if self.data else None
+
+
+async def call(app, method, url, json_body=None, headers=None):
+    """
+    Sends one HTTP request straight to the ASGI `app`, without a server,
+    and returns its Result. Streams aren't supported
+    """
+    body = json.dumps(json_body).encode('utf-8') \
+        if json_body is not None else b''
+    headers = dict(headers or {})
+    if json_body is not None:
+        headers.setdefault('Content-Type', 'application/json')
+    scope = {
+        'type': 'http',
+        'method': method,
+        'path': urlsplit(url).path,
+        'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                    for name, value in headers.items()],
+    }
+    sent = []
+    received = [{'type': 'http.request', 'body': body}]
+
+    async def receive():
+        if received:
+            return received.pop()
+        await asyncio.Future()
+
+    async def send(message):
+        sent.append(message)
+
+    await app(scope, receive, send)
+    start = sent[0]
+    return Result(
+        start['status'],
+        {name.decode('latin-1'): value.decode('latin-1')
+         for name, value in start['headers']},
+        b''.join(message.get('body', b'') for message in sent[1:]))
+
+
+def create_app():
+    return ConnectPyASGI(conn_server.get_config())
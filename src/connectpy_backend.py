@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import time
+import uuid
+import connectpy.connectpy_game as conn_py
+import connectpy.connectpy_lobby as conn_lobby
+
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from multiprocessing.managers import BaseManager
+from threading import Condition, Event, Lock, Thread
+
+# The store served by this process, see `get_store`
+_STORE = None
+
+
+class SharedStore(object):
+    """
+    Redis-like key-value store of strings, counters, lists and sorted sets
+    with leased locks, run in one process and shared with the server
+    workers by BackendManager. Each client connection is served by its own
+    thread, so a blocked `lock` only holds up its caller
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lists = {}
+        # key: ([(score, member)] in order, {member: score})
+        self.zsets = {}
+        # name: (token, lease expiry)
+        self.locks = {}
+        self.released = Condition()
+        # Makes the read-modify-write commands atomic
+        self.guard = Lock()
+
+    def get(self, key):
+        return self.values.get(key)
+
+    def set(self, key, value):
+        self.values[key] = value
+
+    def delete(self, *keys):
+        for key in keys:
+            self.values.pop(key, None)
+            self.lists.pop(key, None)
+            self.zsets.pop(key, None)
+
+    def keys(self, prefix=''):
+        return [key for key in list(self.values) if key.startswith(prefix)]
+
+    def incr(self, key, amount=1):
+        with self.guard:
+            value = self.values.get(key, 0) + amount
+            self.values[key] = value
+        return value
+
+    def rpush(self, key, *values):
+        with self.guard:
+            items = self.lists.setdefault(key, [])
+            items.extend(values)
+            return len(items)
+
+    def ltrim(self, key, start, stop=None):
+        """Keeps only the items of `key` from `start` up to `stop`"""
+        with self.guard:
+            if key in self.lists:
+                self.lists[key] = self.lists[key][start:stop]
+
+    def lrange(self, key, start=0, stop=None):
+        return self.lists.get(key, [])[start:stop]
+
+    def llen(self, key):
+        return len(self.lists.get(key, []))
+
+    def zadd(self, key, member, score):
+        """Adds `member` to the sorted set `key`, or moves it to `score`"""
+        with self.guard:
+            entries, scores = self.zsets.setdefault(key, ([], {}))
+            if member in scores:
+                del entries[bisect_left(entries, (scores[member], member))]
+            scores[member] = score
+            insort(entries, (score, member))
+
+    def zrem(self, key, *members):
+        with self.guard:
+            entries, scores = self.zsets.get(key, ([], {}))
+            for member in members:
+                if member in scores:
+                    del entries[bisect_left(
+                        entries, (scores.pop(member), member))]
+
+    def zrangebyscore(self, key, maximum, count=None):
+        """
+        Returns up to `count` members of the sorted set `key` scored at most
+        `maximum`, lowest first
+        """
+        members = []
+        with self.guard:
+            for score, member in self.zsets.get(key, ([], {}))[0]:
+                if score > maximum or len(members) == count:
+                    break
+                members.append(member)
+        return members
+
+    def zscore(self, key, member):
+        return self.zsets.get(key, ([], {}))[1].get(member)
+
+    def zcard(self, key):
+        return len(self.zsets.get(key, ([], {}))[1])
+
+    def lock(self, name, timeout=5, lease=10):
+        """
+        Returns a token once the lock `name` is free or its holder's `lease`
+        has run out, or None after `timeout` seconds
+        """
+        token = uuid.uuid4().hex
+        deadline = time.monotonic() + timeout
+        with self.released:
+            while True:
+                now = time.monotonic()
+                held = self.locks.get(name)
+                if held is None or held[1] <= now:
+                    break
+                if now >= deadline:
+                    return None
+                self.released.wait(min(deadline, held[1]) - now)
+            self.locks[name] = (token, now + lease)
+        return token
+
+    def unlock(self, name, token):
+        """Releases `name` if it's still held with `token`"""
+        with self.released:
+            held = self.locks.get(name)
+            if held is None or held[0] != token:
+                return False
+            del self.locks[name]
+            self.released.notify_all()
+        return True
+
+
+def get_store():
+    global _STORE
+    if _STORE is None:
+        _STORE = SharedStore()
+    return _STORE
+
+
+class BackendManager(BaseManager):
+    pass
+
+BackendManager.register('store', callable=get_store)
+
+
+def manager_address(config):
+    host, port = config.get('backend_address', '127.0.0.1:6399').split(':')
+    return host, int(port)
+
+
+def connect(config):
+    """Returns a proxy to the SharedStore served at `backend_address`"""
+    manager = BackendManager(
+        address=manager_address(config),
+        authkey=config.get('backend_authkey', 'connectpy').encode())
+    manager.connect()
+    return manager.store()
+
+
+class SharedLobby(object):
+    """
+    ConnectPyLobby work-alike keeping games in a SharedStore, so any number
+    of server processes see the same games. Each game is saved as a
+    `ConnectPyGame.snapshot`, its version and a list of its latest
+    `game_log_size` events, and is changed under a per-game lock: loaded,
+    changed and saved in `locked`. Open game and player counts and an index
+    of games by expiry time are kept up to date as games are saved, so
+    neither metrics nor eviction have to scan the games
+    """
+
+    def __init__(self, config, bot=None, shared=None):
+        """
+        Expect a `config` of the form:
+            backend_address: 127.0.0.1:6399
+            backend_authkey: connectpy
+            backend_lock_timeout: 5
+            backend_lock_lease: 10
+            backend_poll_interval: 0.05
+        plus any ConnectPyLobby config. `shared` is a connected store, one is
+        connected to from the config if not given
+        """
+        self.config = config
+        self.bot = bot
+        self.shared = shared if shared is not None else connect(config)
+        self.max_games = config.get('max_games', 50000)
+        self.idle_timeout = config.get('game_idle_timeout', 300)
+        self.closed_timeout = config.get('closed_game_timeout', 30)
+        self.lock_timeout = config.get('backend_lock_timeout', 5)
+        self.lock_lease = config.get('backend_lock_lease', 10)
+        self.poll_interval = config.get('backend_poll_interval', 0.05)
+        self.log_size = config.get('game_log_size', 100)
+        self.pollers = {}
+
+    def __len__(self):
+        return self.shared.zcard('expiry')
+
+    @contextmanager
+    def lock(self, name, timeout=None):
+        token = self.shared.lock(
+            name, self.lock_timeout if timeout is None else timeout,
+            self.lock_lease)
+        if token is None:
+            raise conn_lobby.GameBusyException(
+                "{} busy - try again later".format(name))
+        try:
+            yield
+        finally:
+            self.shared.unlock(name, token)
+
+    def load(self, game_id):
+        state = self.shared.get('game:{}'.format(game_id))
+        if state is None:
+            raise conn_lobby.GameNotFoundException(
+                "Game {} not found".format(game_id))
+        return conn_py.ConnectPyGame.from_snapshot(
+            json.loads(state), bot=self.bot)
+
+    def save(self, game, events=()):
+        self.shared.set('game:{}'.format(game.id),
+                        json.dumps(game.snapshot(), separators=(',', ':')))
+        if events:
+            key = 'log:{}'.format(game.id)
+            length = self.shared.rpush(key, *[
+                json.dumps(event, separators=(',', ':')) for event in events])
+            if length > self.log_size:
+                self.shared.ltrim(key, -self.log_size)
+        self.shared.set('version:{}'.format(game.id), game.version)
+        self.touch(game)
+
+    def touch(self, game):
+        """Pushes back the expiry of `game`, closed games expire sooner"""
+        timeout = self.closed_timeout if game.closed else self.idle_timeout
+        self.shared.zadd('expiry', game.id, time.time() + timeout)
+
+    def count(self, before, after):
+        """
+        Updates the open game and player counts for a game going from
+        `before` to `after`, both `tally` results
+        """
+        for name, old, new in zip(('open', 'players'), before, after):
+            if new != old:
+                self.shared.incr('count:{}'.format(name), new - old)
+
+    @staticmethod
+    def tally(closed, players):
+        """Returns what a game adds to the (open games, players) counts"""
+        return (0, 0) if closed else (1, len(players))
+
+    def new_game(self):
+        """Creates and saves a new game, evicting expired games first"""
+        with self.lock('lobby'):
+            return self.create_game()
+
+    def create_game(self):
+        self.evict()
+        if len(self) >= self.max_games:
+            raise conn_lobby.LobbyFullException(
+                "Maximum games reached - try again later")
+        game = conn_py.ConnectPyGame(self.config, game_id=uuid.uuid4().hex)
+        self.save(game)
+        self.count((0, 0), self.tally(game.closed, game.players))
+        return game
+
+    def waiting_game(self):
+        """
+        Returns the game waiting for an opponent, creating a new one if the
+        last waiting game has filled up or been closed
+        """
+        with self.lock('lobby'):
+            game_id = self.shared.get('waiting')
+            try:
+                game = self.load(game_id)
+            except conn_lobby.GameNotFoundException:
+                game = None
+            if game is None or game.closed or game.players_ready:
+                game = self.create_game()
+                self.shared.set('waiting', game.id)
+            return game
+
+    def get_game(self, game_id):
+        """
+        Returns the latest saved state of `game_id` and marks it active,
+        evicting expired games as ConnectPyLobby does
+        """
+        game = self.load(game_id)
+        if not game.closed:
+            self.touch(game)
+        self.evict()
+        return game
+
+    @contextmanager
+    def locked(self, game_id):
+        """
+        Yields the game for `game_id` under its lock, saving it and the
+        events it published if the block finishes without raising
+        """
+        with self.lock('game:{}'.format(game_id)):
+            game = self.get_game(game_id)
+            before = self.tally(game.closed, game.players)
+            events = []
+            game.subscribe(events.append)
+            yield game
+            if events:
+                self.save(game, events)
+                self.count(before, self.tally(game.closed, game.players))
+
+    def wait_for_change(self, game, version, timeout):
+        """
+        Polls until `game` moves past `version` or `timeout` seconds pass,
+        returning the game's latest state
+        """
+        deadline = time.monotonic() + timeout
+        key = 'version:{}'.format(game.id)
+        while self.shared.get(key) == version and \
+                time.monotonic() < deadline:
+            time.sleep(self.poll_interval)
+        if self.shared.get(key) == game.version:
+            return game
+        return self.load(game.id)
+
+    def subscribe(self, game, subscriber):
+        """
+        Passes `subscriber` every event saved for `game` after its version,
+        polled from the store by a background thread
+        """
+        stop = Event()
+        self.pollers[subscriber] = stop
+
+        def poll():
+            key = 'version:{}'.format(game.id)
+            seen = game.version
+            while not stop.wait(self.poll_interval):
+                version = self.shared.get(key)
+                if version is None or version <= seen:
+                    continue
+                events = self.events_since(game.id, seen, version)
+                if events is None:
+                    # The log was trimmed past `seen`, so start over from
+                    # the full state, as clients do for a 'state' event
+                    try:
+                        state = self.load(game.id).dict
+                    except conn_lobby.GameNotFoundException:
+                        return
+                    events = [dict(type='state', version=state['version'],
+                                   state=state)]
+                for event in events:
+                    subscriber(event)
+                    seen = event['version']
+        Thread(target=poll, daemon=True).start()
+
+    def events_since(self, game_id, seen, version):
+        """
+        Returns the logged events of `game_id` after version `seen`, up to
+        at least `version`, or None if they've been trimmed from the log
+        """
+        key = 'log:{}'.format(game_id)
+        # The log may have grown since `version` was read, in which case its
+        # last `version - seen` events start too late and the whole log is
+        # read instead
+        for start in (seen - version, 0):
+            events = [event for event in map(
+                json.loads, self.shared.lrange(key, start))
+                if event['version'] > seen]
+            if events and events[0]['version'] == seen + 1:
+                return events
+        return None
+
+    def unsubscribe(self, game, subscriber):
+        self.pollers.pop(subscriber).set()
+
+    def remove_game(self, game_id, expired_at=None, timeout=None):
+        """
+        Removes `game_id` under its lock, so no request still holding the
+        game saves it back. With `expired_at`, only removes the game if
+        it's still expired by then once locked. Returns True if removed
+        """
+        with self.lock('game:{}'.format(game_id), timeout=timeout):
+            if expired_at is not None:
+                expiry = self.shared.zscore('expiry', game_id)
+                if expiry is None or expiry > expired_at:
+                    return False
+            state = self.shared.get('game:{}'.format(game_id))
+            self.shared.delete('game:{}'.format(game_id),
+                               'log:{}'.format(game_id),
+                               'version:{}'.format(game_id))
+            self.shared.zrem('expiry', game_id)
+            if state is not None:
+                state = json.loads(state)
+                self.count(
+                    self.tally(state['closed'], state['players']), (0, 0))
+        return True
+
+    def stats(self):
+        """Returns the number of open games and the players in them"""
+        return {"games": self.shared.get('count:open') or 0,
+                "players": self.shared.get('count:players') or 0}
+
+    def evict(self, now=None):
+        """
+        Removes expired games, returning the number evicted. Only expired
+        games are read from the expiry index, and games locked by a
+        request are in use, so they're skipped
+        """
+        now = time.time() if now is None else now
+        evicted = 0
+        for game_id in self.shared.zrangebyscore('expiry', now):
+            try:
+                evicted += self.remove_game(game_id, expired_at=now,
+                                            timeout=0)
+            except conn_lobby.GameBusyException:
+                continue
+        return evicted
+
+    def recover(self, bot=None):
+        return 0
+
+
+def serve(config):
+    """Serves a SharedStore at `backend_address` until interrupted"""
+    manager = BackendManager(
+        address=manager_address(config),
+        authkey=config.get('backend_authkey', 'connectpy').encode())
+    server = manager.get_server()
+    print("Serving ConnectPy shared state on {}:{}".format(*server.address))
+    server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ConnectPy shared state server for multi-process '
+                    'deployments')
+    parser.add_argument(
+        '-a', dest='address', default='127.0.0.1:6399',
+        help='host:port to listen on')
+    parser.add_argument(
+        '-k', dest='authkey', default='connectpy',
+        help='Key server workers authenticate with')
+    args = parser.parse_args()
+    serve({"backend_address": args.address, "backend_authkey": args.authkey})
+
+if __name__ == '__main__':
+    main()
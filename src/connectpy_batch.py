@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def require_numpy():
+    if np is None:
+        raise ImportError(
+            "connectpy_batch needs numpy - pip install connectpy[batch]")
+
+
+def stack_grids(grids):
+    """
+    Returns the `grid` nested lists of ConnectPyGames as a single
+    (N, rows, columns) int8 array
+    """
+    require_numpy()
+    return np.asarray(grids, dtype=np.int8)
+
+
+def chain_windows(mask, win_zone):
+    """
+    Yields a (N, rows', columns') bool array per direction (horizontal,
+    vertical and both diagonals) that is True wherever a line of `win_zone`
+    set cells of the (N, rows, columns) `mask` starts
+    """
+    rows, columns = mask.shape[1:]
+    reach = win_zone - 1
+    for d_row, d_column in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        height = rows - d_row * reach
+        width = columns - abs(d_column) * reach
+        offset = reach if d_column < 0 else 0
+        if height <= 0 or width <= 0:
+            continue
+        # AND together `win_zone` shifted views, each shifted one step
+        # further along the direction
+        chain = np.ones((mask.shape[0], height, width), dtype=bool)
+        for i in range(win_zone):
+            row, column = d_row * i, offset + d_column * i
+            chain &= mask[:, row:row + height, column:column + width]
+        yield chain
+
+
+def has_chains(boards, player, win_zone):
+    """
+    Returns a (N,) bool array, True for each board of the (N, rows, columns)
+    `boards` with a line of `win_zone` `player` discs in any direction
+    """
+    require_numpy()
+    boards = np.asarray(boards)
+    mask = boards == player
+    found = np.zeros(boards.shape[0], dtype=bool)
+    for chain in chain_windows(mask, win_zone):
+        found |= chain.any(axis=(1, 2))
+    return found
+
+
+def winners(boards, win_zone, players=(1, 2)):
+    """
+    Returns a (N,) int8 array of the winning player indicator for each board
+    of the (N, rows, columns) `boards`, or 0 where nobody has won. Where
+    more than one player has a line the first of `players` is returned
+    """
+    require_numpy()
+    boards = np.asarray(boards)
+    result = np.zeros(boards.shape[0], dtype=np.int8)
+    for player in reversed(players):
+        result[has_chains(boards, player, win_zone)] = player
+    return result
+
+
+def random_boards(count, rows, columns, seed=None):
+    """
+    Returns `count` random (rows, columns) boards with gravity respected
+    but no regard for turn order or earlier wins, for tests and benchmarks
+    """
+    require_numpy()
+    rng = np.random.RandomState(seed)
+    heights = rng.randint(0, rows + 1, size=(count, 1, columns))
+    # Row 0 is the top, so a cell is filled if it's within its column height
+    filled = np.arange(rows)[::-1].reshape(1, rows, 1) < heights
+    discs = rng.randint(1, 3, size=(count, rows, columns))
+    return np.where(filled, discs, 0).astype(np.int8)
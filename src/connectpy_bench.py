@@ -0,0 +1,515 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import threading
+import time
+import connectpy.connectpy_game as conn_py
+import connectpy.connectpy_ai as conn_ai
+import connectpy.connectpy_batch as conn_batch
+import connectpy.connectpy_server as conn_server
+import connectpy.connectpy_asgi as conn_asgi
+
+from collections import OrderedDict
+
+# (game_columns, game_rows, win_zone)
+BOARD_CONFIGS = [
+    (7, 6, 4),
+    (9, 6, 5),
+    (15, 12, 6),
+    (30, 30, 8),
+    (100, 100, 10),
+]
+
+
+def new_game(columns, rows, win_zone):
+    """Returns a started two player ConnectPyGame of the given size"""
+    game = conn_py.ConnectPyGame({
+        "game_columns": columns,
+        "game_rows": rows,
+        "win_zone": win_zone
+    })
+    game.add_player("a")
+    game.add_player("b")
+    game.start_game()
+    return game
+
+
+def fill_order(game):
+    """
+    Returns a column sequence that fills the board of `game`, playing each
+    row left to right
+    """
+    return [column for _ in range(game.rows)
+            for column in range(game.columns)]
+
+
+def half_filled_game(columns, rows, win_zone):
+    game = new_game(columns, rows, win_zone)
+    order = fill_order(game)
+    for column in order[:len(order) // 2]:
+        game.drop_disc(game.current_turn, column)
+    return game
+
+
+def bench_drop_disc(columns, rows, win_zone):
+    game = new_game(columns, rows, win_zone)
+    order = fill_order(game)
+    started = time.perf_counter()
+    for column in order:
+        game.drop_disc(game.current_turn, column)
+    return time.perf_counter() - started, len(order)
+
+
+def bench_is_winner(columns, rows, win_zone):
+    game = half_filled_game(columns, rows, win_zone)
+    grid = game.grid
+    cells = [(grid[row_idx][column_idx], (row_idx, column_idx))
+             for row_idx in range(rows) for column_idx in range(columns)
+             if grid[row_idx][column_idx]]
+    started = time.perf_counter()
+    for indicator, coords in cells:
+        game.is_winner(indicator, coords)
+    return time.perf_counter() - started, len(cells)
+
+
+def bench_axis_has_winner(columns, rows, win_zone):
+    game = half_filled_game(columns, rows, win_zone)
+    axes = game.grid
+    started = time.perf_counter()
+    for axis in axes:
+        game.axis_has_winner(1, axis)
+    return time.perf_counter() - started, len(axes)
+
+
+def bench_window(columns, rows, win_zone):
+    game = half_filled_game(columns, rows, win_zone)
+    axes = game.grid
+    started = time.perf_counter()
+    for axis in axes:
+        for _ in conn_py.window(axis, win_zone):
+            pass
+    return time.perf_counter() - started, len(axes)
+
+
+def bench_reset_game(columns, rows, win_zone):
+    game = new_game(columns, rows, win_zone)
+    ops = 100
+    started = time.perf_counter()
+    for _ in range(ops):
+        game.reset_game()
+    return time.perf_counter() - started, ops
+
+
+def bench_dict(columns, rows, win_zone):
+    game = half_filled_game(columns, rows, win_zone)
+    ops = 10
+    started = time.perf_counter()
+    for _ in range(ops):
+        game.dict
+    return time.perf_counter() - started, ops
+
+
+BENCHMARKS = OrderedDict([
+    ("drop_disc", bench_drop_disc),
+    ("is_winner", bench_is_winner),
+    ("axis_has_winner", bench_axis_has_winner),
+    ("window", bench_window),
+    ("reset_game", bench_reset_game),
+    ("dict", bench_dict),
+])
+
+
+# Board configs and fixed depths for the AI search benchmark
+AI_CONFIGS = [
+    ((7, 6, 4), 7),
+    ((9, 6, 5), 6),
+    ((15, 6, 5), 5),
+]
+
+
+def run_ai_benchmark(configs=AI_CONFIGS, opening=(), tt_size=1 << 18):
+    """
+    Returns {config: {depth, nodes, time, nps}} for fixed depth AIPlayer
+    searches from the position after the `opening` columns
+    """
+    results = OrderedDict()
+    for config, depth in configs:
+        game = new_game(*config)
+        for column in opening:
+            game.drop_disc(game.current_turn, column)
+        bot = conn_ai.AIPlayer({"ai_tt_size": tt_size})
+        position = bot.position(game, game.current_turn)
+        started = time.perf_counter()
+        bot.search(position, depth)
+        elapsed = time.perf_counter() - started
+        results[config_key(*config)] = {
+            "depth": depth,
+            "nodes": bot.nodes,
+            "time": elapsed,
+            "nps": bot.nodes / elapsed
+        }
+    return results
+
+
+def run_ai_scaling(config=(7, 6, 4), depth=9, workers=(1, 2, 4, 8),
+                   opening=(), tt_size=1 << 18):
+    """
+    Returns {workers: {depth, nodes, time, nps}} for a fixed depth search
+    from the position after the `opening` columns, serial AIPlayer for one
+    worker and ParallelAIPlayer otherwise. Each pool is warmed up with a
+    shallow search first so process start-up isn't timed
+    """
+    results = OrderedDict()
+    game = new_game(*config)
+    for column in opening:
+        game.drop_disc(game.current_turn, column)
+    for count in workers:
+        ai_config = {"ai_tt_size": tt_size, "ai_workers": count}
+        if count > 1:
+            bot = conn_ai.ParallelAIPlayer(ai_config)
+        else:
+            bot = conn_ai.AIPlayer(ai_config)
+        try:
+            bot.search(bot.position(game, game.current_turn), 1)
+            position = bot.position(game, game.current_turn)
+            started = time.perf_counter()
+            bot.search(position, depth)
+            elapsed = time.perf_counter() - started
+        finally:
+            if count > 1:
+                bot.close()
+        results[count] = {
+            "depth": depth,
+            "nodes": bot.nodes,
+            "time": elapsed,
+            "nps": bot.nodes / elapsed
+        }
+    return results
+
+
+def scalar_winners(game, grids, players=(1, 2)):
+    """
+    Returns the winner of each of `grids` found one `is_winner` call per
+    disc, the batch API's scalar equivalent
+    """
+    results = []
+    for grid in grids:
+        game.grid = grid
+        winner = 0
+        for player in players:
+            if any(game.is_winner(player, (row_idx, column_idx))
+                   for row_idx, row in enumerate(grid)
+                   for column_idx, indicator in enumerate(row)
+                   if indicator == player):
+                winner = player
+                break
+        results.append(winner)
+    return results
+
+
+def run_batch_benchmark(configs=BOARD_CONFIGS[:3], count=2000, seed=0):
+    """
+    Returns {config: {boards, scalar, batch, speedup}} of boards per second
+    scored by `scalar_winners` and `connectpy_batch.winners`
+    """
+    results = OrderedDict()
+    for columns, rows, win_zone in configs:
+        boards = conn_batch.random_boards(count, rows, columns, seed=seed)
+        grids = boards.tolist()
+        game = new_game(columns, rows, win_zone)
+
+        started = time.perf_counter()
+        scalar = scalar_winners(game, grids)
+        scalar_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        batch = conn_batch.winners(boards, win_zone)
+        batch_time = time.perf_counter() - started
+
+        if list(batch) != scalar:
+            raise AssertionError("Batch winners differ from is_winner")
+        results[config_key(columns, rows, win_zone)] = {
+            "boards": count,
+            "scalar": count / scalar_time,
+            "batch": count / batch_time,
+            "speedup": scalar_time / batch_time
+        }
+    return results
+
+
+SERVER_CONFIG = {"game_columns": 7, "game_rows": 6, "win_zone": 4}
+
+
+def rss_bytes():
+    """Returns this process' resident memory, or None off Linux"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def per_waiter(before, after, idle):
+    if before is None or after is None:
+        return None
+    return max(after - before, 0) / idle
+
+
+def run_server_benchmark(idle=1000, requests=500, config=SERVER_CONFIG):
+    """
+    Returns {server: {requests/s, idle, threads, bytes/waiter, wake}} for
+    the Flask app and the ASGI app, both driven in-process without sockets.
+    Each serves `requests` /status calls one after another, then holds
+    `idle` long-polls on one game, measuring the threads and resident
+    memory they take and the seconds to answer all of them once a player
+    joins. Socket buffers are left out, they cost the same in either server
+    """
+    results = OrderedDict()
+
+    app = conn_server.create_app()
+    app.config.update(config)
+    conn_server.new_lobby(app)
+    client = app.test_client()
+    game_id = client.post('/join', json={'player_id': 'a'}).json['game_id']
+    game = app.lobby.get_game(game_id)
+    data = {'player_id': 'a', 'game_id': game_id}
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        client.post('/status', json=data)
+    rate = requests / (time.perf_counter() - started)
+
+    poll = dict(data, version=game.version, wait=60)
+    threads = threading.active_count()
+    before = rss_bytes()
+    pollers = [threading.Thread(
+        target=lambda: app.test_client().post('/status', json=poll))
+        for _ in range(idle)]
+    for poller in pollers:
+        poller.start()
+    # Give every poller time to block in its long-poll
+    time.sleep(1)
+    after = rss_bytes()
+    waiting = threading.active_count() - threads
+    started = time.perf_counter()
+    client.post('/join', json={'player_id': 'b'})
+    for poller in pollers:
+        poller.join()
+    results["flask"] = {
+        "requests/s": rate,
+        "idle": idle,
+        "threads": waiting,
+        "bytes/waiter": per_waiter(before, after, idle),
+        "wake": time.perf_counter() - started
+    }
+
+    app = conn_asgi.ConnectPyASGI(config)
+
+    async def run():
+        state = (await conn_asgi.call(
+            app, 'POST', '/join', {'player_id': 'a'})).json
+        data = {'player_id': 'a', 'game_id': state['game_id']}
+        started = time.perf_counter()
+        for _ in range(requests):
+            await conn_asgi.call(app, 'POST', '/status', data)
+        rate = requests / (time.perf_counter() - started)
+
+        poll = dict(data, version=state['version'], wait=60)
+        threads = threading.active_count()
+        before = rss_bytes()
+        pollers = [asyncio.ensure_future(conn_asgi.call(
+            app, 'POST', '/status', poll)) for _ in range(idle)]
+        while app.watches.get(state['game_id']) is None or \
+                app.watches[state['game_id']].waiters < idle:
+            await asyncio.sleep(0.01)
+        after = rss_bytes()
+        waiting = threading.active_count() - threads
+        started = time.perf_counter()
+        await conn_asgi.call(app, 'POST', '/join', {'player_id': 'b'})
+        await asyncio.gather(*pollers)
+        return {
+            "requests/s": rate,
+            "idle": idle,
+            "threads": waiting,
+            "bytes/waiter": per_waiter(before, after, idle),
+            "wake": time.perf_counter() - started
+        }
+
+    results["asgi"] = asyncio.run(run())
+    app.executor.shutdown()
+    return results
+
+
+def config_key(columns, rows, win_zone):
+    return "{}x{}/{}".format(columns, rows, win_zone)
+
+
+def run_benchmarks(configs=BOARD_CONFIGS, names=None, repeat=5):
+    """
+    Returns {benchmark: {config: seconds per op}}, taking the best of
+    `repeat` runs of each benchmark on each board config
+    """
+    results = OrderedDict()
+    for name in names or BENCHMARKS:
+        bench = BENCHMARKS[name]
+        results[name] = OrderedDict()
+        for config in configs:
+            best = None
+            for _ in range(repeat):
+                elapsed, ops = bench(*config)
+                per_op = elapsed / max(ops, 1)
+                best = per_op if best is None else min(best, per_op)
+            results[name][config_key(*config)] = best
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """
+    Returns a list of (benchmark, config, baseline, current) regressions
+    where `results` is slower than `baseline` by more than `tolerance`
+    """
+    regressions = []
+    for name, timings in results.items():
+        for config, per_op in timings.items():
+            base = baseline.get(name, {}).get(config)
+            if base and per_op > base * (1 + tolerance):
+                regressions.append((name, config, base, per_op))
+    return regressions
+
+
+def print_results(results):
+    configs = list(next(iter(results.values())).keys()) if results else []
+    print("{:<16}".format("us/op") + ''.join(
+        "{:>14}".format(config) for config in configs))
+    for name, timings in results.items():
+        print("{:<16}".format(name) + ''.join(
+            "{:>14.3f}".format(timings[config] * 1e6) for config in configs))
+
+
+def print_ai_results(results):
+    print("{:<12} {:>6} {:>10} {:>9} {:>12}".format(
+        "config", "depth", "nodes", "time s", "positions/s"))
+    for config, stats in results.items():
+        print("{:<12} {:>6} {:>10} {:>9.3f} {:>12.0f}".format(
+            config, stats["depth"], stats["nodes"], stats["time"],
+            stats["nps"]))
+
+
+def print_scaling_results(results):
+    print("{:<8} {:>6} {:>10} {:>9} {:>12} {:>8}".format(
+        "workers", "depth", "nodes", "time s", "positions/s", "speedup"))
+    serial = next(iter(results.values()))["time"] if results else 0
+    for workers, stats in results.items():
+        print("{:<8} {:>6} {:>10} {:>9.3f} {:>12.0f} {:>8.2f}".format(
+            workers, stats["depth"], stats["nodes"], stats["time"],
+            stats["nps"], serial / stats["time"]))
+
+
+def print_batch_results(results):
+    print("{:<12} {:>8} {:>12} {:>12} {:>8}".format(
+        "config", "boards", "scalar/s", "batch/s", "speedup"))
+    for config, stats in results.items():
+        print("{:<12} {:>8} {:>12.0f} {:>12.0f} {:>8.1f}".format(
+            config, stats["boards"], stats["scalar"], stats["batch"],
+            stats["speedup"]))
+
+
+def print_server_results(results):
+    print("{:<8} {:>11} {:>6} {:>8} {:>13} {:>9}".format(
+        "server", "requests/s", "idle", "threads", "bytes/waiter", "wake s"))
+    for server, stats in results.items():
+        memory = stats["bytes/waiter"]
+        print("{:<8} {:>11.0f} {:>6} {:>8} {:>13} {:>9.3f}".format(
+            server, stats["requests/s"], stats["idle"], stats["threads"],
+            "n/a" if memory is None else "{:.0f}".format(memory),
+            stats["wake"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ConnectPy game engine micro-benchmarks')
+    parser.add_argument(
+        '-b', dest='benchmarks', nargs='+', choices=list(BENCHMARKS),
+        help='Benchmarks to run, all by default')
+    parser.add_argument(
+        '-r', dest='repeat', type=int, default=5,
+        help='Runs per benchmark, the best run is kept')
+    parser.add_argument(
+        '-o', dest='output', action='store',
+        help='Write results as JSON to this file')
+    parser.add_argument(
+        '--baseline', action='store',
+        help='JSON results to compare against, exits 1 on regressions')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.2,
+        help='Allowed slowdown against the baseline, as a fraction')
+    parser.add_argument(
+        '--ai', action='store_true',
+        help='Benchmark AI search positions per second instead')
+    parser.add_argument(
+        '--ai-scaling', dest='workers', type=int, nargs='+',
+        help='Benchmark parallel AI search at these worker counts instead')
+    parser.add_argument(
+        '--batch', action='store_true',
+        help='Benchmark batch win checking boards per second instead')
+    parser.add_argument(
+        '--server', dest='idle', type=int, nargs='?', const=1000,
+        help='Benchmark the Flask app against the ASGI app with this many '
+             'idle long-polls instead')
+    args = parser.parse_args()
+
+    if args.idle:
+        results = run_server_benchmark(idle=args.idle)
+        print_server_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    if args.batch:
+        results = run_batch_benchmark()
+        print_batch_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    if args.workers:
+        results = run_ai_scaling(workers=args.workers)
+        print_scaling_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    if args.ai:
+        results = run_ai_benchmark()
+        print_ai_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return
+
+    results = run_benchmarks(names=args.benchmarks, repeat=args.repeat)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(results, baseline, args.tolerance)
+        for name, config, base, current in regressions:
+            print("REGRESSION {} {}: {:.3f}us/op -> {:.3f}us/op".format(
+                name, config, base * 1e6, current * 1e6))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
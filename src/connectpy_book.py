@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import mmap
+import struct
+import time
+import connectpy.connectpy_ai as conn_ai
+
+from hashlib import blake2b
+
+# magic, format version, columns, rows, win_zone, plies, record count
+HEADER = struct.Struct('<4sBBBBBI')
+# canonical position key, best move in the canonical orientation
+RECORD = struct.Struct('<QB')
+MAGIC = b'CPYB'
+FORMAT_VERSION = 1
+
+
+class OpeningBookException(Exception):
+    pass
+
+
+def mirror(board, columns, rows):
+    """Returns `board` reflected left to right"""
+    stride = rows + 1
+    column_mask = (1 << stride) - 1
+    mirrored = 0
+    for column in range(columns):
+        mirrored |= (board >> column * stride & column_mask) << \
+            (columns - 1 - column) * stride
+    return mirrored
+
+
+def position_hash(current, opponent, columns, rows):
+    size = (columns * (rows + 1) + 7) // 8
+    digest = blake2b(current.to_bytes(size, 'little') +
+                     opponent.to_bytes(size, 'little'), digest_size=8)
+    return int.from_bytes(digest.digest(), 'little')
+
+
+def canonical_key(current, opponent, columns, rows):
+    """
+    Returns (key, mirrored), keying a position and its mirror image the
+    same. `mirrored` is True if the key is that of the mirror image, in
+    which case book moves are mirrored too
+    """
+    key = position_hash(current, opponent, columns, rows)
+    mirror_key = position_hash(mirror(current, columns, rows),
+                               mirror(opponent, columns, rows),
+                               columns, rows)
+    if mirror_key < key:
+        return mirror_key, True
+    return key, False
+
+
+class OpeningBook(object):
+    """
+    Read-only opening book, memory-mapped and binary searched, so lookups
+    cost O(log n) page reads however large the book
+    """
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < HEADER.size:
+            raise OpeningBookException(
+                "{} is not an opening book".format(path))
+        (magic, version, self.columns, self.rows, self.win_zone, self.plies,
+         self.count) = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != FORMAT_VERSION or \
+                len(self.map) != HEADER.size + self.count * RECORD.size:
+            raise OpeningBookException(
+                "{} is not an opening book".format(path))
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def board(self):
+        return self.columns, self.rows, self.win_zone
+
+    def close(self):
+        self.map.close()
+
+    def record(self, idx):
+        return RECORD.unpack_from(self.map, HEADER.size + idx * RECORD.size)
+
+    def lookup(self, current, opponent):
+        """
+        Returns the book move for the player to move with `current` against
+        `opponent`, or None if the position isn't in the book
+        """
+        key, mirrored = canonical_key(current, opponent, self.columns,
+                                      self.rows)
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.record(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        found, move = self.record(lo)
+        if found != key:
+            return None
+        return self.columns - 1 - move if mirrored else move
+
+
+def write_book(path, columns, rows, win_zone, plies, moves):
+    """Writes the {key: canonical move} `moves` as a book sorted by key"""
+    with open(path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, columns, rows, win_zone,
+                            plies, len(moves)))
+        for key in sorted(moves):
+            f.write(RECORD.pack(key, moves[key]))
+
+
+def opening_positions(columns, rows, win_zone, plies):
+    """
+    Yields each distinct (up to mirroring) undecided Position reached in
+    fewer than `plies` moves, with its canonical key and orientation
+    """
+    bot = conn_ai.AIPlayer({})
+    zobrist = bot.zobrist_keys(columns, rows)
+    level = [conn_ai.Position(columns, rows, win_zone, 0, 0,
+                              [0] * columns, zobrist)]
+    seen = set()
+    for _ in range(plies):
+        next_level = []
+        for position in level:
+            key, mirrored = canonical_key(
+                position.current, position.opponent, columns, rows)
+            if key in seen:
+                continue
+            seen.add(key)
+            yield position, key, mirrored
+            for column in range(columns):
+                if position.can_play(column) and \
+                        not position.is_winning_move(column):
+                    child = conn_ai.Position(
+                        columns, rows, win_zone, position.current,
+                        position.opponent, position.heights, zobrist)
+                    child.play(column)
+                    next_level.append(child)
+        level = next_level
+
+
+def generate_book(columns, rows, win_zone, plies, depth, tt_size=1 << 20,
+                  progress=None):
+    """
+    Returns {key: canonical move} from a `depth` ply search of every
+    opening position up to `plies` moves in
+    """
+    bot = conn_ai.AIPlayer({"ai_tt_size": tt_size})
+    moves = {}
+    for position, key, mirrored in opening_positions(
+            columns, rows, win_zone, plies):
+        if not any(position.can_play(c) for c in range(columns)):
+            continue
+        move, score = bot.search(position, min(
+            depth, columns * rows - position.moves))
+        moves[key] = columns - 1 - move if mirrored else move
+        if progress:
+            progress(len(moves))
+    return moves
+
+
+def load_books(paths):
+    """Returns {(columns, rows, win_zone): OpeningBook} for `paths`"""
+    books = {}
+    for path in paths or ():
+        book = OpeningBook(path)
+        books[book.board] = book
+    return books
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ConnectPy opening book generator')
+    parser.add_argument('-c', dest='columns', type=int, default=9)
+    parser.add_argument('-r', dest='rows', type=int, default=6)
+    parser.add_argument('-w', dest='win_zone', type=int, default=5)
+    parser.add_argument(
+        '-p', dest='plies', type=int, default=6,
+        help='Book positions up to this many moves in')
+    parser.add_argument(
+        '-d', dest='depth', type=int, default=10,
+        help='Search depth for each book position')
+    parser.add_argument('-o', dest='output', required=True)
+    args = parser.parse_args()
+
+    started = time.monotonic()
+
+    def progress(count):
+        if not count % 100:
+            print("{} positions, {:.0f}s".format(
+                count, time.monotonic() - started))
+
+    moves = generate_book(args.columns, args.rows, args.win_zone,
+                          args.plies, args.depth, progress=progress)
+    write_book(args.output, args.columns, args.rows, args.win_zone,
+               args.plies, moves)
+    print("Wrote {} positions to {}".format(len(moves), args.output))
+
+if __name__ == '__main__':
+    main()
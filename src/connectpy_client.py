@@ -2,20 +2,58 @@
 
 import requests
 import argparse
+import random
+import json
 import time
+import shutil
 import sys
 import signal
 import yaml
+import connectpy.connectpy_wire as conn_wire
 
+from functools import lru_cache
+from queue import Queue, Empty
+from threading import Thread
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
 from termios import tcflush, TCIFLUSH
 
+CELLS = {0: '[   ]', 1: '[ x ]', 2: '[ o ]'}
+# Redraw the whole board when more than this share of its cells changed
+FULL_REDRAW_SHARE = 0.5
+# Endpoints that change nothing on the server, safe to resend
+READ_ENDPOINTS = frozenset(['/status', '/events', '/hints'])
+
 
 class PlayerClient(object):
-    def __init__(self, player_id, server_url):
+    def __init__(self, player_id, server_url, session=None,
+                 pool_connections=1, pool_maxsize=4, connect_timeout=5,
+                 read_timeout=30, max_retries=3, backoff_factor=0.2,
+                 backoff_max=5, binary=True):
         self.game_state = {}
-        self.last_game_state = {}
         self.id = player_id
         self.server_url = server_url
+        self.events = None
+        self.etag = None
+        self.renderer = BoardRenderer()
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        # Full states come in the compact binary format if the server has
+        # it, JSON otherwise
+        self.accept = '{}, {};q=0.5'.format(
+            conn_wire.MIMETYPE, conn_wire.JSON_MIMETYPE) if binary \
+            else conn_wire.JSON_MIMETYPE
+        if session is None:
+            # Keep-alive connections are pooled per host by the adapter
+            session = requests.Session()
+            adapter = HTTPAdapter(
+                pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
 
     @property
     def opposing_player(self):
@@ -25,48 +63,178 @@ class PlayerClient(object):
         else:
             return None
 
+    @property
+    def game_id(self):
+        return self.game_state.get('game_id')
+
     @property
     def can_move(self):
         return self.game_state['turn'] == self.id
 
-    def make_request(self, endpoint, data):
-        resp = requests.post(
-            self.server_url + endpoint, json=data)
+    def make_request(self, endpoint, data, headers=None):
+        if self.game_state:
+            # Ask for only the changes since the state we already hold
+            data = dict(data, since=self.game_state['version'])
+        headers = dict(headers or {}, Accept=self.accept)
+        resp = self.post(
+            endpoint, json=data, headers=headers, wait=data.get('wait', 0))
+        if resp.status_code == 304:
+            # Not modified - the state we hold is current
+            return resp
         if resp:
-            self.last_game_state = self.game_state
-            self.game_state = resp.json()
+            self.etag = resp.headers.get('ETag')
+            state = decode_state(resp)
+            if 'events' in state:
+                self.apply_events(state['events'])
+            else:
+                self.game_state = state
 
         return resp
 
+    def post(self, endpoint, wait=0, **kwargs):
+        """
+        POSTs to `endpoint` on the pooled session, retrying failed requests
+        with jittered exponential backoff. Read-only endpoints are retried on
+        connection errors, timeouts and 5xx responses. Others (/join, /move,
+        /close) only when no connection was made, as the server may have
+        acted on a request that timed out or failed mid-way, e.g. on a stale
+        keep-alive connection. `wait` extends the read timeout for requests
+        the server may hold (long-polls)
+        """
+        timeout = (self.connect_timeout, self.read_timeout + wait)
+        safe = endpoint in READ_ENDPOINTS
+        for attempt in range(self.max_retries + 1):
+            try:
+                resp = self.session.post(
+                    self.server_url + endpoint, timeout=timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt == self.max_retries or \
+                        not (safe or not_sent(e)):
+                    raise
+            else:
+                if not safe or resp.status_code < 500 or \
+                        attempt == self.max_retries:
+                    return resp
+            time.sleep(self.backoff(attempt))
+
+    def backoff(self, attempt):
+        """Returns a full-jitter backoff delay for retry number `attempt`"""
+        return random.uniform(0, min(
+            self.backoff_max, self.backoff_factor * 2 ** attempt))
+
     def join_server(self):
         return self.make_request('/join', {'player_id': self.id})
 
-    def update_status(self):
-        return self.make_request('/status', {'player_id': self.id})
+    def update_status(self, wait=0):
+        """
+        Fetches the game state. With a `wait`, the server holds the request
+        for up to `wait` seconds until the state moves past our last version
+        """
+        data = {'player_id': self.id, 'game_id': self.game_id}
+        if wait:
+            data.update(version=self.game_state.get('version'), wait=wait)
+        headers = {'If-None-Match': self.etag} if self.etag else None
+        return self.make_request('/status', data, headers=headers)
+
+    def poll_status(self, wait, interval):
+        """
+        Long-polls the game state, sleeping out the rest of `interval` if the
+        server answers early without a change (e.g. it doesn't long-poll)
+        """
+        version = self.game_state.get('version')
+        started = time.monotonic()
+        resp = self.update_status(wait=wait)
+        elapsed = time.monotonic() - started
+        if self.game_state.get('version') == version and elapsed < interval:
+            time.sleep(interval - elapsed)
+        return resp
 
     def make_move(self, column):
         return self.make_request(
-            '/move', {'player_id': self.id, 'column': column})
+            '/move', {'player_id': self.id, 'game_id': self.game_id,
+                      'column': column})
 
     def close_game(self):
         return self.make_request(
-            '/close', {'player_id': self.id})
-
-    def wait_for_opponent(self):
+            '/close', {'player_id': self.id, 'game_id': self.game_id})
+
+    def open_stream(self):
+        """
+        Subscribes to the server's /events push channel, applying events from
+        a background reader. Returns False if the channel is unavailable, in
+        which case updates fall back to polling /status
+        """
+        try:
+            resp = self.session.post(
+                self.server_url + '/events',
+                json={'player_id': self.id, 'game_id': self.game_id},
+                timeout=(self.connect_timeout, None), stream=True)
+        except requests.RequestException:
+            return False
+
+        mimetype = resp.headers.get('Content-Type', '').split(';')[0]
+        if resp.status_code != 200 or mimetype != 'text/event-stream':
+            resp.close()
+            return False
+
+        self.events = Queue()
+        Thread(target=self.read_stream, args=(resp, self.events),
+               daemon=True).start()
+        return True
+
+    def read_stream(self, resp, events):
+        try:
+            for event in parse_events(resp.iter_lines(decode_unicode=True)):
+                events.put(event)
+        except requests.RequestException:
+            pass
+        finally:
+            # Tell the reader the stream has ended
+            events.put(None)
+
+    def next_update(self, wait, interval):
+        """
+        Waits up to `wait` seconds for the next game update, from the event
+        stream if one is open or by long-polling /status otherwise
+        """
+        if self.events is None:
+            return self.poll_status(wait, interval)
+
+        try:
+            event = self.events.get(timeout=wait)
+        except Empty:
+            return
+        if event is None:
+            self.events = None
+            return self.update_status()
+        self.apply_event(event)
+
+    def apply_event(self, event):
+        return self.apply_events([event])
+
+    def apply_events(self, events):
+        """
+        Applies pushed or delta game `events` to a copy of `self.game_state`,
+        ignoring events older than the state we already hold
+        """
+        state = self.game_state
+        for event in events:
+            if event['version'] <= state.get('version', 0):
+                continue
+            if event['type'] == 'state':
+                state = event['state']
+            else:
+                state = apply_game_event(state, event)
+
+        if state is not self.game_state:
+            self.game_state = state
+
+    def wait_for_opponent(self, wait=10, interval=1):
         while not self.opposing_player:
-            self.update_status()
-            time.sleep(1)
+            self.next_update(wait, interval)
 
     def printable_state(self):
-        s = [['[   ]' if e == 0
-             else '[ {} ]'.format(play_piece(e)) for e in row]
-             for row in self.game_state['game']]
-        s.append(['[ {} ]'.format(n + 1) for n in range(
-            self.game_state['columns'])])
-        lens = [max(map(len, col)) for col in zip(*s)]
-        fmt = ' '.join('{{:{}}}'.format(x) for x in lens)
-        table = [fmt.format(*row) for row in s]
-        return '\n'.join(table)
+        return printable_grid(self.game_state)
 
     def get_move(self):
         column = None
@@ -89,19 +257,187 @@ class PlayerClient(object):
         return column - 1
 
 
-def play_piece(player_indicator):
-        return 'x' if player_indicator == 1 else 'o'
-
-
-def get_player_client(server_url):
+@lru_cache(maxsize=None)
+def board_layout(columns):
+    """
+    Returns (row format, footer, x offset of each column) for drawing a
+    board of `columns`, each column as wide as its `[ n ]` label
+    """
+    labels = ['[ {} ]'.format(n + 1) for n in range(columns)]
+    widths = [max(len(CELLS[0]), len(label)) for label in labels]
+    fmt = ' '.join('{{:{}}}'.format(width) for width in widths)
+    offsets = [sum(widths[:idx]) + idx for idx in range(columns)]
+    return fmt, fmt.format(*labels), offsets
+
+
+def printable_grid(game_state):
+    """Returns the board of `game_state` as text, column numbers below"""
+    fmt, footer, _ = board_layout(game_state['columns'])
+    table = [fmt.format(*[CELLS.get(cell, CELLS[2]) for cell in row])
+             for row in game_state['game']]
+    table.append(footer)
+    return '\n'.join(table)
+
+
+def changed_cells(last_state, game_state):
+    """
+    Returns the (row_idx, column_idx) of the cells that differ between the
+    grids of `last_state` and `game_state`. A single drop since the last
+    state is found from `last_drop` alone, otherwise only the rows that
+    differ are compared cell by cell
+    """
+    last_drop = game_state['last_drop']
+    if game_state['version'] == last_state['version'] + 1 and \
+            last_drop and last_drop != last_state['last_drop']:
+        return [tuple(last_drop)]
+    cells = []
+    for row_idx, (row, last_row) in enumerate(
+            zip(game_state['game'], last_state['game'])):
+        if row != last_row:
+            cells.extend((row_idx, column_idx) for column_idx, (cell, last)
+                         in enumerate(zip(row, last_row)) if cell != last)
+    return cells
+
+
+class BoardRenderer(object):
+    """
+    Draws game states to `stream`. On a terminal the board is drawn once,
+    then only the cells changed since the last frame are redrawn, in place
+    with ANSI cursor addressing, and the cursor is left on the line below
+    the board. Otherwise, or if the board is taller than the terminal so
+    its top has scrolled away, each new state is printed in full
+    """
+
+    def __init__(self, stream=None, tty=None):
+        self.stream = stream
+        self.tty = tty
+        self.state = None
+
+    def render(self, game_state):
+        """
+        Draws `game_state` if it isn't the state last drawn. Returns True
+        if anything was drawn
+        """
+        last_state = self.state
+        if last_state is not None and \
+                game_state['version'] == last_state['version'] and \
+                game_state['game_id'] == last_state['game_id']:
+            return False
+        self.state = game_state
+
+        stream = sys.stdout if self.stream is None else self.stream
+        if self.tty is None:
+            self.tty = stream.isatty()
+        if not self.tty:
+            stream.write(printable_grid(game_state) + '\n')
+        elif not game_state['game']:
+            return False
+        else:
+            stream.write(self.frame(last_state, game_state))
+        stream.flush()
+        return True
+
+    def frame(self, last_state, game_state):
+        """Returns the ANSI output taking `last_state` to `game_state`"""
+        rows, columns = game_state['rows'], game_state['columns']
+        cells = None
+        if last_state is not None and last_state['game'] and \
+                last_state['game_id'] == game_state['game_id'] and \
+                (last_state['rows'], last_state['columns']) == (rows, columns):
+            cells = changed_cells(last_state, game_state)
+            if len(cells) > rows * columns * FULL_REDRAW_SHARE or \
+                    rows + 2 > shutil.get_terminal_size().lines:
+                cells = None
+
+        if cells is None:
+            # Clear the screen and draw from the top
+            out = ['\x1b[H\x1b[2J', printable_grid(game_state)]
+        else:
+            offsets = board_layout(columns)[2]
+            grid = game_state['game']
+            out = ['\x1b[{};{}H{}'.format(
+                row_idx + 1, offsets[column_idx] + 1,
+                CELLS.get(grid[row_idx][column_idx], CELLS[2]))
+                for row_idx, column_idx in cells]
+        # Park the cursor below the board and clear what was printed there
+        out.append('\x1b[{};1H\x1b[J'.format(rows + 2))
+        return ''.join(out)
+
+
+def not_sent(error):
+    """
+    Returns True if the requests exception `error` was raised before the
+    request reached the server
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = error.args[0] if error.args else None
+    # urllib3 wraps the connection error in a MaxRetryError
+    reason = getattr(reason, 'reason', reason)
+    return isinstance(reason, NewConnectionError)
+
+
+def parse_events(lines):
+    """
+    Yields the decoded JSON `data` of each Server-Sent Event from an iterable
+    of text `lines`
+    """
+    data = []
+    for line in lines:
+        if not line:
+            if data:
+                yield json.loads('\n'.join(data))
+                data = []
+        elif line.startswith('data:'):
+            data.append(line[5:].lstrip())
+
+
+def decode_state(resp):
+    """Returns the state dict in `resp`, binary or JSON"""
+    mimetype = resp.headers.get('Content-Type', '').split(';')[0]
+    if mimetype == conn_wire.MIMETYPE:
+        return conn_wire.decode(resp.content)
+    return resp.json()
+
+
+def apply_game_event(game_state, event):
+    """Returns a copy of the `game_state` dict with `event` applied"""
+    state = dict(game_state, version=event['version'])
+    event_type = event['type']
+
+    if event_type == 'join':
+        state['players'] = dict(state['players'])
+        state['players'][event['player']] = event['indicator']
+    elif event_type == 'start':
+        state['started'] = True
+        state['turn'] = event['turn']
+    elif event_type == 'reset':
+        state['game'] = [[0] * state['columns'] for _ in range(state['rows'])]
+        state['last_drop'] = None
+        state['winner'] = None
+    elif event_type == 'drop':
+        row_idx, column_idx = event['coords']
+        state['game'] = [list(row) for row in state['game']]
+        state['game'][row_idx][column_idx] = \
+            state['players'][event['player']]
+        state['last_drop'] = event['coords']
+        state['turn'] = event['turn']
+        state['winner'] = event['winner']
+    elif event_type == 'close':
+        state['closed'] = event['player']
+
+    return state
+
+
+def get_player_client(server_url, **client_options):
     player_id = input("Please enter your name: ")
-    player_client = PlayerClient(player_id, server_url)
+    player_client = PlayerClient(player_id, server_url, **client_options)
 
     return player_client
 
 
-def try_join_game(server_url):
-    player_client = get_player_client(server_url)
+def try_join_game(server_url, streaming=False, **client_options):
+    player_client = get_player_client(server_url, **client_options)
     print("Hi {}! - Connecting to game...".format(player_client.id))
     resp = player_client.join_server()
 
@@ -115,11 +451,13 @@ def try_join_game(server_url):
 
     if resp:
         print("Player {} joined successfully!".format(player_client.id))
+        if streaming and not player_client.open_stream():
+            print("Event stream unavailable, polling for updates")
         print("Waiting for opponent...")
         player_client.wait_for_opponent()
+        player_client.renderer.render(player_client.game_state)
         print("Your opponent is {}, good luck!".format(
             player_client.opposing_player))
-        print(player_client.printable_state())
         return player_client
     else:
         print(resp.json()['error'])
@@ -127,17 +465,21 @@ def try_join_game(server_url):
 
 
 def print_state_change(player_client):
-    if player_client.game_state != player_client.last_game_state:
-        print(player_client.printable_state())
-    else:
+    if not player_client.renderer.render(player_client.game_state):
         print('Waiting for opponent...\r', end="")
 
 
-def run_client(
-        server_url='http://localhost:80', interval=0.5, wait_timeout=30):
+def run_client(server_url='http://localhost:80', interval=0.5,
+               wait_timeout=30, poll_timeout=10, streaming=True,
+               **client_options):
+    """
+    Runs an interactive game. Any `client_options` (pool sizes, timeouts and
+    retry settings) are passed to PlayerClient
+    """
     player_client = None
     while not player_client:
-        player_client = try_join_game(server_url)
+        player_client = try_join_game(
+            server_url, streaming, **client_options)
 
     time_waiting = 0
 
@@ -149,11 +491,18 @@ def run_client(
             if not resp:
                 print(resp.json()['error'])
         else:
-            time_waiting += interval
             if time_waiting >= wait_timeout:
                 player_client.close_game()
                 print("Closing game due to inactiviy...")
-            player_client.update_status()
+            else:
+                started = time.monotonic()
+                player_client.next_update(
+                    min(poll_timeout, wait_timeout - time_waiting), interval)
+                time_waiting += time.monotonic() - started
+
+        # Draw first, on a terminal the board is redrawn in place and
+        # clears the lines below it
+        print_state_change(player_client)
 
         winner = player_client.game_state['winner']
         if winner:
@@ -164,9 +513,6 @@ def run_client(
             print("Game closed by {}, goodbye!".format(player_closed))
             break
 
-        print_state_change(player_client)
-        time.sleep(interval)
-
 
 def get_config(config_path):
     config = {}
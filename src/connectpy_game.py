@@ -1,6 +1,12 @@
 # -*- coding: utf-8 -*-
 
+import json
+import connectpy.connectpy_metrics as conn_metrics
+
+from functools import lru_cache
 from itertools import islice, cycle
+from threading import Condition, RLock
+from time import perf_counter
 
 
 class ColumnOutOfBoundsException(Exception):
@@ -27,6 +33,43 @@ class AlreadyJoinedException(Exception):
     pass
 
 
+@lru_cache(maxsize=None)
+def winning_lines(columns, rows, win_zone):
+    """
+    Returns (lines, cell_lines) for a board of `columns` x `rows`: every run
+    of `win_zone` cells a player could win on, as tuples of bitboard bit
+    indexes, and for each bit the indexes of the lines through it. Shared
+    by every game of the same size
+    """
+    stride = rows + 1
+    lines = []
+    # (column step, height step) of the vertical, horizontal and both
+    # diagonal axes
+    for step_column, step_height in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        for column_idx in range(columns):
+            for height in range(rows):
+                end_column = column_idx + step_column * (win_zone - 1)
+                end_height = height + step_height * (win_zone - 1)
+                if end_column < columns and 0 <= end_height < rows:
+                    lines.append(tuple(
+                        (column_idx + step_column * n) * stride +
+                        height + step_height * n for n in range(win_zone)))
+    cell_lines = [[] for _ in range(columns * stride)]
+    for line_idx, line in enumerate(lines):
+        for bit in line:
+            cell_lines[bit].append(line_idx)
+    return tuple(lines), tuple(tuple(cell) for cell in cell_lines)
+
+
+def axis_shifts(stride):
+    """
+    Returns (axis, bit shift) for each axis a line can run along on
+    bitboards of column `stride`, in the order `is_winner` checks them
+    """
+    return (('vertical', 1), ('horizontal', stride),
+            ('diagonal', stride - 1), ('diagonal', stride + 1))
+
+
 def window(seq, n):
     """
     Returns a sliding window (of width `n`) over data from the iterable `seq`
@@ -59,57 +102,125 @@ def surrounding_diag(mat, x, y, n, flip=False):
     direction = 1 if flip else -1
     for i in range(-n, n):
         xi, yi = x - i, y + (i * direction)
-        try:
-            if xi * yi >= 0:
-                diag.append(mat[xi][yi])
-        except IndexError:
-            continue
+        if 0 <= xi < len(mat) and 0 <= yi < len(mat[xi]):
+            diag.append(mat[xi][yi])
     return diag
 
 
 class ConnectPyGame(object):
     """Object for storing and updating ConnectPy game state."""
 
-    def __init__(self, config):
+    def __init__(self, config, game_id=None):
         """
         Expect a `config` of the form:
             game_columns: 9
             game_rows: 6
             win_zone: 5
+            game_log_size: 100
         """
         self.config = config
+        self.id = game_id
         self.columns = config.get('game_columns', 9)
         self.rows = config.get('game_rows', 6)
         self.win_zone = config.get('win_zone', 5)
         self.started = False
         self.max_players = 2
         self.players = {}
+        self.bots = {}
         self.player_cycle = None
         self.current_turn = None
         self.winner = None
         self.last_drop = None
         self.closed = False
-        self.grid = []
+        # Columns played since the last reset, in order
+        self.moves = []
+        # Held by callers for a whole read-modify-write, such as checking
+        # `is_turn` then calling `drop_disc`. Readers don't need it: each
+        # change is made and published under `self.changed`, so readers
+        # holding that never see half a change
+        self.lock = RLock()
+        # Bumped by every state change, `self.changed` is notified and each
+        # callable in `self.subscribers` is passed an event describing it.
+        # The last `self.log_size` events are kept in `self.log`, so event
+        # N is `self.log[N - 1 - self.log_start]`, `self.log_start` being
+        # the version the log starts from
+        self.version = 0
+        self.changed = Condition()
+        self.subscribers = []
+        self.log = []
+        self.log_start = 0
+        self.log_size = config.get('game_log_size', 100)
+        # Serialized forms of `self.dict`, cleared by every state change
+        self.cache = {}
+        # Each column takes `rows` + 1 bits, the spare top bit is always clear
+        # so that chains can't wrap from one column into the next
+        self.stride = self.rows + 1
+        self.boards = {}
+        self.heights = []
+        # Every possible winning line, and for each player the number of
+        # their discs on each line, kept up to date by `drop_disc`
+        self.lines, self.cell_lines = winning_lines(
+            self.columns, self.rows, self.win_zone)
+        self.line_counts = {}
 
     @property
     def players_ready(self):
         """Returns a bool indicating if enough players have joined"""
         return len(self.players) == self.max_players
 
+    @property
+    def grid(self):
+        """
+        Returns a nested list view of the bitboards, indexed as
+        `grid[row_idx][column_idx]` with row 0 at the top
+        """
+        grid = []
+        if not self.heights:
+            return grid
+        for row_idx in range(self.rows):
+            row = []
+            for column_idx in range(self.columns):
+                mask = self.cell_mask(row_idx, column_idx)
+                for indicator, board in self.boards.items():
+                    if board & mask:
+                        row.append(indicator)
+                        break
+                else:
+                    row.append(0)
+            grid.append(row)
+        return grid
+
+    @grid.setter
+    def grid(self, grid):
+        """Loads the bitboards and column heights from a nested list `grid`"""
+        self.boards = {}
+        self.heights = [0 for column in range(self.columns)] if grid else []
+        for row_idx, row in enumerate(grid):
+            for column_idx, indicator in enumerate(row):
+                if indicator:
+                    self.boards[indicator] = self.boards.get(
+                        indicator, 0) | self.cell_mask(row_idx, column_idx)
+                    self.heights[column_idx] = max(
+                        self.heights[column_idx], self.rows - row_idx)
+        self.count_lines()
+
     @property
     def dict(self):
         """Returns a dict representation of the ConnectPyGame object"""
-        return {
-            "game": self.grid,
-            "turn": self.current_turn,
-            "players": self.players,
-            "winner": self.winner,
-            "started": self.started,
-            "last_drop": self.last_drop,
-            "rows": self.rows,
-            "columns": self.columns,
-            "closed": self.closed
-        }
+        with self.changed:
+            return {
+                "game_id": self.id,
+                "game": self.grid,
+                "turn": self.current_turn,
+                "players": dict(self.players),
+                "winner": self.winner,
+                "started": self.started,
+                "last_drop": self.last_drop,
+                "rows": self.rows,
+                "columns": self.columns,
+                "closed": self.closed,
+                "version": self.version
+            }
 
     def start_game(self):
         """
@@ -117,54 +228,126 @@ class ConnectPyGame(object):
         player to move `self.current_turn`
         """
         if self.players_ready:
-            self.reset_game()
-            self.player_cycle = cycle(self.players.keys())
-            self.current_turn = self.next_player()
-            self.started = True
+            with self.changed:
+                self.reset_game()
+                self.player_cycle = cycle(self.players.keys())
+                self.current_turn = self.next_player()
+                self.started = True
+                self.publish('start', turn=self.current_turn)
         else:
             raise PlayersNotReadyException(
                 "Calling start_game before all players have connected")
 
     def reset_game(self):
         """Reset game state to starting state"""
-        self.grid = []
-        for row in range(self.rows):
-            self.grid.append([0 for column in range(self.columns)])
-        self.last_drop = None
-        self.winner = None
+        with self.changed:
+            self.boards = {
+                indicator: 0 for indicator in range(1, self.max_players + 1)}
+            self.heights = [0 for column in range(self.columns)]
+            self.count_lines()
+            self.moves = []
+            self.last_drop = None
+            self.winner = None
+            self.publish('reset')
 
     def drop_disc(self, player_id, column_idx):
         """
         Returns True if the drop move for `player_id` at `column_idx` is a
         winning move. Also cycles `self.current_turn` to the next player
         """
+        started = perf_counter()
         player_indicator = self.get_player_indicator(player_id)
 
-        drop_coords = None
-        try:
-            for row_idx, row in reversed(list(enumerate(self.grid))):
-                if row[column_idx] == 0:
-                    row[column_idx] = player_indicator
-                    drop_coords = (row_idx, column_idx)
-                    break
-            else:
-                raise FullColumnException(
-                    "Player {} - Column {} full".format(
-                        player_id, column_idx))
-        except IndexError:
+        if not 0 <= column_idx < len(self.heights):
             raise ColumnOutOfBoundsException(
                 "Player {} - Column {} out of bounds".format(
                     player_id, column_idx))
 
-        self.current_turn = self.next_player()
-        self.last_drop = drop_coords
-
-        is_won = self.is_winner(player_indicator, drop_coords)
-        if is_won:
-            self.winner = player_id
+        height = self.heights[column_idx]
+        if height == self.rows:
+            raise FullColumnException(
+                "Player {} - Column {} full".format(player_id, column_idx))
+
+        with self.changed:
+            bit = column_idx * self.stride + height
+            self.boards[player_indicator] |= 1 << bit
+            self.heights[column_idx] = height + 1
+            self.moves.append(column_idx)
+            counts = self.line_counts[player_indicator]
+            for line in self.cell_lines[bit]:
+                counts[line] += 1
+            drop_coords = (self.rows - 1 - height, column_idx)
 
+            self.current_turn = self.next_player()
+            self.last_drop = drop_coords
+
+            # `is_winner` is timed here rather than inside, so its other
+            # callers don't pay for the clock
+            checked = perf_counter()
+            is_won = self.is_winner(player_indicator, drop_coords)
+            checked = perf_counter() - checked
+            if is_won:
+                self.winner = player_id
+
+            self.publish('drop', player=player_id, coords=drop_coords,
+                         turn=self.current_turn, winner=self.winner)
+        conn_metrics.DROP_DISC_SECONDS.observe(perf_counter() - started)
+        conn_metrics.IS_WINNER_SECONDS.observe(checked)
         return is_won
 
+    def count_lines(self):
+        """Recounts `self.line_counts` from the bitboards"""
+        self.line_counts = {}
+        for indicator, board in self.boards.items():
+            counts = self.line_counts[indicator] = [0] * len(self.lines)
+            while board:
+                low = board & -board
+                for line in self.cell_lines[low.bit_length() - 1]:
+                    counts[line] += 1
+                board ^= low
+
+    def hints(self, player_id):
+        """
+        Returns a dict of the columns where `player_id` wins by dropping
+        now ("wins") and those an opponent would win by dropping in next
+        ("blocks"). Only the landing cell of each column is checked, against
+        the line counters through it. With a `win_zone` of 1 every open
+        column is both
+        """
+        player = self.get_player_indicator(player_id)
+        with self.changed:
+            wins, blocks = [], []
+            hints = {"version": self.version, "wins": wins, "blocks": blocks}
+            if not self.started or self.winner:
+                return hints
+            counts = self.line_counts.get(player)
+            all_counts = list(self.line_counts.values())
+            needed = self.win_zone - 1
+            for column_idx, height in enumerate(self.heights):
+                if height == self.rows:
+                    continue
+                win = block = False
+                for line in self.cell_lines[column_idx * self.stride + height]:
+                    # A line is one drop from won when a single player holds
+                    # all but its last cell
+                    if sum(line_counts[line] for line_counts in all_counts) \
+                            != needed:
+                        continue
+                    if counts is not None and counts[line] == needed:
+                        win = True
+                    if any(line_counts[line] == needed
+                           for line_counts in all_counts
+                           if line_counts is not counts):
+                        block = True
+                if win:
+                    wins.append(column_idx)
+                if block:
+                    blocks.append(column_idx)
+            return hints
+
+    def cell_mask(self, row_idx, column_idx):
+        """Returns the bitboard mask for the cell at `row_idx`, `column_idx`"""
+        return 1 << (column_idx * self.stride + self.rows - 1 - row_idx)
 
     def axis_has_winner(self, player, win_axis):
         """
@@ -175,45 +358,87 @@ class ConnectPyGame(object):
             if all(n == player for n in seq):
                 return True
 
-    def is_winner(self, player, drop_coords):
+    def chain_length(self, board, origin, shift):
         """
-        Returns True if the matrix `self.grid` contains a chain of indicators
-        of length `self.win_zone` for `player` in any direction from
-        coordinates `drop_coords`.
+        Returns the length (capped at `self.win_zone`) of the chain of set
+        bits in `board` through bit `origin`, walking outward `shift` bits at
+        a time in both directions and stopping at the first mismatch
         """
-        row_idx, column_idx = drop_coords
+        if not board >> origin & 1:
+            return 0
 
-        # Get the surrounding win zone on the horizontal axis
-        win_hor = surrounding_slice(
-            self.grid[row_idx], column_idx, self.win_zone)
+        length = 1
+        idx = origin + shift
+        while length < self.win_zone and board >> idx & 1:
+            length += 1
+            idx += shift
 
-        # Get the surrounding win zone on the vertical axis
-        win_vert = surrounding_slice(
-            list(zip(*self.grid))[column_idx], row_idx, self.win_zone)
+        idx = origin - shift
+        while length < self.win_zone and idx >= 0 and board >> idx & 1:
+            length += 1
+            idx -= shift
 
-        # Get the surrounding win zone on the diagonal axis
-        win_diag_main = surrounding_diag(
-            self.grid, row_idx, column_idx, self.win_zone, flip=False)
+        return length
+
+    def is_winner(self, player, drop_coords):
+        """
+        Returns True if the bitboard for `player` contains a chain of
+        indicators of length `self.win_zone` in any direction through
+        coordinates `drop_coords`.
+        """
+        return self.winning_axis(player, drop_coords) is not None
 
-        # Get the surrounding win zone on the flipped diagonal axis
-        win_diag_flip = surrounding_diag(
-            self.grid, row_idx, column_idx, self.win_zone, flip=True)
+    def winning_axis(self, player, drop_coords):
+        """
+        Returns the first axis, as named by `axis_shifts`, along which
+        `player` has a chain of `self.win_zone` through coordinates
+        `drop_coords`, or None
+        """
+        board = self.boards.get(player, 0)
+        row_idx, column_idx = drop_coords
+        origin = column_idx * self.stride + self.rows - 1 - row_idx
 
-        # Return true is any win zone axis contains a winning chain
-        return any(self.axis_has_winner(player, win_axis) for win_axis in
-                   [win_hor, win_vert, win_diag_main, win_diag_flip])
+        for axis, shift in axis_shifts(self.stride):
+            if self.chain_length(board, origin, shift) == self.win_zone:
+                return axis
+        return None
 
-    def add_player(self, player_id):
-        """Adds a player_id to `self.players` and assigns it an indicator"""
+    def add_player(self, player_id, bot=None):
+        """
+        Adds a player_id to `self.players` and assigns it an indicator. A
+        `bot`, with a `choose_move(game, player_id)` method, plays its moves
+        through `play_bots`
+        """
         if not self.players_ready:
             if player_id not in self.players:
-                self.players[player_id] = len(self.players) + 1
+                with self.changed:
+                    self.players[player_id] = len(self.players) + 1
+                    if bot is not None:
+                        self.bots[player_id] = bot
+                    self.publish('join', player=player_id,
+                                 indicator=self.players[player_id],
+                                 bot=bot is not None)
             else:
                 raise AlreadyJoinedException(
                     "Player {} already joined".format(player_id))
         else:
             raise FullGameException("Maximum players reached")
 
+    def play_bots(self):
+        """
+        Drops discs for bot players while it's their turn in a running game
+        without a winner. Returns True if a bot won
+        """
+        while self.started and not self.winner and not self.closed and \
+                self.current_turn in self.bots:
+            player_id = self.current_turn
+            column = self.bots[player_id].choose_move(self, player_id)
+            if column is None:
+                break
+            if self.drop_disc(player_id, column):
+                return True
+        return False
+
     def is_turn(self, player_id):
         """Returns True if `player_id` matches `self.current_turn`"""
         return self.current_turn == player_id
@@ -232,5 +457,140 @@ class ConnectPyGame(object):
 
     def close(self, player_id):
         """Sets `self.closed` to `player_id`"""
-        self.closed = player_id
+        with self.changed:
+            self.closed = player_id
+            self.publish('close', player=player_id)
+
+    def publish(self, event_type, **data):
+        """
+        Increments `self.version`, wakes any waiting readers and passes an
+        event of the form {"type": `event_type`, "version": ..., **data} to
+        each of `self.subscribers`
+        """
+        with self.changed:
+            self.version += 1
+            event = dict(data, type=event_type, version=self.version)
+            self.log.append(event)
+            excess = len(self.log) - self.log_size
+            if excess > 0:
+                # Older versions get the full state from `changes_since`
+                del self.log[:excess]
+                self.log_start += excess
+            self.cache.clear()
+            self.changed.notify_all()
+            for subscriber in self.subscribers:
+                subscriber(event)
+        return event
+
+    def serialized(self):
+        """
+        Returns a (version, JSON) tuple for `self.dict`, encoding it at most
+        once per version
+        """
+        return self.encoded('json', lambda game: json.dumps(
+            game.dict, separators=(',', ':')))
+
+    def encoded(self, key, encode):
+        """
+        Returns a (version, `encode(self)`) tuple, cached in `self.cache`
+        under `key` until the next state change
+        """
+        with self.changed:
+            try:
+                return self.cache[key]
+            except KeyError:
+                encoded = self.cache[key] = (self.version, encode(self))
+                return encoded
+
+    def changes_since(self, version):
+        """
+        Returns a delta dict holding the events published after `version`,
+        or None if `version` isn't a version of this game
+        """
+        with self.changed:
+            if not isinstance(version, int) or \
+                    not self.log_start <= version <= self.version:
+                return None
+            return {
+                "game_id": self.id,
+                "since": version,
+                "version": self.version,
+                "events": self.log[version - self.log_start:]
+            }
+
+    def snapshot(self):
+        """
+        Returns a JSON serializable dict of the game state, which
+        `from_snapshot` restores
+        """
+        with self.changed:
+            return {
+                "game_id": self.id,
+                "columns": self.columns,
+                "rows": self.rows,
+                "win_zone": self.win_zone,
+                "players": list(self.players.items()),
+                "bots": list(self.bots),
+                "boards": list(self.boards.items()),
+                "heights": self.heights,
+                "moves": list(self.moves),
+                "started": self.started,
+                "turn": self.current_turn,
+                "winner": self.winner,
+                "last_drop": self.last_drop,
+                "closed": self.closed,
+                "version": self.version
+            }
+
+    @classmethod
+    def from_snapshot(cls, state, bot=None):
+        """
+        Returns the ConnectPyGame saved by `snapshot`, with `bot` playing
+        for its bot players. Events from before the snapshot aren't kept
+        """
+        game = cls({
+            "game_columns": state['columns'],
+            "game_rows": state['rows'],
+            "win_zone": state['win_zone']
+        }, game_id=state['game_id'])
+        for player_id, indicator in state['players']:
+            game.players[player_id] = indicator
+            if player_id in state['bots']:
+                game.bots[player_id] = bot
+        game.boards = dict(state['boards'])
+        game.heights = list(state['heights'])
+        game.count_lines()
+        game.moves = list(state.get('moves', ()))
+        game.started = state['started']
+        game.current_turn = state['turn']
+        game.winner = state['winner']
+        if state['last_drop'] is not None:
+            game.last_drop = tuple(state['last_drop'])
+        game.closed = state['closed']
+        game.version = game.log_start = state['version']
+        if game.started:
+            # Leave the cycle just past the player whose turn it is
+            game.player_cycle = cycle(game.players.keys())
+            while game.next_player() != game.current_turn:
+                pass
+        return game
+
+    def subscribe(self, subscriber):
+        """Adds a callable to be passed every event this game publishes"""
+        with self.changed:
+            self.subscribers.append(subscriber)
+
+    def unsubscribe(self, subscriber):
+        """Removes a callable added by `subscribe`"""
+        with self.changed:
+            self.subscribers.remove(subscriber)
+
+    def wait_for_change(self, version, timeout):
+        """
+        Blocks until `self.version` differs from `version` or `timeout`
+        seconds pass. Returns True if the state changed
+        """
+        with self.changed:
+            return self.changed.wait_for(
+                lambda: self.version != version, timeout)
 
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import json
+import random
+import threading
+import time
+import requests
+
+from collections import defaultdict, Counter
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from connectpy.connectpy_client import PlayerClient
+from connectpy.connectpy_server import create_app
+
+
+class LoadStats(object):
+    """Thread-safe request latency and status code counts per endpoint"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.codes = defaultdict(Counter)
+
+    def record(self, endpoint, status, latency):
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            self.codes[endpoint][status] += 1
+
+    def report(self, elapsed):
+        """Returns a dict of throughput and per-endpoint latency stats"""
+        with self.lock:
+            total = sum(len(lats) for lats in self.latencies.values())
+            endpoints = {}
+            for endpoint, lats in sorted(self.latencies.items()):
+                lats = sorted(lats)
+                endpoints[endpoint] = {
+                    "count": len(lats),
+                    "p50": percentile(lats, 50),
+                    "p90": percentile(lats, 90),
+                    "p99": percentile(lats, 99),
+                    "max": lats[-1],
+                    "codes": {str(code): count for code, count in
+                              sorted(self.codes[endpoint].items(), key=str)}
+                }
+        return {
+            "elapsed": elapsed,
+            "requests": total,
+            "throughput": total / elapsed if elapsed else 0,
+            "endpoints": endpoints
+        }
+
+
+def percentile(sorted_values, pct):
+    """Returns the nearest-rank `pct` percentile of `sorted_values`"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100.0 * len(sorted_values))), 1)
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class RecordingSession(object):
+    """Wraps a requests.Session style `session`, timing every POST"""
+
+    def __init__(self, session, stats):
+        self.session = session
+        self.stats = stats
+
+    def post(self, url, **kwargs):
+        endpoint = urlsplit(url).path
+        started = time.monotonic()
+        try:
+            resp = self.session.post(url, **kwargs)
+        except requests.RequestException as e:
+            self.stats.record(
+                endpoint, type(e).__name__, time.monotonic() - started)
+            raise
+        self.stats.record(
+            endpoint, resp.status_code, time.monotonic() - started)
+        return resp
+
+
+class TestClientSession(object):
+    """Sends requests.Session style POSTs to an in-process Flask `app`"""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def post(self, url, json=None, headers=None, timeout=None, stream=False):
+        return TestClientResponse(
+            self.client.post(urlsplit(url).path, json=json, headers=headers))
+
+
+class TestClientResponse(object):
+    """The parts of requests.Response used by PlayerClient"""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    @property
+    def content(self):
+        return self.response.data
+
+    def json(self):
+        return self.response.json
+
+    def close(self):
+        self.response.close()
+
+
+def open_columns(game_state):
+    """Returns the indexes of columns with space left in `game_state`"""
+    return [idx for idx, cell in enumerate(game_state['game'][0])
+            if cell == 0]
+
+
+def random_policy(game_state, rng):
+    columns = open_columns(game_state)
+    return rng.choice(columns) if columns else None
+
+
+def first_policy(game_state, rng):
+    columns = open_columns(game_state)
+    return columns[0] if columns else None
+
+
+def center_policy(game_state, rng):
+    center = (game_state['columns'] - 1) / 2.0
+    columns = open_columns(game_state)
+    return min(columns, key=lambda c: abs(c - center)) if columns else None
+
+
+MOVE_POLICIES = {
+    'random': random_policy,
+    'first': first_policy,
+    'center': center_policy,
+}
+
+
+def run_player(client, moves=20, think_time=(0, 0), policy='random',
+               poll_wait=5, wait_timeout=30, rng=None):
+    """
+    Drives `client` through join -> move/status -> close, making up to
+    `moves` moves. Returns the number of moves made
+    """
+    rng = rng or random.Random()
+    choose_column = MOVE_POLICIES[policy]
+    if not client.join_server():
+        return 0
+
+    made = 0
+    deadline = time.monotonic() + wait_timeout
+    while made < moves and not client.game_state['closed']:
+        if time.monotonic() > deadline:
+            break
+        if client.opposing_player and client.can_move:
+            time.sleep(rng.uniform(*think_time))
+            column = choose_column(client.game_state, rng)
+            if column is None:
+                break
+            if client.make_move(column):
+                made += 1
+            deadline = time.monotonic() + wait_timeout
+        else:
+            client.update_status(wait=poll_wait)
+
+    if not client.game_state['closed']:
+        client.close_game()
+    return made
+
+
+def run_load(players, server_url=None, app=None, moves=20,
+             think_time=(0, 0), policy='random', poll_wait=5,
+             wait_timeout=30, retries=0, ramp_up=0, seed=None):
+    """
+    Runs `players` simulated players, one per thread, against either
+    `server_url` or the in-process Flask `app`, starting them evenly over
+    `ramp_up` seconds. Returns the LoadStats report
+    """
+    stats = LoadStats()
+    rng = random.Random(seed)
+
+    def make_client(idx):
+        session = TestClientSession(app) if app is not None else None
+        client = PlayerClient(
+            'player-{}'.format(idx), server_url or '', session=session,
+            pool_maxsize=1, max_retries=retries)
+        client.session = RecordingSession(client.session, stats)
+        return client
+
+    clients = [make_client(idx) for idx in range(players)]
+    player_rngs = [random.Random(rng.random()) for _ in clients]
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=players) as executor:
+        futures = []
+        for client, player_rng in zip(clients, player_rngs):
+            futures.append(executor.submit(
+                run_player, client, moves=moves, think_time=think_time,
+                policy=policy, poll_wait=poll_wait,
+                wait_timeout=wait_timeout, rng=player_rng))
+            time.sleep(ramp_up / players)
+        errors = Counter()
+        for future in futures:
+            try:
+                future.result()
+            except requests.RequestException as e:
+                errors[type(e).__name__] += 1
+    report = stats.report(time.monotonic() - started)
+    report["players"] = players
+    report["player_errors"] = dict(errors)
+    return report
+
+
+def print_report(report):
+    print("{} players, {} requests in {:.2f}s ({:.1f} req/s)".format(
+        report["players"], report["requests"], report["elapsed"],
+        report["throughput"]))
+    print("{:<10} {:>8} {:>9} {:>9} {:>9} {:>9}  codes".format(
+        "endpoint", "count", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+    for endpoint, stats in report["endpoints"].items():
+        print("{:<10} {:>8} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f}  {}".format(
+            endpoint, stats["count"], stats["p50"] * 1000,
+            stats["p90"] * 1000, stats["p99"] * 1000, stats["max"] * 1000,
+            ' '.join('{}={}'.format(code, count)
+                     for code, count in stats["codes"].items())))
+    for error, count in report["player_errors"].items():
+        print("{} players failed with {}".format(count, error))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='ConnectPy load generator')
+    parser.add_argument(
+        '-n', dest='players', type=int, default=10,
+        help='Number of simulated players')
+    parser.add_argument(
+        '-u', dest='server_url', action='store',
+        help='Server URL, runs against an in-process app if not set')
+    parser.add_argument(
+        '-m', dest='moves', type=int, default=20,
+        help='Moves per player')
+    parser.add_argument(
+        '-t', dest='think_time', type=float, nargs=2, default=[0, 0],
+        metavar=('MIN', 'MAX'), help='Think time range in seconds')
+    parser.add_argument(
+        '-p', dest='policy', choices=sorted(MOVE_POLICIES),
+        default='random', help='Move policy')
+    parser.add_argument(
+        '--poll-wait', type=float, default=5,
+        help='Long-poll wait for /status in seconds')
+    parser.add_argument(
+        '--wait-timeout', type=float, default=30,
+        help='Seconds a player waits for its opponent before giving up')
+    parser.add_argument(
+        '--ramp-up', type=float, default=0,
+        help='Seconds over which to start the players')
+    parser.add_argument(
+        '--retries', type=int, default=0,
+        help='Client retries on 5xx and connection errors')
+    parser.add_argument(
+        '--seed', type=int, help='Seed for think times and moves')
+    parser.add_argument(
+        '--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args()
+
+    report = run_load(
+        args.players, server_url=args.server_url,
+        app=None if args.server_url else create_app(), moves=args.moves,
+        think_time=tuple(args.think_time), policy=args.policy,
+        poll_wait=args.poll_wait, wait_timeout=args.wait_timeout,
+        retries=args.retries, ramp_up=args.ramp_up, seed=args.seed)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+import time
+import uuid
+import connectpy.connectpy_game as conn_py
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from threading import RLock
+
+
+class GameNotFoundException(Exception):
+    pass
+
+
+class LobbyFullException(Exception):
+    pass
+
+
+class GameBusyException(Exception):
+    pass
+
+
+class ConnectPyLobby(object):
+    """
+    Registry of running ConnectPy games, keyed by game id. This is the
+    in-process game backend, connectpy_backend.SharedLobby offers the same
+    interface over state shared between processes
+    """
+
+    def __init__(self, config, store=None):
+        """
+        Expect a `config` of the form:
+            max_games: 50000
+            game_idle_timeout: 300
+            closed_game_timeout: 30
+        Any ConnectPyGame config is passed through to each new game. Games
+        are saved to the connectpy_store GameStore `store`, if given
+        """
+        self.config = config
+        self.store = store
+        self.max_games = config.get('max_games', 50000)
+        self.idle_timeout = config.get('game_idle_timeout', 300)
+        self.closed_timeout = config.get('closed_game_timeout', 30)
+        # Ordered from least to most recently active, so expired games are
+        # always found at the front
+        self.games = OrderedDict()
+        self.last_active = {}
+        self.waiting = None
+        # Guards the registry, each game has its own lock for its state
+        self.lock = RLock()
+
+    def __len__(self):
+        return len(self.games)
+
+    def new_game(self):
+        """Creates a new ConnectPyGame and adds it to `self.games`"""
+        with self.lock:
+            self.evict()
+            if len(self.games) >= self.max_games:
+                raise LobbyFullException(
+                    "Maximum games reached - try again later")
+
+            game_id = uuid.uuid4().hex
+            game = conn_py.ConnectPyGame(self.config, game_id=game_id)
+            self.games[game_id] = game
+            self.last_active[game_id] = time.monotonic()
+            if self.store is not None:
+                self.store.attach(game)
+            return game
+
+    def recover(self, bot=None):
+        """
+        Adds the games saved in `self.store` by an earlier run, with `bot`
+        playing for their bot players. Returns the number recovered
+        """
+        if self.store is None:
+            return 0
+        now = time.monotonic()
+        games = self.store.recover(bot=bot)
+        with self.lock:
+            for game in games:
+                self.games[game.id] = game
+                self.last_active[game.id] = now
+                self.store.attach(game, new=False)
+                if not game.closed and not game.players_ready:
+                    self.waiting = game
+        return len(games)
+
+    def waiting_game(self):
+        """
+        Returns the game waiting for an opponent, creating a new one if the
+        last waiting game has filled up or been closed
+        """
+        with self.lock:
+            game = self.waiting
+            if game is None or game.closed or game.players_ready \
+                    or game.id not in self.games:
+                game = self.waiting = self.new_game()
+            return game
+
+    def get_game(self, game_id):
+        """
+        Returns the game for `game_id` and marks it as active. Closed games
+        are not marked, so they expire `closed_game_timeout` after closing.
+        """
+        with self.lock:
+            try:
+                game = self.games[game_id]
+            except (KeyError, TypeError):
+                raise GameNotFoundException(
+                    "Game {} not found".format(game_id))
+
+            if not game.closed:
+                self.games.move_to_end(game_id)
+                self.last_active[game_id] = time.monotonic()
+            self.evict()
+            return game
+
+    @contextmanager
+    def locked(self, game_id):
+        """
+        Yields the game for `game_id` under its lock, to be read and changed
+        as one step. Every change to a game goes through here
+        """
+        game = self.get_game(game_id)
+        with game.lock:
+            yield game
+
+    def wait_for_change(self, game, version, timeout):
+        """
+        Blocks until `game` moves past `version` or `timeout` seconds pass,
+        returning the game's latest state
+        """
+        game.wait_for_change(version, timeout)
+        return game
+
+    def subscribe(self, game, subscriber):
+        """Passes `subscriber` every event `game` publishes from now on"""
+        game.subscribe(subscriber)
+
+    def unsubscribe(self, game, subscriber):
+        game.unsubscribe(subscriber)
+
+    def remove_game(self, game_id):
+        """Removes `game_id` from the registry"""
+        with self.lock:
+            game = self.games.pop(game_id, None)
+            self.last_active.pop(game_id, None)
+            if game is not None:
+                if game is self.waiting:
+                    self.waiting = None
+                if self.store is not None:
+                    self.store.remove(game_id)
+            return game
+
+    def stats(self):
+        """Returns the number of open games and the players in them"""
+        with self.lock:
+            games = [game for game in self.games.values() if not game.closed]
+        return {
+            "games": len(games),
+            "players": sum(len(game.players) for game in games)
+        }
+
+    def evict(self, now=None):
+        """
+        Removes expired games from the front of `self.games`, stopping at the
+        first game still in use. Returns the number of games evicted.
+        """
+        now = time.monotonic() if now is None else now
+        evicted = 0
+        with self.lock:
+            while self.games:
+                game_id, game = next(iter(self.games.items()))
+                timeout = self.closed_timeout if game.closed \
+                    else self.idle_timeout
+                if now - self.last_active[game_id] < timeout:
+                    break
+                self.remove_game(game_id)
+                evicted += 1
+        return evicted
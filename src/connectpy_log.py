@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+import atexit
+import json
+import logging
+
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+LOGGER_NAME = 'connectpy'
+
+# The background writer shared by every app in the process
+_LISTENER = None
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats a record as one JSON object, with any `fields` merged in"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, separators=(',', ':'), default=str)
+
+
+def fields(**values):
+    """
+    Returns the `extra` for a structured log call, e.g.
+        log.info("Game started", extra=fields(game_id=game.id))
+    """
+    return {'fields': values}
+
+
+def setup_logging(config):
+    """
+    Expect a `config` of the form:
+        log_level: INFO
+        log_format: json
+    Records from the `connectpy` loggers are queued and written to stderr
+    by a background thread, so a request never waits on the write. Either
+    format is accepted: `json` or `text`
+    """
+    global _LISTENER
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(config.get('log_level', 'INFO'))
+    if _LISTENER is None:
+        records = SimpleQueue()
+        handler = logging.StreamHandler()
+        if config.get('log_format', 'json') == 'json':
+            handler.setFormatter(JSONFormatter())
+        else:
+            handler.setFormatter(logging.Formatter(
+                '%(asctime)s %(levelname)s %(name)s %(message)s'))
+        _LISTENER = QueueListener(records, handler)
+        _LISTENER.start()
+        # Write out whatever is still queued when the process exits
+        atexit.register(_LISTENER.stop)
+        logger.addHandler(QueueHandler(records))
+        logger.propagate = False
+    return logger
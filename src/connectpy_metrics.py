@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left
+from threading import Lock
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from a fast status request to a long-poll
+REQUEST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Seconds, for engine calls that take microseconds
+ENGINE_BUCKETS = (1e-06, 2.5e-06, 5e-06, 1e-05, 2.5e-05, 5e-05, 0.0001,
+                  0.00025, 0.001)
+# Bytes
+SIZE_BUCKETS = (64, 128, 256, 512, 1024, 2048, 4096, 16384, 65536)
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{{{}}}'.format(','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs))
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return '{}'.format(value)
+
+
+class Metric(object):
+    """
+    A named metric with a value per combination of its `labels`, rendered
+    in the Prometheus text format
+    """
+
+    kind = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = Lock()
+
+    def render(self):
+        lines = ['# HELP {} {}'.format(self.name, self.description),
+                 '# TYPE {} {}'.format(self.name, self.kind)]
+        with self.lock:
+            values = self.snapshot()
+        for label_values, value in sorted(values):
+            lines.extend(self.samples(label_values, value))
+        return lines
+
+    def snapshot(self):
+        return list(self.values.items())
+
+    def samples(self, label_values, value):
+        yield '{}{} {}'.format(self.name, format_labels(
+            self.labels, label_values), format_value(value))
+
+
+class Gauge(Metric):
+
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative `buckets`. The `_count` sample of
+    each label combination doubles as its counter
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(),
+                 buckets=REQUEST_BUCKETS):
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *label_values):
+        counts = self.values.get(label_values)
+        if counts is None:
+            with self.lock:
+                # One count per bucket plus +Inf, then the sum
+                counts = self.values.setdefault(
+                    label_values, [0] * (len(self.buckets) + 2))
+        idx = bisect_left(self.buckets, value)
+        with self.lock:
+            counts[idx] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        return [(labels, list(counts))
+                for labels, counts in self.values.items()]
+
+    def samples(self, label_values, counts):
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            yield '{}_bucket{} {}'.format(self.name, format_labels(
+                self.labels, label_values, [('le', format_value(bound))]),
+                total)
+        labels = format_labels(self.labels, label_values)
+        yield '{}_sum{} {}'.format(self.name, labels, counts[-1])
+        yield '{}_count{} {}'.format(self.name, labels, total)
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(),
+                  buckets=REQUEST_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Metrics are kept per process, so with several server workers each one is
+# scraped on its own
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.histogram(
+    'connectpy_request_seconds', 'Request latency by endpoint and status',
+    labels=('endpoint', 'status'))
+RESPONSE_BYTES = REGISTRY.histogram(
+    'connectpy_response_bytes', 'Response body size by endpoint',
+    labels=('endpoint',), buckets=SIZE_BUCKETS)
+DROP_DISC_SECONDS = REGISTRY.histogram(
+    'connectpy_drop_disc_seconds', 'Time spent in ConnectPyGame.drop_disc',
+    buckets=ENGINE_BUCKETS)
+IS_WINNER_SECONDS = REGISTRY.histogram(
+    'connectpy_is_winner_seconds', 'Time spent in ConnectPyGame.is_winner',
+    buckets=ENGINE_BUCKETS)
+ACTIVE_GAMES = REGISTRY.gauge(
+    'connectpy_active_games', 'Games in the lobby that are not closed')
+ACTIVE_PLAYERS = REGISTRY.gauge(
+    'connectpy_active_players', 'Players in games that are not closed')
+STORE_FAILED_COMMITS = REGISTRY.gauge(
+    'connectpy_store_failed_commits',
+    'Game log commits that failed to write since the store started')
+
+
+def observe_request(endpoint, status, seconds, size=None):
+    REQUEST_SECONDS.observe(seconds, endpoint, status)
+    if size is not None:
+        RESPONSE_BYTES.observe(size, endpoint)
+
+
+def scrape(lobby):
+    """Returns every metric in the Prometheus text format"""
+    stats = lobby.stats()
+    ACTIVE_GAMES.set(stats['games'])
+    ACTIVE_PLAYERS.set(stats['players'])
+    return REGISTRY.render()
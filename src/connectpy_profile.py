@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+
+import cProfile
+import hmac
+import io
+import marshal
+import pstats
+import random
+
+from collections import deque
+from threading import Lock
+
+
+class RequestProfiler(object):
+    """
+    Profiles a sampled fraction of requests, plus any request sending the
+    `profile_token` in the `profile_header`, with cProfile. The profiles of
+    each endpoint are kept in memory, the oldest dropped past
+    `profile_retention`, and merged when read.
+
+    Only one request is profiled at a time, others go unprofiled, which
+    also caps the cost of a high sample rate
+    """
+
+    def __init__(self, config):
+        """
+        Expect a `config` of the form:
+            profile_sample_rate: 0.0
+            profile_header: X-Connectpy-Profile
+            profile_token: null
+            profile_retention: 50
+        """
+        self.sample_rate = config.get('profile_sample_rate', 0.0)
+        self.header = config.get('profile_header', 'X-Connectpy-Profile')
+        self.token = config.get('profile_token')
+        self.retention = config.get('profile_retention', 50)
+        self.profiles = {}
+        self.lock = Lock()
+        self.running = Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.sample_rate or self.token)
+
+    def authorized(self, headers):
+        """
+        Returns True if `headers` carry the profile token, compared in
+        constant time so the token can't be guessed byte by byte
+        """
+        value = headers.get(self.header)
+        if self.token is None or value is None:
+            return False
+        return hmac.compare_digest(
+            value.encode('utf-8'), str(self.token).encode('utf-8'))
+
+    def start(self, headers):
+        """
+        Returns a running cProfile.Profile if this request is to be
+        profiled, otherwise None
+        """
+        if not (self.sample_rate and random.random() < self.sample_rate) \
+                and not self.authorized(headers):
+            return None
+        if not self.running.acquire(blocking=False):
+            return None
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def stop(self, profile, endpoint):
+        """Stops `profile` and keeps it under `endpoint`"""
+        profile.disable()
+        self.running.release()
+        profile.create_stats()
+        with self.lock:
+            if endpoint not in self.profiles:
+                self.profiles[endpoint] = deque(maxlen=self.retention)
+            self.profiles[endpoint].append(profile)
+
+    def summary(self):
+        """Returns {endpoint: number of profiles kept}"""
+        with self.lock:
+            return {endpoint: len(profiles)
+                    for endpoint, profiles in self.profiles.items()}
+
+    def stats(self, endpoint, stream=None):
+        """
+        Returns a pstats.Stats merging the profiles kept for `endpoint`, or
+        None if there are none
+        """
+        with self.lock:
+            profiles = list(self.profiles.get(endpoint, ()))
+        if not profiles:
+            return None
+        return pstats.Stats(*profiles, stream=stream)
+
+    def report(self, endpoint, limit=40):
+        """Returns the merged profile of `endpoint` as pstats text"""
+        stream = io.StringIO()
+        stats = self.stats(endpoint, stream=stream)
+        if stats is None:
+            return None
+        stats.sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
+
+    def dump(self, endpoint):
+        """
+        Returns the merged profile of `endpoint` in the binary format of
+        `pstats.Stats.dump_stats`, for snakeviz or `python -m pstats`
+        """
+        stats = self.stats(endpoint)
+        if stats is None:
+            return None
+        return marshal.dumps(stats.stats)
@@ -1,26 +1,54 @@
 # -*- coding: utf-8 -*-
 
 import yaml
+import atexit
+import json
+import logging
 import os
 import connectpy.connectpy_game as conn_py
-
+import connectpy.connectpy_lobby as conn_lobby
+import connectpy.connectpy_ai as conn_ai
+import connectpy.connectpy_book as conn_book
+import connectpy.connectpy_store as conn_store
+import connectpy.connectpy_backend as conn_backend
+import connectpy.connectpy_metrics as conn_metrics
+import connectpy.connectpy_log as conn_log
+import connectpy.connectpy_profile as conn_profile
+import connectpy.connectpy_wire as conn_wire
+import connectpy.connectpy_archive as conn_archive
+
+from queue import Queue, Empty
 from functools import wraps
-from flask import Flask, Blueprint, request, jsonify, current_app
+from time import perf_counter
+from flask import (
+    Flask, Blueprint, Response, request, jsonify, current_app)
 
 paths = Blueprint('paths', __name__)
+log = logging.getLogger('connectpy.server')
+
+BOT_PLAYER_ID = 'connectpy-bot'
+JOIN_ATTEMPTS = 5
+
+
+def pick_game():
+    """Returns a new game for bot games, otherwise the waiting game"""
+    if request.json.get('opponent') == 'bot':
+        return current_app.lobby.new_game()
+    return current_app.lobby.waiting_game()
 
 
 def game_started(func):
     @wraps(func)
     def decorator(*args, **kwargs):
-        if current_app.game.closed:
-            new_game(current_app)
-        if current_app.game.started or current_app.game.players_ready:
+        if request.player_id == BOT_PLAYER_ID:
+            # Taken by the server's bot in bot games
             return error_response(
-                "ConnectPy game in progress", status=503)
-        else:
-            resp = func(*args, **kwargs)
-        return resp
+                "player_id {} is reserved".format(BOT_PLAYER_ID), status=400)
+        try:
+            request.game = pick_game()
+        except conn_lobby.LobbyFullException as e:
+            return error_response(str(e), status=503)
+        return func(*args, **kwargs)
     return decorator
 
 
@@ -28,9 +56,13 @@ def player_joined(func):
     @wraps(func)
     def decorator(*args, **kwargs):
         try:
+            request.game = current_app.lobby.get_game(
+                request.json.get('game_id'))
             player_id = request.json.get('player_id')
-            current_app.game.get_player_indicator(player_id)
+            request.game.get_player_indicator(player_id)
             request.player_id = player_id
+        except conn_lobby.GameNotFoundException as e:
+            return error_response(str(e), status=404)
         except conn_py.PlayerInvalidException as e:
             return error_response(str(e), status=403)
         else:
@@ -64,67 +96,253 @@ def required_fields(fields):
     return decorator
 
 
+@paths.before_request
+def start_timer():
+    request.started = perf_counter()
+
+
+@paths.after_request
+def record_request(resp):
+    endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+    conn_metrics.observe_request(
+        endpoint, resp.status_code, perf_counter() - request.started,
+        None if resp.is_streamed else resp.content_length)
+    return resp
+
+
+@paths.errorhandler(conn_lobby.GameBusyException)
+def game_busy(e):
+    return error_response(str(e), status=503)
+
+
+@paths.errorhandler(conn_lobby.GameNotFoundException)
+def game_not_found(e):
+    return error_response(str(e), status=404)
+
+
 @paths.route('/join', methods=['POST'])
 @required_fields(['player_id'])
 @game_started
 def join():
+    # Joins racing for the same waiting game are settled under its lock,
+    # the losers move on to the next waiting game
+    for _ in range(JOIN_ATTEMPTS):
+        if not request.game.started and not request.game.players_ready:
+            with current_app.lobby.locked(request.game.id) as game:
+                if not game.started and not game.players_ready:
+                    return join_game(game)
+        try:
+            request.game = pick_game()
+        except conn_lobby.LobbyFullException as e:
+            return error_response(str(e), status=503)
+    return error_response("ConnectPy game in progress", status=503)
+
+
+def join_game(game):
     try:
-        current_app.game.add_player(request.player_id)
+        game.add_player(request.player_id)
     except conn_py.AlreadyJoinedException as e:
         return error_response(str(e), status=409)
     else:
-        print("Player {} connected".format(request.player_id))
+        log.info("Player joined", extra=conn_log.fields(
+            player_id=request.player_id, game_id=game.id))
+
+    if request.json.get('opponent') == 'bot' and not game.players_ready:
+        game.add_player(BOT_PLAYER_ID, bot=current_app.bot)
 
-    if current_app.game.players_ready:
-        current_app.game.start_game()
-        print("Game started")
+    if game.players_ready:
+        game.start_game()
+        game.play_bots()
+        log.info("Game started", extra=conn_log.fields(game_id=game.id))
 
-    return ok_response(current_app.game.dict)
+    return state_response(game)
 
 
 @paths.route('/status', methods=['GET', 'POST'])
-@required_fields(['player_id'])
+@required_fields(['player_id', 'game_id'])
 @player_joined
 def status():
-    return ok_response(current_app.game.dict)
+    version = request.json.get('version')
+    if version is not None:
+        # Long-poll: hold the request until the game moves past `version`
+        try:
+            wait = min(float(request.json.get('wait', 0)),
+                       current_app.config.get('status_max_wait', 30))
+        except (TypeError, ValueError):
+            return error_response("wait must be a number", status=400)
+        if wait > 0:
+            request.game = current_app.lobby.wait_for_change(
+                request.game, version, wait)
+
+    etag = game_etag(request.game.id, request.game.version)
+    if request.if_none_match.contains_weak(etag):
+        resp = current_app.response_class(status=304)
+        set_state_etag(resp, request.game.id, request.game.version)
+        return resp
+    return state_response(request.game)
+
+
+@paths.route('/events', methods=['GET', 'POST'])
+@required_fields(['player_id', 'game_id'])
+@player_joined
+def events():
+    """
+    Server-Sent Events stream of the game: a `state` event with the full
+    game dict, then one small event per join, start, drop, reset or close
+    """
+    game = request.game
+    lobby = current_app.lobby
+    keepalive = current_app.config.get('events_keepalive', 15)
+
+    def stream():
+        queue = Queue()
+        # Subscribe before the snapshot so no event can be missed, clients
+        # skip any event with a version the snapshot already includes
+        lobby.subscribe(game, queue.put)
+        try:
+            state = game.dict
+            yield sse_event(dict(type='state', version=state['version'],
+                                 state=state))
+            while True:
+                try:
+                    event = queue.get(timeout=keepalive)
+                except Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield sse_event(event)
+                if event['type'] == 'close':
+                    break
+        finally:
+            lobby.unsubscribe(game, queue.put)
+
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+
+@paths.route('/hints', methods=['GET', 'POST'])
+@required_fields(['player_id', 'game_id'])
+@player_joined
+def hints():
+    """
+    Returns the columns where the player wins by dropping now and those
+    they must block, as `ConnectPyGame.hints`
+    """
+    hints = request.game.hints(request.player_id)
+    return ok_response(dict(
+        hints, game_id=request.game.id, player_id=request.player_id))
 
 
 @paths.route('/move', methods=['POST'])
-@required_fields(['player_id', 'column'])
+@required_fields(['player_id', 'game_id', 'column'])
 @player_joined
 def move():
     player_id = request.json['player_id']
     column = request.json['column']
 
-    if current_app.game.is_turn(player_id):
+    with current_app.lobby.locked(request.game.id) as game:
+        return play_move(game, player_id, column)
+
+
+def play_move(game, player_id, column):
+    if game.is_turn(player_id):
         try:
-            winner = current_app.game.drop_disc(player_id, column)
+            winner = game.drop_disc(player_id, column)
         except (conn_py.FullColumnException,
                 conn_py.ColumnOutOfBoundsException) as e:
             return error_response(str(e), status=400)
-
-        game_dict = current_app.game.dict
-        current_app.game.print_grid()
+        if not winner:
+            # Bots reply within the same request
+            winner = game.play_bots()
+
+        resp = state_response(game)
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Disc dropped", extra=conn_log.fields(
+                game_id=game.id, player_id=player_id, grid=game.grid))
         if winner:
-            print("{} Wins! - Resetting".format(player_id))
-            current_app.game.reset_game()
-        return ok_response(game_dict)
+            log.info("Game won - resetting", extra=conn_log.fields(
+                game_id=game.id, winner=game.winner))
+            if current_app.archive is not None:
+                current_app.archive.record(game)
+            game.reset_game()
+            game.play_bots()
+        return resp
     else:
         return error_response(
             "Not your turn! - Enhance your calm", status=420)
 
 
 @paths.route('/close', methods=['POST'])
-@required_fields(['player_id'])
+@required_fields(['player_id', 'game_id'])
 @player_joined
 def close():
-    current_app.game.close(request.player_id)
-    resp = ok_response(current_app.game.dict)
-    print("Game closed by {}".format(request.player_id))
+    with current_app.lobby.locked(request.game.id) as game:
+        game.close(request.player_id)
+        resp = state_response(game)
+    log.info("Game closed", extra=conn_log.fields(
+        game_id=game.id, player_id=request.player_id))
 
     return resp
 
 
+@paths.route('/metrics', methods=['GET'])
+def metrics():
+    return current_app.response_class(
+        conn_metrics.scrape(current_app.lobby),
+        content_type=conn_metrics.CONTENT_TYPE)
+
+
+@paths.route('/admin/profiles', methods=['GET'])
+def profiles():
+    """
+    Lists the endpoints with kept profiles, or with `?endpoint=` returns
+    the merged profile of one as text, or `&format=pstats` for the binary
+    pstats format. Needs the profile token in the profile header
+    """
+    profiler = current_app.profiler
+    if not profiler.authorized(request.headers):
+        return error_response("Profile token required", status=403)
+    endpoint = request.args.get('endpoint')
+    if endpoint is None:
+        return ok_response(profiler.summary())
+
+    binary = request.args.get('format') == 'pstats'
+    body = profiler.dump(endpoint) if binary else profiler.report(endpoint)
+    if body is None:
+        return error_response(
+            "No profiles for {}".format(endpoint), status=404)
+    if not binary:
+        return current_app.response_class(body, mimetype='text/plain')
+    resp = current_app.response_class(
+        body, mimetype='application/octet-stream')
+    resp.headers['Content-Disposition'] = \
+        'attachment; filename=connectpy{}.prof'.format(
+            endpoint.replace('/', '-'))
+    return resp
+
+
+def start_profile():
+    if request.endpoint != 'paths.profiles':
+        request.profile = current_app.profiler.start(request.headers)
+
+
+def stop_profile(exc):
+    profile = getattr(request, 'profile', None)
+    if profile is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unknown'
+        current_app.profiler.stop(profile, endpoint)
+
+
+def install_profiler(app):
+    """
+    Profiles requests as set by the `profile_*` config. Nothing is hooked
+    into requests unless sampling or a profile token is configured
+    """
+    app.profiler = conn_profile.RequestProfiler(app.config)
+    if app.profiler.enabled:
+        app.before_request(start_profile)
+        app.teardown_request(stop_profile)
+
+
 def get_config():
     config_filename = os.environ.get('CONNECTPY_SETTINGS')
     config = {}
@@ -142,22 +360,91 @@ def error_response(error_str, status=400):
     return resp
 
 
+def game_etag(game_id, version):
+    return '{}-{}'.format(game_id, version)
+
+
+def set_state_etag(resp, game_id, version):
+    """
+    Tags `resp` with the game version it leaves the client holding. JSON,
+    binary, gzipped and delta bodies of a version share the tag, so it's
+    weak and varies by the negotiating headers
+    """
+    resp.set_etag(game_etag(game_id, version), weak=True)
+    resp.headers['Vary'] = 'Accept, Accept-Encoding'
+
+
+def state_response(game):
+    """
+    Returns the full state of `game`, or only the changes since the version
+    in the request's `since` field when the game can still provide them.
+    Full states are sent in the compact binary format and gzipped when the
+    client accepts it. Either way the ETag names the game version the
+    client ends up holding
+    """
+    since = request.json.get('since')
+    if since is not None:
+        delta = game.changes_since(since)
+        if delta is not None:
+            resp = ok_response(delta)
+            set_state_etag(resp, game.id, delta['version'])
+            return resp
+
+    binary, compress = conn_wire.negotiate(
+        request.headers.get('Accept'), request.headers.get('Accept-Encoding'),
+        current_app.config)
+    version, body, gzipped = conn_wire.encoded_state(
+        game, binary, compress, current_app.config.get(
+            'wire_gzip_min_size', conn_wire.GZIP_MIN_SIZE))
+    resp = current_app.response_class(
+        body, mimetype=conn_wire.MIMETYPE if binary
+        else conn_wire.JSON_MIMETYPE)
+    if gzipped:
+        resp.headers['Content-Encoding'] = 'gzip'
+    set_state_etag(resp, game.id, version)
+    return resp
+
+
+def sse_event(event):
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        event['version'], event['type'],
+        json.dumps(event, separators=(',', ':')))
+
+
 def ok_response(data):
     resp = jsonify(data)
     resp.status_code = 200
     return resp
 
 
-def new_game(app):
-    app.game = conn_py.ConnectPyGame(app.config)
+def new_lobby(app):
+    if app.config.get('ai_workers', 1) > 1:
+        app.bot = conn_ai.ParallelAIPlayer(app.config)
+    else:
+        app.bot = conn_ai.AIPlayer(app.config)
+    app.bot.books = conn_book.load_books(app.config.get('ai_opening_books'))
+    if app.config.get('backend', 'local') == 'shared':
+        app.lobby = conn_backend.SharedLobby(app.config, bot=app.bot)
+    else:
+        store = conn_store.new_store(app.config)
+        if store is not None:
+            # Commits what's still buffered
+            atexit.register(store.close)
+        app.lobby = conn_lobby.ConnectPyLobby(app.config, store=store)
+        app.lobby.recover(bot=app.bot)
 
 
 def create_app():
     config = get_config()
     app = Flask(__name__)
     app.config.update(config)
+    conn_log.setup_logging(app.config)
     app.register_blueprint(paths)
-    new_game(app)
+    install_profiler(app)
+    new_lobby(app)
+    app.archive = conn_archive.new_archive(app.config)
+    if app.archive is not None:
+        atexit.register(app.archive.close)
 
     return app
 
@@ -0,0 +1,338 @@
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+import os
+import re
+import connectpy.connectpy_game as conn_py
+import connectpy.connectpy_log as conn_log
+import connectpy.connectpy_metrics as conn_metrics
+
+from threading import Condition, Lock, Thread
+
+log = logging.getLogger('connectpy.store')
+
+SEGMENT_NAME = 'wal.{:08d}.log'
+SEGMENT_RE = re.compile(r'^wal\.(\d{8})\.log$')
+SNAPSHOT_NAME = 'snapshot.json'
+# Stands in for the bot of bot players in games rebuilt for a snapshot,
+# which only needs to know which players are bots
+OFFLINE_BOT = object()
+
+
+class GameStore(object):
+    """
+    Persistence interface for a ConnectPyLobby. `attach` is called for each
+    new game and `remove` for each removed game, `recover` returns the
+    games saved by an earlier run. The base store saves nothing
+    """
+
+    def attach(self, game, new=True):
+        pass
+
+    def remove(self, game_id):
+        pass
+
+    def recover(self, bot=None):
+        return []
+
+    def close(self):
+        pass
+
+
+def apply_record(games, record, bot=None):
+    """
+    Replays a logged `record` onto the {game_id: ConnectPyGame} `games`.
+    Records a game has already seen, from its snapshot, are skipped
+    """
+    game_id = record['game']
+    if record['type'] == 'new':
+        games[game_id] = conn_py.ConnectPyGame({
+            "game_columns": record['columns'],
+            "game_rows": record['rows'],
+            "win_zone": record['win_zone']
+        }, game_id=game_id)
+        return
+    if record['type'] == 'remove':
+        games.pop(game_id, None)
+        return
+
+    game = games.get(game_id)
+    if game is None or record['version'] <= game.version:
+        return
+    if record['type'] == 'join':
+        game.add_player(record['player'], bot=bot if record['bot'] else None)
+    elif record['type'] == 'start':
+        game.start_game()
+    elif record['type'] == 'drop':
+        game.drop_disc(record['player'], record['coords'][1])
+    elif record['type'] == 'reset' and game.started:
+        # Unstarted games are reset by the following 'start'
+        game.reset_game()
+    elif record['type'] == 'close':
+        game.close(record['player'])
+
+
+def read_segment(path):
+    """
+    Yields the records of the log segment at `path`, stopping at a torn
+    final record left by a crash mid-write
+    """
+    with open(path) as f:
+        for line in f:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                return
+
+
+def fsync_dir(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class LogStore(GameStore):
+    """
+    Write-ahead log of game events with group commit. Events are buffered
+    in memory as they're published and a background thread writes and
+    fsyncs them every `store_commit_interval` seconds, so a request only
+    pays for a JSON encode and a list append.
+
+    The log is split into segments of about `store_segment_records`
+    records. Each full segment is folded into `snapshot.json` and deleted,
+    so recovery replays at most the snapshot plus the newest segment.
+
+    A failed commit is logged and counted in `failed`, and its records are
+    put back in the buffer and retried after `store_retry_interval`
+    seconds in a fresh segment, as the old one may end in a torn record.
+    """
+
+    def __init__(self, config):
+        """
+        Expect a `config` of the form:
+            store_path: /var/lib/connectpy
+            store_commit_interval: 0.005
+            store_segment_records: 10000
+            store_retry_interval: 1
+        """
+        self.path = config['store_path']
+        self.commit_interval = config.get('store_commit_interval', 0.005)
+        self.segment_records = config.get('store_segment_records', 10000)
+        self.retry_interval = config.get('store_retry_interval', 1)
+        os.makedirs(self.path, exist_ok=True)
+
+        # `self.lock` guards the buffer, `self.write_lock` the files
+        self.lock = Condition(Lock())
+        self.write_lock = Lock()
+        self.buffer = []
+        self.closed = False
+        self.segment = None
+        self.segment_file = None
+        self.written = 0
+        self.thread = None
+        # Commits that failed, and whether the segment may end torn
+        self.failed = 0
+        self.torn = False
+
+    def segments(self):
+        """Returns the sequence numbers of the log segments on disk"""
+        found = []
+        for name in os.listdir(self.path):
+            match = SEGMENT_RE.match(name)
+            if match:
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    def segment_path(self, seq):
+        return os.path.join(self.path, SEGMENT_NAME.format(seq))
+
+    def load_snapshot(self, bot=OFFLINE_BOT):
+        """Returns ({game_id: ConnectPyGame}, last segment folded in)"""
+        try:
+            with open(os.path.join(self.path, SNAPSHOT_NAME)) as f:
+                snapshot = json.load(f)
+        except FileNotFoundError:
+            return {}, 0
+        games = {}
+        for state in snapshot['games']:
+            game = conn_py.ConnectPyGame.from_snapshot(state, bot=bot)
+            games[game.id] = game
+        return games, snapshot['segment']
+
+    def recover(self, bot=None):
+        """
+        Rebuilds the saved games from the snapshot and the segments written
+        since, then starts logging to a fresh segment. Returns the games in
+        creation order
+        """
+        games, folded = self.load_snapshot(bot=bot)
+        segments = self.segments()
+        for seq in segments:
+            if seq > folded:
+                for record in read_segment(self.segment_path(seq)):
+                    apply_record(games, record, bot=bot)
+        self.open_segment(max(segments + [folded]) + 1)
+        self.start()
+        return list(games.values())
+
+    def open_segment(self, seq):
+        with self.write_lock:
+            self.switch_segment(seq)
+
+    def switch_segment(self, seq):
+        """Closes the current segment and starts `seq`, under `write_lock`"""
+        if self.segment_file is not None:
+            self.segment_file.close()
+            self.segment_file = None
+        self.segment = seq
+        self.segment_file = open(self.segment_path(seq), 'a')
+        self.written = 0
+        self.torn = False
+        fsync_dir(self.path)
+
+    def start(self):
+        if self.segment_file is None:
+            self.open_segment(max(self.segments() + [0]) + 1)
+        if self.thread is None:
+            self.thread = Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def attach(self, game, new=True):
+        """
+        Logs every event `game` publishes from now on, preceded by its
+        creation if it's `new`
+        """
+        self.start()
+        if new:
+            self.append({
+                "type": "new",
+                "game": game.id,
+                "columns": game.columns,
+                "rows": game.rows,
+                "win_zone": game.win_zone
+            })
+        game.subscribe(lambda event: self.append(dict(event, game=game.id)))
+
+    def remove(self, game_id):
+        self.append({"type": "remove", "game": game_id})
+
+    def append(self, record):
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        with self.lock:
+            self.buffer.append(line)
+            self.lock.notify()
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.lock.wait_for(
+                    lambda: self.buffer or self.closed)
+                if self.closed and not self.buffer:
+                    return
+            # Let more records gather so they share one fsync
+            with self.lock:
+                self.lock.wait_for(lambda: self.closed, self.commit_interval)
+            try:
+                self.commit()
+                if self.written >= self.segment_records:
+                    self.rotate()
+            except Exception:
+                log.exception("Game log commit failed", extra=conn_log.fields(
+                    path=self.path, segment=self.segment,
+                    failed=self.failed))
+                # `close` makes the last attempt
+                with self.lock:
+                    if self.lock.wait_for(
+                            lambda: self.closed, self.retry_interval):
+                        return
+
+    def commit(self):
+        """
+        Writes and fsyncs the buffered records. If that fails they're put
+        back in the buffer and the error is raised
+        """
+        with self.write_lock:
+            with self.lock:
+                lines, self.buffer = self.buffer, []
+            if not lines:
+                return
+            try:
+                if self.torn or self.segment_file is None:
+                    self.switch_segment(self.segment + 1)
+                self.segment_file.write(''.join(lines))
+                self.segment_file.flush()
+                os.fsync(self.segment_file.fileno())
+            except Exception:
+                # Replay skips what's logged twice, by version
+                self.torn = True
+                with self.lock:
+                    self.buffer[:0] = lines
+                    self.failed += 1
+                conn_metrics.STORE_FAILED_COMMITS.set(self.failed)
+                raise
+            self.written += len(lines)
+
+    def rotate(self):
+        """
+        Starts a new segment and folds the full ones into the snapshot. The
+        snapshot is rebuilt from the log rather than the live games, so it's
+        consistent with the segments it replaces
+        """
+        self.open_segment(self.segment + 1)
+        games, folded = self.load_snapshot()
+        full = [seq for seq in self.segments()
+                if folded < seq < self.segment]
+        if not full:
+            return
+        for seq in full:
+            for record in read_segment(self.segment_path(seq)):
+                apply_record(games, record, bot=OFFLINE_BOT)
+
+        path = os.path.join(self.path, SNAPSHOT_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({
+                "segment": full[-1],
+                "games": [game.snapshot() for game in games.values()]
+            }, f, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        fsync_dir(self.path)
+        for seq in full:
+            os.remove(self.segment_path(seq))
+
+    def flush(self):
+        """Commits the buffered records now rather than on the next tick"""
+        if self.segment is not None:
+            self.commit()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        try:
+            self.flush()
+        finally:
+            with self.write_lock:
+                if self.segment_file is not None:
+                    self.segment_file.close()
+                    self.segment_file = None
+
+
+STORES = {
+    'log': LogStore,
+}
+
+
+def new_store(config):
+    """Returns the GameStore named by the `store` config, or None"""
+    name = config.get('store')
+    if not name:
+        return None
+    return STORES[name](config)
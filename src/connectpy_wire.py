@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+import gzip
+import json
+import struct
+
+# Compact binary form of `ConnectPyGame.dict`: a header, every field but
+# the grid as JSON, then the grid packed 2 bits per cell, 4 cells per byte,
+# row by row from the top
+MIMETYPE = 'application/vnd.connectpy.state'
+JSON_MIMETYPE = 'application/json'
+MAGIC = b'CPYS'
+FORMAT_VERSION = 1
+# magic, format version, rows, columns, length of the JSON fields
+HEADER = struct.Struct('<4sBHHI')
+# Payloads at least this long are gzipped for clients that accept it
+GZIP_MIN_SIZE = 1024
+
+
+class WireFormatException(Exception):
+    pass
+
+
+def pack_cells(grid):
+    """Returns the indicators in the nested list `grid` as 2-bit cells"""
+    cells = [cell for row in grid for cell in row]
+    cells.extend([0] * (-len(cells) % 4))
+    return bytes(
+        cells[idx] | cells[idx + 1] << 2 | cells[idx + 2] << 4 |
+        cells[idx + 3] << 6 for idx in range(0, len(cells), 4))
+
+
+def unpack_cells(data, rows, columns):
+    """Returns the nested list grid held in the 2-bit cells `data`"""
+    cells = [byte >> shift & 3 for byte in data for shift in (0, 2, 4, 6)]
+    return [cells[row_idx * columns:(row_idx + 1) * columns]
+            for row_idx in range(rows)]
+
+
+def encode(state):
+    """Returns the ConnectPyGame.dict `state` in the binary format"""
+    fields = json.dumps(
+        {key: value for key, value in state.items() if key != 'game'},
+        separators=(',', ':')).encode('utf-8')
+    rows, columns = (state['rows'], state['columns']) if state['game'] \
+        else (0, 0)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, rows, columns, len(fields)) + \
+        fields + pack_cells(state['game'])
+
+
+def decode(data):
+    """Returns the state dict held in the binary `data`"""
+    try:
+        magic, version, rows, columns, length = HEADER.unpack_from(data)
+    except struct.error:
+        raise WireFormatException("Truncated ConnectPy state")
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise WireFormatException("Not a ConnectPy state")
+    start = HEADER.size + length
+    state = json.loads(data[HEADER.size:start].decode('utf-8'))
+    state['game'] = unpack_cells(data[start:], rows, columns)
+    return state
+
+
+def accepts(header, mimetype):
+    """
+    Returns True if the Accept or Accept-Encoding `header` lists
+    `mimetype` (or encoding) with a non-zero quality
+    """
+    for item in (header or '').split(','):
+        params = item.strip().split(';')
+        if params[0].strip().lower() != mimetype:
+            continue
+        for param in params[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
+        return True
+    return False
+
+
+def negotiate(accept, accept_encoding, config):
+    """
+    Returns (binary, compress) for a request with the `accept` and
+    `accept_encoding` headers. Expect a `config` of the form:
+        wire_binary: true
+        wire_gzip: true
+    """
+    return (config.get('wire_binary', True) and accepts(accept, MIMETYPE),
+            config.get('wire_gzip', True) and
+            accepts(accept_encoding, 'gzip'))
+
+
+def encoded_state(game, binary=False, compress=False,
+                  min_size=GZIP_MIN_SIZE):
+    """
+    Returns (version, body, gzipped) for the full state of `game` as JSON,
+    or in the binary format if `binary`, gzipped if `compress` and at least
+    `min_size` bytes long. Each form is encoded once per game version
+    """
+    if binary:
+        version, body = game.encoded('binary', lambda game: encode(game.dict))
+    else:
+        version, body = game.serialized()
+        body = body.encode('utf-8')
+    if not compress or len(body) < min_size:
+        return version, body, False
+
+    key = 'binary.gzip' if binary else 'json.gzip'
+    version, body = game.encoded(key, lambda game: gzip.compress(
+        encoded_state(game, binary)[1], compresslevel=6))
+    return version, body, True
@@ -3,10 +3,29 @@
 
 import flask_testing
 import connectpy_server
+import connectpy_client
+import connectpy_loadtest
+import connectpy_bench
+import connectpy_batch
 import connectpy_game
+import connectpy_lobby
+import connectpy_log
+import connectpy_metrics
+import connectpy_wire
+import gzip
+import io
+import logging
 import unittest
+import json
+import sys
+import threading
+import random
+import time
 import os
+import pstats
+import tempfile
 import mock
+import urllib3
 
 
 class TestConnectpyServer(flask_testing.TestCase):
@@ -18,14 +37,27 @@ class TestConnectpyServer(flask_testing.TestCase):
 
     def setUp(self):
         self.mock_response = mock.Mock()
-        self.mock_game_obj = mock.Mock()
-        self.app.game = self.mock_game_obj
+        self.game = mock.Mock()
+        self.game.play_bots.return_value = False
+        self.app.lobby = mock.MagicMock()
+        self.app.lobby.get_game.return_value = self.game
+        self.app.lobby.waiting_game.return_value = self.game
+        self.app.lobby.locked.return_value.__enter__.return_value = self.game
+        self.app.lobby.wait_for_change.return_value = self.game
         self.player_id = 'deadbeef'
+        self.game_id = 'cafebabe'
+        self.move_data = {
+            'player_id': self.player_id, 'game_id': self.game_id, 'column': 1}
         self.client = self.app.test_client()
 
+    def set_state(self, data, version=1):
+        self.game.id = self.game_id
+        self.game.version = version
+        self.game.serialized.return_value = (version, json.dumps(data))
+
     def _test_not_joined(self, endpoint):
-        data = {'player_id': self.player_id, 'column': 1}
-        self.app.game.get_player_indicator.side_effect = \
+        data = self.move_data
+        self.game.get_player_indicator.side_effect = \
             connectpy_server.conn_py.PlayerInvalidException
         rv = self.client.post(endpoint, json=data)
         self.assertEqual(rv.status_code, 403)
@@ -42,6 +74,12 @@ class TestConnectpyServer(flask_testing.TestCase):
     def test_status_player_not_joined(self):
         self._test_not_joined('/status')
 
+    def test_status_game_not_found(self):
+        self.app.lobby.get_game.side_effect = \
+            connectpy_server.conn_lobby.GameNotFoundException
+        rv = self.client.post('/status', json=self.move_data)
+        self.assertEqual(rv.status_code, 404)
+
     def test_status_bad_mimetype(self):
         self._test_bad_mimetype('/status')
 
@@ -50,12 +88,34 @@ class TestConnectpyServer(flask_testing.TestCase):
 
     def test_status_ok(self):
         test_data = {'test': 'ok'}
-        self.app.game.dict = test_data
+        self.set_state(test_data)
 
-        rv = self.client.post('/status', json={'player_id': self.player_id})
+        rv = self.client.post('/status', json={
+            'player_id': self.player_id, 'game_id': self.game_id})
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.json, test_data)
 
+    def test_status_etag(self):
+        self.set_state({'test': 'ok'})
+        data = {'player_id': self.player_id, 'game_id': self.game_id}
+
+        rv = self.client.post('/status', json=data)
+        # Shared by every representation of the version, so weak
+        self.assertTrue(rv.headers['ETag'].startswith('W/'))
+        self.assertEqual(rv.headers['Vary'], 'Accept, Accept-Encoding')
+
+        rv = self.client.post('/status', json=data, headers={
+            'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        self.assertFalse(rv.data)
+        self.assertEqual(rv.headers['Vary'], 'Accept, Accept-Encoding')
+
+        self.set_state({'test': 'changed'}, version=2)
+        rv = self.client.post('/status', json=data, headers={
+            'If-None-Match': rv.headers['ETag']})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json, {'test': 'changed'})
+
     def test_join_required_fields(self):
         self._test_required_fields('/join', {})
 
@@ -63,29 +123,36 @@ class TestConnectpyServer(flask_testing.TestCase):
         self._test_bad_mimetype('/join')
 
     def test_join_game_started(self):
-        self.app.game.closed = False
-        self.app.game.started = True
-        self.app.game.players_ready = True
+        self.game.closed = False
+        self.game.started = True
+        self.game.players_ready = True
+
+        rv = self.client.post('/join', json={'player_id': self.player_id})
+        self.assertEqual(rv.status_code, 503)
+
+    def test_join_lobby_full(self):
+        self.app.lobby.waiting_game.side_effect = \
+            connectpy_server.conn_lobby.LobbyFullException
 
         rv = self.client.post('/join', json={'player_id': self.player_id})
         self.assertEqual(rv.status_code, 503)
 
     def test_join_game_already_joined(self):
-        self.app.game.closed = False
-        self.app.game.started = False
-        self.app.game.players_ready = False
-        self.app.game.add_player.side_effect = \
+        self.game.closed = False
+        self.game.started = False
+        self.game.players_ready = False
+        self.game.add_player.side_effect = \
             connectpy_server.conn_py.AlreadyJoinedException
 
         rv = self.client.post('/join', json={'player_id': self.player_id})
         self.assertEqual(rv.status_code, 409)
 
     def test_join_game_ok(self):
-        self.app.game.closed = False
-        self.app.game.started = False
-        self.app.game.players_ready = False
+        self.game.closed = False
+        self.game.started = False
+        self.game.players_ready = False
         test_data = {'test': 'ok'}
-        self.app.game.dict = test_data
+        self.set_state(test_data)
 
         rv = self.client.post('/join', json={'player_id': self.player_id})
         self.assertEqual(rv.status_code, 200)
@@ -101,47 +168,59 @@ class TestConnectpyServer(flask_testing.TestCase):
         self._test_required_fields('/move', {})
 
     def test_move_not_your_turn(self):
-        self.app.game.is_turn.return_value = False
+        self.game.is_turn.return_value = False
 
-        rv = self.client.post(
-            '/move', json={'player_id': self.player_id, 'column': 1})
+        rv = self.client.post('/move', json=self.move_data)
         self.assertEqual(rv.status_code, 420)
 
     def test_move_invalid(self):
-        self.app.game.is_turn.return_value = True
+        self.game.is_turn.return_value = True
 
         # Test FullColumnException
-        self.app.game.drop_disc.side_effect = \
+        self.game.drop_disc.side_effect = \
             connectpy_server.conn_py.FullColumnException
-        rv = self.client.post(
-            '/move', json={'player_id': self.player_id, 'column': 1})
+        rv = self.client.post('/move', json=self.move_data)
         self.assertEqual(rv.status_code, 400)
 
         # Test ColumnOutOfBoundsException
-        self.app.game.drop_disc.side_effect = \
+        self.game.drop_disc.side_effect = \
             connectpy_server.conn_py.ColumnOutOfBoundsException
-        rv = self.client.post(
-            '/move', json={'player_id': self.player_id, 'column': 1})
+        rv = self.client.post('/move', json=self.move_data)
         self.assertEqual(rv.status_code, 400)
 
     def test_move_ok(self):
-        self.app.game.is_turn.return_value = True
+        self.game.is_turn.return_value = True
         test_data = {'test': 'ok'}
-        self.app.game.dict = test_data
+        self.set_state(test_data)
 
         # Test normal move
-        self.app.game.drop_disc.return_value = False
-        rv = self.client.post(
-            '/move', json={'player_id': self.player_id, 'column': 1})
+        self.game.drop_disc.return_value = False
+        rv = self.client.post('/move', json=self.move_data)
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.json, test_data)
 
         # Test winning move
-        self.app.game.drop_disc.return_value = True
-        rv = self.client.post(
-            '/move', json={'player_id': self.player_id, 'column': 1})
+        self.game.drop_disc.return_value = True
+        rv = self.client.post('/move', json=self.move_data)
         self.assertEqual(rv.status_code, 200)
-        self.app.game.reset_game.assert_called_once()
+        self.game.reset_game.assert_called_once()
+
+    def test_hints_player_not_joined(self):
+        self._test_not_joined('/hints')
+
+    def test_hints_required_fields(self):
+        self._test_required_fields('/hints', {'player_id': self.player_id})
+
+    def test_hints_ok(self):
+        self.game.id = self.game_id
+        self.game.hints.return_value = {
+            "version": 3, "wins": [2], "blocks": [5]}
+        rv = self.client.post('/hints', json=self.move_data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json, {
+            "game_id": self.game_id, "player_id": self.player_id,
+            "version": 3, "wins": [2], "blocks": [5]})
+        self.game.hints.assert_called_once_with(self.player_id)
 
     def test_close_player_not_joined(self):
         self._test_not_joined('/close')
@@ -154,13 +233,866 @@ class TestConnectpyServer(flask_testing.TestCase):
 
     def test_close_ok(self):
         test_data = {'test': 'ok'}
-        self.app.game.dict = test_data
+        self.set_state(test_data)
 
-        rv = self.client.post('/close', json={'player_id': self.player_id})
+        rv = self.client.post('/close', json={
+            'player_id': self.player_id, 'game_id': self.game_id})
         self.assertEqual(rv.status_code, 200)
         self.assertEqual(rv.json, test_data)
 
 
+class TestConnectpyLobbyServer(flask_testing.TestCase):
+
+    def create_app(self):
+        self.dir = os.path.dirname(os.path.abspath(__file__))
+        os.environ['CONNECTPY_SETTINGS'] = os.path.join(self.dir, 'test.cfg')
+        return connectpy_server.create_app()
+
+    def setUp(self):
+        self.client = self.app.test_client()
+
+    def join(self, player_id):
+        return self.client.post('/join', json={'player_id': player_id}).json
+
+    def test_matchmaking(self):
+        first = self.join('a')
+        self.assertFalse(first['started'])
+        second = self.join('b')
+        self.assertEqual(first['game_id'], second['game_id'])
+        self.assertTrue(second['started'])
+
+        # A third player is paired into a new game instead of a 503
+        third = self.join('a')
+        self.assertNotEqual(first['game_id'], third['game_id'])
+        fourth = self.join('c')
+        self.assertEqual(third['game_id'], fourth['game_id'])
+        self.assertEqual(len(self.app.lobby), 2)
+
+    def test_routing_by_game_id(self):
+        game_id = self.join('a')['game_id']
+        state = self.join('b')
+        other_game_id = self.join('c')['game_id']
+
+        rv = self.client.post('/move', json={
+            'player_id': state['turn'], 'game_id': game_id, 'column': 0})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['last_drop'], [rv.json['rows'] - 1, 0])
+
+        rv = self.client.post('/status', json={
+            'player_id': 'a', 'game_id': other_game_id})
+        self.assertEqual(rv.status_code, 403)
+        rv = self.client.post('/status', json={
+            'player_id': 'c', 'game_id': other_game_id})
+        self.assertEqual(rv.status_code, 200)
+        self.assertIsNone(rv.json['last_drop'])
+
+    def test_status_long_poll_timeout(self):
+        state = self.join('a')
+        data = {'player_id': 'a', 'game_id': state['game_id'],
+                'version': state['version'], 'wait': 0.1}
+
+        started = time.monotonic()
+        rv = self.client.post('/status', json=data)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(rv.json['version'], state['version'])
+
+        data['wait'] = 'soon'
+        rv = self.client.post('/status', json=data)
+        self.assertEqual(rv.status_code, 400)
+
+    def test_status_long_poll_stale_version(self):
+        state = self.join('a')
+        self.join('b')
+
+        started = time.monotonic()
+        rv = self.client.post('/status', json={
+            'player_id': 'a', 'game_id': state['game_id'],
+            'version': state['version'], 'wait': 5})
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertGreater(rv.json['version'], state['version'])
+
+    def test_status_long_poll_wakes_on_join(self):
+        state = self.join('a')
+        results = []
+
+        def poll():
+            client = self.app.test_client()
+            results.append(client.post('/status', json={
+                'player_id': 'a', 'game_id': state['game_id'],
+                'version': state['version'], 'wait': 5}).json)
+
+        poller = threading.Thread(target=poll)
+        poller.start()
+        time.sleep(0.05)
+        self.join('b')
+        poller.join(timeout=5)
+
+        self.assertEqual(len(results), 1)
+        self.assertIn('b', results[0]['players'])
+
+    def test_events_stream(self):
+        game_id = self.join('a')['game_id']
+        rv = self.client.post(
+            '/events', json={'player_id': 'a', 'game_id': game_id},
+            buffered=False)
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        events = connectpy_client.parse_events(
+            line for chunk in rv.response
+            for line in chunk.decode().split('\n'))
+
+        state = next(events)
+        self.assertEqual(state['type'], 'state')
+        client = connectpy_client.PlayerClient('a', 'http://localhost')
+        client.apply_event(state)
+
+        turn = self.join('b')['turn']
+        for column in (0, 1, 0):
+            turn = self.client.post('/move', json={
+                'player_id': turn, 'game_id': game_id,
+                'column': column}).json['turn']
+        self.client.post('/close', json={'player_id': 'b', 'game_id': game_id})
+
+        received = list(events)
+        self.assertEqual([event['type'] for event in received], [
+            'join', 'reset', 'start', 'drop', 'drop', 'drop', 'close'])
+        for event in received:
+            client.apply_event(event)
+
+        rv = self.client.post('/status', json={
+            'player_id': 'a', 'game_id': game_id})
+        self.assertEqual(client.game_state, rv.json)
+
+    def test_delta_responses(self):
+        game_id = self.join('a')['game_id']
+        state = self.join('b')
+        version = state['version']
+
+        rv = self.client.post('/move', json={
+            'player_id': state['turn'], 'game_id': game_id, 'column': 2,
+            'since': version})
+        self.assertNotIn('game', rv.json)
+        self.assertEqual(rv.json['since'], version)
+        self.assertEqual(rv.json['version'], version + 1)
+        self.assertEqual(
+            [event['type'] for event in rv.json['events']], ['drop'])
+
+        # Unknown versions fall back to the full state
+        rv = self.client.post('/status', json={
+            'player_id': 'a', 'game_id': game_id, 'since': version + 10})
+        self.assertIn('game', rv.json)
+
+    def test_client_applies_deltas(self):
+        session = FakeSession(self.client)
+        players = [connectpy_client.PlayerClient(player_id, '', session)
+                   for player_id in ('a', 'b')]
+        for player in players:
+            player.join_server()
+        players[0].update_status()
+        for column in (0, 1, 1, 3):
+            player = next(p for p in players if p.can_move)
+            player.make_move(column)
+            for player in players:
+                player.update_status()
+
+        rv = self.client.post('/status', json={
+            'player_id': 'a', 'game_id': players[0].game_id})
+        for player in players:
+            self.assertEqual(player.game_state, rv.json)
+
+    def test_binary_responses(self):
+        self.join('a')
+        state = self.join('b')
+        data = {'player_id': 'a', 'game_id': state['game_id']}
+        headers = {'Accept': connectpy_wire.MIMETYPE}
+        rv = self.client.post('/status', json=data, headers=headers)
+        self.assertEqual(rv.mimetype, connectpy_wire.MIMETYPE)
+        self.assertEqual(connectpy_wire.decode(rv.data), state)
+
+        self.app.config['wire_gzip_min_size'] = 0
+        headers['Accept-Encoding'] = 'gzip'
+        rv = self.client.post('/status', json=data, headers=headers)
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(
+            connectpy_wire.decode(gzip.decompress(rv.data)), state)
+
+        # Clients that don't ask for it get JSON
+        rv = self.client.post('/status', json=data)
+        self.assertEqual(rv.json, state)
+
+    def test_bot_opponent(self):
+        state = self.client.post('/join', json={
+            'player_id': 'a', 'opponent': 'bot'}).json
+        self.assertTrue(state['started'])
+        self.assertIn(connectpy_server.BOT_PLAYER_ID, state['players'])
+        self.assertEqual(state['turn'], 'a')
+
+        rv = self.client.post('/move', json={
+            'player_id': 'a', 'game_id': state['game_id'], 'column': 0})
+        self.assertEqual(rv.json['turn'], 'a')
+        self.assertEqual(
+            sum(cell != 0 for row in rv.json['game'] for cell in row), 2)
+
+        rv = self.client.post('/join', json={
+            'player_id': connectpy_server.BOT_PLAYER_ID, 'opponent': 'bot'})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_metrics(self):
+        self.join('a')
+        state = self.join('b')
+        self.client.post('/move', json={
+            'player_id': state['turn'], 'game_id': state['game_id'],
+            'column': 0})
+        self.client.post('/status', json={'player_id': 'a'})
+
+        rv = self.client.get('/metrics')
+        self.assertEqual(rv.content_type, connectpy_metrics.CONTENT_TYPE)
+        lines = rv.data.decode().split('\n')
+        self.assertIn('connectpy_active_games 1', lines)
+        self.assertIn('connectpy_active_players 2', lines)
+        samples = dict(line.rsplit(' ', 1) for line in lines
+                       if line and not line.startswith('#'))
+        self.assertGreaterEqual(int(samples[
+            'connectpy_request_seconds_count{endpoint="/join",status="200"}'
+        ]), 2)
+        self.assertIn(
+            'connectpy_request_seconds_count{endpoint="/status",status="400"}',
+            samples)
+        self.assertIn('connectpy_response_bytes_count{endpoint="/move"}',
+                      samples)
+        self.assertGreater(int(samples['connectpy_drop_disc_seconds_count']),
+                           0)
+        self.assertGreater(int(samples['connectpy_is_winner_seconds_count']),
+                           0)
+
+    def test_load_harness(self):
+        report = connectpy_loadtest.run_load(
+            2, app=self.app, moves=3, policy='center', poll_wait=1,
+            wait_timeout=5, ramp_up=0.2, seed=1)
+
+        self.assertEqual(report["players"], 2)
+        self.assertEqual(report["player_errors"], {})
+        endpoints = report["endpoints"]
+        self.assertEqual(endpoints["/join"]["codes"], {"200": 2})
+        # The first mover closes after its third move, which may land
+        # before or after the reply
+        self.assertIn(endpoints["/move"]["count"], (5, 6))
+        self.assertEqual(list(endpoints["/close"]["codes"]), ["200"])
+        self.assertEqual(report["requests"], sum(
+            stats["count"] for stats in endpoints.values()))
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(connectpy_loadtest.percentile(values, 50), 50)
+        self.assertEqual(connectpy_loadtest.percentile(values, 99), 99)
+        self.assertEqual(connectpy_loadtest.percentile([3], 90), 3)
+        self.assertIsNone(connectpy_loadtest.percentile([], 90))
+
+
+class TestConnectpyProfiler(flask_testing.TestCase):
+
+    def create_app(self):
+        self.dir = os.path.dirname(os.path.abspath(__file__))
+        os.environ['CONNECTPY_SETTINGS'] = os.path.join(self.dir, 'test.cfg')
+        app = connectpy_server.create_app()
+        app.config.update({"profile_token": "s3cret",
+                           "profile_retention": 2})
+        connectpy_server.install_profiler(app)
+        return app
+
+    def setUp(self):
+        self.client = self.app.test_client()
+        self.headers = {'X-Connectpy-Profile': 's3cret'}
+
+    def test_disabled(self):
+        app = connectpy_server.create_app()
+        self.assertFalse(app.profiler.enabled)
+        self.assertNotIn(connectpy_server.start_profile,
+                         app.before_request_funcs.get(None, []))
+
+    def test_profile_header(self):
+        self.client.post('/join', json={'player_id': 'a'})
+        self.assertEqual(self.app.profiler.summary(), {})
+        for player_id in ('b', 'c', 'd'):
+            self.client.post('/join', json={'player_id': player_id},
+                             headers=self.headers)
+
+        rv = self.client.get('/admin/profiles')
+        self.assertEqual(rv.status_code, 403)
+        rv = self.client.get('/admin/profiles', headers=self.headers)
+        # Only the newest `profile_retention` profiles are kept
+        self.assertEqual(rv.json, {'/join': 2})
+
+        rv = self.client.get('/admin/profiles?endpoint=/join',
+                             headers=self.headers)
+        self.assertEqual(rv.mimetype, 'text/plain')
+        self.assertIn('join_game', rv.data.decode())
+        rv = self.client.get('/admin/profiles?endpoint=/move',
+                             headers=self.headers)
+        self.assertEqual(rv.status_code, 404)
+
+        rv = self.client.get('/admin/profiles?endpoint=/join&format=pstats',
+                             headers=self.headers)
+        self.assertEqual(rv.mimetype, 'application/octet-stream')
+        with tempfile.NamedTemporaryFile() as f:
+            f.write(rv.data)
+            f.flush()
+            stats = pstats.Stats(f.name)
+        self.assertTrue(any(func[2] == 'add_player' for func in stats.stats))
+
+    def test_sample_rate(self):
+        profiler = connectpy_server.conn_profile.RequestProfiler(
+            {"profile_sample_rate": 1.0})
+        self.assertTrue(profiler.enabled)
+        self.assertFalse(profiler.authorized({}))
+        profile = profiler.start({})
+        # One request is profiled at a time
+        self.assertIsNone(profiler.start({}))
+        profiler.stop(profile, '/status')
+        self.assertEqual(profiler.summary(), {'/status': 1})
+
+    def test_profile_token(self):
+        profiler = connectpy_server.conn_profile.RequestProfiler(
+            {"profile_token": "s3cret"})
+        header = profiler.header
+        self.assertTrue(profiler.authorized({header: 's3cret'}))
+        for value in ('s3cre', 's3crets', 'sécret', ''):
+            self.assertFalse(profiler.authorized({header: value}))
+        self.assertFalse(profiler.authorized({}))
+
+
+class TestConnectpyConcurrency(flask_testing.TestCase):
+
+    def create_app(self):
+        self.dir = os.path.dirname(os.path.abspath(__file__))
+        os.environ['CONNECTPY_SETTINGS'] = os.path.join(self.dir, 'test.cfg')
+        return connectpy_server.create_app()
+
+    def setUp(self):
+        # Switch threads as often as possible to shake out races
+        self.switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+
+    def tearDown(self):
+        sys.setswitchinterval(self.switch_interval)
+
+    def run_player(self, player_id, moves, results):
+        client = self.app.test_client()
+        rng = random.Random(player_id)
+        state = client.post('/join', json={'player_id': player_id}).json
+        data = {'player_id': player_id, 'game_id': state['game_id']}
+        accepted = []
+
+        def play():
+            # Each player sends moves from two threads at once, as a
+            # client retrying a slow request would
+            client = self.app.test_client()
+            for _ in range(moves):
+                rv = client.post('/move', json=dict(
+                    data, column=rng.randrange(state['columns'])))
+                accepted.append(rv.status_code == 200)
+                client.post('/status', json=data)
+
+        movers = [threading.Thread(target=play) for _ in range(2)]
+        for mover in movers:
+            mover.start()
+        for mover in movers:
+            mover.join(timeout=60)
+        results[player_id] = (state['game_id'], sum(accepted))
+
+    def test_stress(self):
+        players, moves = 32, 25
+        results = {}
+        threads = [threading.Thread(
+            target=self.run_player, args=(str(idx), moves, results))
+            for idx in range(players)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=60)
+
+        self.assertEqual(len(results), players)
+        # Every join found a seat and every game has exactly two players
+        games = self.app.lobby.games
+        self.assertEqual(len(games), players // 2)
+        seated = [p for game in games.values() for p in game.players]
+        self.assertEqual(sorted(seated), sorted(results))
+
+        for game in games.values():
+            self.assertEqual([e['version'] for e in game.log],
+                             list(range(1, game.version + 1)))
+            drops = [e for e in game.log if e['type'] == 'drop']
+            # Only moves acknowledged with a 200 were played, in turn
+            self.assertEqual(len(drops), sum(
+                accepted for game_id, accepted in results.values()
+                if game_id == game.id))
+            for previous, drop in zip(drops, drops[1:]):
+                self.assertNotEqual(previous['player'], drop['player'])
+
+            # The boards don't overlap and agree with the column heights
+            first, second = game.boards[1], game.boards[2]
+            self.assertFalse(first & second)
+            self.assertLessEqual(abs(bin(first).count('1') -
+                                     bin(second).count('1')), 1)
+            for column, height in enumerate(game.heights):
+                column_bits = (first | second) >> (column * game.stride) & \
+                    ((1 << game.stride) - 1)
+                self.assertEqual(column_bits, (1 << height) - 1)
+
+    def test_status_does_not_block(self):
+        client = self.app.test_client()
+        state = client.post('/join', json={'player_id': 'a'}).json
+        client.post('/join', json={'player_id': 'b'})
+        game = self.app.lobby.get_game(state['game_id'])
+
+        # Hold the game as a slow move would, /status still answers
+        with game.lock:
+            result = []
+            poller = threading.Thread(target=lambda: result.append(
+                self.app.test_client().post('/status', json={
+                    'player_id': 'a', 'game_id': game.id})))
+            poller.start()
+            poller.join(timeout=2)
+            self.assertEqual(result[0].status_code, 200)
+            self.assertTrue(result[0].json['started'])
+
+
+class FakeSession(object):
+    """Sends requests.Session style POSTs to a Flask test client"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def post(self, url, json=None, headers=None, timeout=None):
+        return FakeResponse(self.client.post(url, json=json, headers=headers))
+
+
+class FakeResponse(object):
+    """Wraps a Flask test response in the parts of the requests API used"""
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.content = response.data
+
+    def __bool__(self):
+        return self.status_code < 400
+
+    def json(self):
+        return self.response.json
+
+
+class TestPlayerClient(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.Mock()
+        self.client = connectpy_client.PlayerClient(
+            'a', 'http://localhost', session=self.session, max_retries=2,
+            backoff_factor=0.5, backoff_max=1)
+
+    @mock.patch.object(connectpy_client.time, 'sleep')
+    def test_retry_server_error(self, sleep):
+        self.session.post.side_effect = [
+            mock.Mock(status_code=502), mock.Mock(status_code=200)]
+        resp = self.client.post('/status', json={})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.session.post.call_count, 2)
+        self.assertEqual(sleep.call_count, 1)
+
+    @mock.patch.object(connectpy_client.time, 'sleep')
+    def test_retry_gives_up(self, sleep):
+        self.session.post.side_effect = \
+            connectpy_client.requests.ConnectionError
+        with self.assertRaises(connectpy_client.requests.ConnectionError):
+            self.client.post('/status', json={})
+        self.assertEqual(self.session.post.call_count, 3)
+
+        self.session.post.side_effect = None
+        self.session.post.return_value = mock.Mock(status_code=503)
+        resp = self.client.post('/join', json={})
+        self.assertEqual(resp.status_code, 503)
+
+    @mock.patch.object(connectpy_client.time, 'sleep')
+    def test_retry_unsafe(self, sleep):
+        # The server may have applied a move that timed out or failed
+        requests = connectpy_client.requests
+        for error in (requests.ReadTimeout, mock.Mock(status_code=502)):
+            self.session.post.reset_mock()
+            self.session.post.side_effect = [error, mock.Mock(status_code=200)]
+            try:
+                resp = self.client.post('/move', json={})
+            except requests.ReadTimeout:
+                pass
+            else:
+                self.assertEqual(resp.status_code, 502)
+            self.assertEqual(self.session.post.call_count, 1)
+
+        # A connection that was never made sent nothing
+        errors = urllib3.exceptions
+        refused = requests.ConnectionError(errors.MaxRetryError(
+            None, '/move', errors.NewConnectionError(None, 'refused')))
+        self.session.post.reset_mock()
+        self.session.post.side_effect = [
+            requests.ConnectTimeout, refused, mock.Mock(status_code=200)]
+        resp = self.client.post('/move', json={})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.session.post.call_count, 3)
+
+        # A stale keep-alive connection dropped after the move was sent
+        aborted = requests.ConnectionError(errors.ProtocolError(
+            'Connection aborted.', ConnectionResetError()))
+        self.session.post.reset_mock()
+        self.session.post.side_effect = [aborted, mock.Mock(status_code=200)]
+        with self.assertRaises(requests.ConnectionError):
+            self.client.post('/move', json={})
+        self.assertEqual(self.session.post.call_count, 1)
+
+        self.session.post.reset_mock()
+        self.session.post.side_effect = [
+            requests.ReadTimeout, mock.Mock(status_code=200)]
+        resp = self.client.post('/status', json={})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.session.post.call_count, 2)
+
+    def test_no_retry_client_error(self):
+        self.session.post.return_value = mock.Mock(status_code=420)
+        self.client.post('/move', json={})
+        self.assertEqual(self.session.post.call_count, 1)
+
+    def test_long_poll_timeout(self):
+        self.session.post.return_value = mock.Mock(status_code=200)
+        self.client.post('/status', wait=10, json={})
+        self.assertEqual(self.session.post.call_args[1]['timeout'],
+                         (self.client.connect_timeout,
+                          self.client.read_timeout + 10))
+
+    def test_backoff(self):
+        for attempt in range(5):
+            delay = self.client.backoff(attempt)
+            self.assertTrue(0 <= delay <= min(1, 0.5 * 2 ** attempt))
+
+
+class TestBoardRenderer(unittest.TestCase):
+
+    def setUp(self):
+        self.state = {
+            "game_id": "cafebabe",
+            "version": 3,
+            "rows": 3,
+            "columns": 10,
+            "last_drop": None,
+            "game": [[0] * 10 for _ in range(3)]
+        }
+
+    def drop(self, state, row_idx, column_idx, indicator, versions=1):
+        grid = [list(row) for row in state["game"]]
+        grid[row_idx][column_idx] = indicator
+        return dict(state, game=grid, last_drop=[row_idx, column_idx],
+                    version=state["version"] + versions)
+
+    def test_layout(self):
+        self.assertEqual(connectpy_client.printable_grid(self.state).split(
+            '\n')[-1], ' '.join(
+            ['[ {} ]'.format(n) for n in range(1, 10)] + ['[ 10 ]']))
+        offsets = connectpy_client.board_layout(10)[2]
+        self.assertEqual(offsets[:2], [0, 6])
+        self.assertEqual(offsets[9], 54)
+
+    def test_not_a_tty(self):
+        out = io.StringIO()
+        renderer = connectpy_client.BoardRenderer(stream=out)
+        self.assertTrue(renderer.render(self.state))
+        self.assertFalse(renderer.render(dict(self.state)))
+        state = self.drop(self.state, 2, 9, 1)
+        self.assertTrue(renderer.render(state))
+        self.assertNotIn('\x1b', out.getvalue())
+        self.assertEqual(out.getvalue().split('\n')[6],
+                         ' '.join(['[   ]'] * 9 + ['[ x ] ']))
+
+    def test_tty_redraws_changed_cells(self):
+        out = io.StringIO()
+        renderer = connectpy_client.BoardRenderer(stream=out, tty=True)
+        renderer.render(self.state)
+        self.assertTrue(out.getvalue().startswith('\x1b[H\x1b[2J'))
+
+        # One drop, found from last_drop
+        out.truncate(0)
+        out.seek(0)
+        state = self.drop(self.state, 2, 9, 1)
+        renderer.render(state)
+        self.assertEqual(out.getvalue(), '\x1b[3;55H[ x ]\x1b[5;1H\x1b[J')
+
+        # Two drops since the last frame, found by comparing rows
+        out.truncate(0)
+        out.seek(0)
+        state = self.drop(self.drop(state, 2, 0, 2), 1, 9, 1, versions=2)
+        renderer.render(state)
+        self.assertEqual(out.getvalue(), '\x1b[2;55H[ x ]\x1b[3;1H[ o ]'
+                         '\x1b[5;1H\x1b[J')
+
+        # A new game redraws the whole board
+        out.truncate(0)
+        out.seek(0)
+        renderer.render(dict(self.state, game_id="deadbeef"))
+        self.assertTrue(out.getvalue().startswith('\x1b[H\x1b[2J'))
+
+    @mock.patch.object(connectpy_client.shutil, 'get_terminal_size')
+    def test_tty_shorter_than_board(self, get_terminal_size):
+        # The board and the line below it don't fit, so the top row has
+        # scrolled out of reach of cursor addressing
+        get_terminal_size.return_value = os.terminal_size((80, 4))
+        out = io.StringIO()
+        renderer = connectpy_client.BoardRenderer(stream=out, tty=True)
+        renderer.render(self.state)
+        out.truncate(0)
+        out.seek(0)
+        renderer.render(self.drop(self.state, 2, 9, 1))
+        self.assertTrue(out.getvalue().startswith('\x1b[H\x1b[2J'))
+
+
+class TestConnectpyBench(unittest.TestCase):
+
+    def test_run_benchmarks(self):
+        results = connectpy_bench.run_benchmarks(
+            configs=[(7, 6, 4), (9, 6, 5)], repeat=1)
+        self.assertEqual(list(results), list(connectpy_bench.BENCHMARKS))
+        for timings in results.values():
+            self.assertEqual(list(timings), ["7x6/4", "9x6/5"])
+            self.assertTrue(all(t > 0 for t in timings.values()))
+
+    def test_run_ai_benchmark(self):
+        results = connectpy_bench.run_ai_benchmark(
+            configs=[((7, 6, 4), 3)], tt_size=1 << 10)
+        self.assertEqual(results["7x6/4"]["depth"], 3)
+        self.assertGreater(results["7x6/4"]["nps"], 0)
+
+    def test_run_server_benchmark(self):
+        results = connectpy_bench.run_server_benchmark(idle=20, requests=10)
+        self.assertEqual(list(results), ["flask", "asgi"])
+        self.assertEqual(results["flask"]["threads"], 20)
+        self.assertLess(results["asgi"]["threads"], 20)
+        for stats in results.values():
+            self.assertGreater(stats["requests/s"], 0)
+
+    def test_compare_results(self):
+        baseline = {"drop_disc": {"7x6/4": 1.0, "9x6/5": 1.0}}
+        results = {"drop_disc": {"7x6/4": 1.1, "9x6/5": 1.5},
+                   "dict": {"7x6/4": 9.0}}
+        self.assertEqual(
+            connectpy_bench.compare_results(results, baseline, 0.2),
+            [("drop_disc", "9x6/5", 1.0, 1.5)])
+
+
+@unittest.skipIf(connectpy_batch.np is None, "numpy not installed")
+class TestConnectpyWire(unittest.TestCase):
+
+    def setUp(self):
+        self.game = connectpy_game.ConnectPyGame(
+            {"game_columns": 30, "game_rows": 30, "win_zone": 8},
+            game_id="cafebabe")
+        self.game.add_player("a")
+        self.game.add_player("b")
+        self.game.start_game()
+        for column in (0, 1, 29, 29, 7):
+            self.game.drop_disc(self.game.current_turn, column)
+
+    def test_round_trip(self):
+        state = json.loads(json.dumps(self.game.dict))
+        encoded = connectpy_wire.encode(self.game.dict)
+        self.assertEqual(connectpy_wire.decode(encoded), state)
+        self.assertLess(len(encoded), len(self.game.serialized()[1]) / 4)
+
+        empty = connectpy_game.ConnectPyGame({}, game_id="deadbeef")
+        self.assertEqual(
+            connectpy_wire.decode(connectpy_wire.encode(empty.dict)),
+            json.loads(json.dumps(empty.dict)))
+        with self.assertRaises(connectpy_wire.WireFormatException):
+            connectpy_wire.decode(b'{"game_id": "cafebabe"}')
+
+    def test_accepts(self):
+        mimetype = connectpy_wire.MIMETYPE
+        self.assertTrue(connectpy_wire.accepts(
+            mimetype + ', application/json;q=0.5', mimetype))
+        self.assertFalse(connectpy_wire.accepts(
+            mimetype + ';q=0, application/json', mimetype))
+        self.assertFalse(connectpy_wire.accepts('*/*', mimetype))
+        self.assertFalse(connectpy_wire.accepts(None, mimetype))
+        self.assertTrue(connectpy_wire.accepts('gzip, deflate', 'gzip'))
+
+    def test_encoded_state(self):
+        version, body, gzipped = connectpy_wire.encoded_state(
+            self.game, binary=True, compress=True, min_size=1 << 20)
+        self.assertFalse(gzipped)
+        self.assertEqual(connectpy_wire.decode(body)['version'], version)
+
+        version, body, gzipped = connectpy_wire.encoded_state(
+            self.game, compress=True, min_size=0)
+        self.assertTrue(gzipped)
+        self.assertEqual(json.loads(gzip.decompress(body))['version'],
+                         version)
+        # Each form is encoded once per version
+        self.assertIs(connectpy_wire.encoded_state(
+            self.game, compress=True, min_size=0)[1], body)
+        self.game.drop_disc(self.game.current_turn, 3)
+        self.assertIsNot(connectpy_wire.encoded_state(
+            self.game, compress=True, min_size=0)[1], body)
+
+
+class TestConnectpyMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = connectpy_metrics.Histogram(
+            'latency_seconds', 'Latency', labels=('endpoint',),
+            buckets=(0.1, 1))
+        histogram.observe(0.05, '/join')
+        histogram.observe(0.5, '/join')
+        histogram.observe(5, '/join')
+        histogram.observe(1, '/"move"')
+        self.assertEqual(histogram.render(), [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{endpoint="/\\"move\\"",le="0.1"} 0',
+            'latency_seconds_bucket{endpoint="/\\"move\\"",le="1"} 1',
+            'latency_seconds_bucket{endpoint="/\\"move\\"",le="+Inf"} 1',
+            'latency_seconds_sum{endpoint="/\\"move\\""} 1',
+            'latency_seconds_count{endpoint="/\\"move\\""} 1',
+            'latency_seconds_bucket{endpoint="/join",le="0.1"} 1',
+            'latency_seconds_bucket{endpoint="/join",le="1"} 2',
+            'latency_seconds_bucket{endpoint="/join",le="+Inf"} 3',
+            'latency_seconds_sum{endpoint="/join"} 5.55',
+            'latency_seconds_count{endpoint="/join"} 3'])
+
+    def test_registry(self):
+        registry = connectpy_metrics.Registry()
+        gauge = registry.gauge('games', 'Games')
+        self.assertEqual(registry.render(),
+                         '# HELP games Games\n# TYPE games gauge\n')
+        gauge.set(3)
+        self.assertTrue(registry.render().endswith('games 3\n'))
+
+    def test_json_log_format(self):
+        record = logging.LogRecord(
+            'connectpy.server', logging.INFO, __file__, 1, "Game started",
+            None, None)
+        record.fields = {'game_id': 'cafebabe'}
+        entry = json.loads(connectpy_log.JSONFormatter().format(record))
+        self.assertEqual(entry['message'], "Game started")
+        self.assertEqual(entry['level'], "INFO")
+        self.assertEqual(entry['game_id'], "cafebabe")
+
+
+class TestConnectpyBatch(unittest.TestCase):
+
+    def test_winners(self):
+        boards = [
+            [[0, 0, 0, 0, 0],
+             [0, 0, 0, 0, 0],
+             [2, 2, 2, 0, 0],
+             [1, 1, 1, 1, 0]],
+            [[0, 0, 0, 0, 0],
+             [0, 0, 0, 2, 0],
+             [0, 0, 2, 1, 0],
+             [0, 2, 1, 1, 0]],
+            [[1, 0, 0, 0, 0],
+             [1, 0, 0, 0, 0],
+             [1, 2, 0, 0, 0],
+             [2, 2, 0, 0, 0]],
+            [[0, 0, 0, 0, 0],
+             [0, 0, 0, 0, 0],
+             [0, 0, 0, 0, 0],
+             [0, 0, 0, 0, 0]],
+        ]
+        self.assertEqual(
+            connectpy_batch.winners(boards, 3).tolist(), [1, 2, 1, 0])
+        self.assertEqual(
+            connectpy_batch.winners(boards, 4).tolist(), [1, 0, 0, 0])
+
+    def test_matches_is_winner(self):
+        for columns, rows, win_zone in ((7, 6, 4), (9, 6, 5), (5, 8, 3)):
+            boards = connectpy_batch.random_boards(
+                300, rows, columns, seed=columns)
+            game = connectpy_bench.new_game(columns, rows, win_zone)
+            self.assertEqual(
+                connectpy_batch.winners(boards, win_zone).tolist(),
+                connectpy_bench.scalar_winners(game, boards.tolist()))
+            found = connectpy_batch.has_chains(boards, 2, win_zone)
+            for board, has_chain in zip(boards.tolist(), found):
+                self.assertEqual(
+                    has_chain, brute_force_winner(board, 2, win_zone))
+
+    def test_win_zone_larger_than_board(self):
+        boards = connectpy_batch.stack_grids([[[1, 1, 1]]])
+        self.assertEqual(connectpy_batch.winners(boards, 4).tolist(), [0])
+
+    def test_run_batch_benchmark(self):
+        results = connectpy_bench.run_batch_benchmark(
+            configs=[(7, 6, 4)], count=50)
+        self.assertEqual(results["7x6/4"]["boards"], 50)
+        self.assertGreater(results["7x6/4"]["batch"], 0)
+
+
+class TestConnectpyLobby(unittest.TestCase):
+
+    def setUp(self):
+        self.lobby = connectpy_lobby.ConnectPyLobby({
+            "max_games": 3,
+            "game_idle_timeout": 60,
+            "closed_game_timeout": 5
+        })
+
+    def test_waiting_game(self):
+        game = self.lobby.waiting_game()
+        self.assertIs(self.lobby.waiting_game(), game)
+        game.add_player("a")
+        game.add_player("b")
+        self.assertIsNot(self.lobby.waiting_game(), game)
+
+        closed = self.lobby.waiting_game()
+        closed.close("c")
+        self.assertIsNot(self.lobby.waiting_game(), closed)
+
+    def test_get_game(self):
+        game = self.lobby.new_game()
+        self.assertIs(self.lobby.get_game(game.id), game)
+        with self.assertRaises(connectpy_lobby.GameNotFoundException):
+            self.lobby.get_game("missing")
+
+    def test_lobby_full(self):
+        for _ in range(self.lobby.max_games):
+            self.lobby.new_game()
+        with self.assertRaises(connectpy_lobby.LobbyFullException):
+            self.lobby.new_game()
+
+    def test_evict(self):
+        idle, closed, active = [self.lobby.new_game() for _ in range(3)]
+        closed.close("a")
+        now = self.lobby.last_active[active.id]
+
+        # Closed games expire first, but only once they reach the front
+        self.assertEqual(self.lobby.evict(now + 10), 0)
+        self.lobby.get_game(idle.id)
+        self.lobby.last_active[idle.id] = now
+        self.assertEqual(self.lobby.evict(now + 10), 1)
+        self.assertNotIn(closed.id, self.lobby.games)
+
+        self.assertEqual(self.lobby.evict(now + 60), 2)
+        self.assertEqual(len(self.lobby), 0)
+
+
+def brute_force_winner(grid, player, win_zone):
+    """Scans every cell of `grid` in every direction for a winning chain"""
+    rows, columns = len(grid), len(grid[0])
+    for row_idx in range(rows):
+        for column_idx in range(columns):
+            for d_row, d_column in ((0, 1), (1, 0), (1, 1), (1, -1)):
+                cells = [(row_idx + d_row * i, column_idx + d_column * i)
+                         for i in range(win_zone)]
+                if all(0 <= r < rows and 0 <= c < columns and
+                       grid[r][c] == player for r, c in cells):
+                    return True
+    return False
+
+
 class TestConnectpyGame(unittest.TestCase):
 
     def setUp(self):
@@ -183,6 +1115,7 @@ class TestConnectpyGame(unittest.TestCase):
 
     def test_dict(self):
         expected = {
+            "game_id": self.game.id,
             "game": self.game.grid,
             "turn": self.game.current_turn,
             "players": self.game.players,
@@ -191,7 +1124,8 @@ class TestConnectpyGame(unittest.TestCase):
             "last_drop": self.game.last_drop,
             "rows": self.game.rows,
             "columns": self.game.columns,
-            "closed": self.game.closed
+            "closed": self.game.closed,
+            "version": self.game.version
         }
         self.assertEqual(expected, self.game.dict)
 
@@ -266,6 +1200,30 @@ class TestConnectpyGame(unittest.TestCase):
         win_axis = [1, 1, 1, 1, 1, 0, 0, 0, 0]
         self.assertTrue(self.game.axis_has_winner(1, win_axis))
 
+    def test_grid_round_trip(self):
+        state = [
+            [0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 1, 0, 0, 0, 0, 0, 0],
+            [0, 0, 2, 0, 0, 0, 0, 0, 0],
+            [0, 0, 2, 1, 2, 0, 0, 0, 0],
+            [0, 0, 2, 2, 2, 1, 1, 0, 0],
+            [0, 0, 2, 1, 1, 1, 1, 0, 0]]
+        self.game.grid = state
+        self.assertEqual(self.game.grid, state)
+        self.assertEqual(self.game.heights, [0, 0, 5, 3, 3, 2, 2, 0, 0])
+
+    def test_drop_disc_heights(self):
+        self.game.players = {"a": 1, "b": 2}
+        self.game.start_game()
+        player = self.game.current_turn
+
+        self.game.drop_disc(player, 3)
+        self.assertEqual(self.game.last_drop, (self.game.rows - 1, 3))
+        self.assertEqual(self.game.heights[3], 1)
+        self.assertEqual(
+            self.game.boards[self.game.players[player]],
+            self.game.cell_mask(self.game.rows - 1, 3))
+
     def test_is_winner(self):
         self.game.win_zone = 5
 
@@ -328,6 +1286,158 @@ class TestConnectpyGame(unittest.TestCase):
         self.assertTrue(self.game.is_winner(1, drop_coords))
 
 
+    def test_winning_axis(self):
+        self.game.grid = [
+            [0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 2, 0, 0, 0, 0, 0, 1, 0],
+            [0, 2, 0, 0, 0, 0, 1, 2, 0],
+            [0, 2, 0, 0, 0, 1, 2, 2, 0],
+            [0, 2, 0, 0, 1, 2, 2, 2, 0],
+            [0, 2, 1, 1, 1, 1, 1, 1, 0]]
+        self.assertEqual(self.game.winning_axis(2, (1, 1)), 'vertical')
+        self.assertEqual(self.game.winning_axis(1, (5, 2)), 'horizontal')
+        self.assertEqual(self.game.winning_axis(1, (2, 6)), 'diagonal')
+        self.assertIsNone(self.game.winning_axis(2, (3, 6)))
+
+    def test_is_winner_matches_brute_force(self):
+        rng = random.Random(1234)
+        for _ in range(200):
+            config = {
+                "game_columns": rng.randint(1, 10),
+                "game_rows": rng.randint(1, 10),
+                "win_zone": rng.randint(1, 6)
+            }
+            game = connectpy_game.ConnectPyGame(config)
+            game.players = {"a": 1, "b": 2}
+            game.start_game()
+
+            while True:
+                open_columns = [c for c, h in enumerate(game.heights)
+                                if h < game.rows]
+                if not open_columns:
+                    break
+                player_id = game.current_turn
+                indicator = game.players[player_id]
+                won = game.drop_disc(player_id, rng.choice(open_columns))
+                self.assertEqual(won, brute_force_winner(
+                    game.grid, indicator, game.win_zone))
+                if won:
+                    break
+
+    def test_hints(self):
+        self.game.players = {"a": 1, "b": 2}
+        self.game.start_game()
+        self.assertEqual(self.game.hints("a")["wins"], [])
+
+        # "a" has 4 along the bottom with column 6 open, "b" 4 up column 1
+        self.game.grid = [
+            [0, 0, 0, 0, 0, 0, 0, 0, 0],
+            [0, 2, 0, 0, 0, 0, 0, 0, 0],
+            [0, 2, 0, 0, 0, 0, 0, 0, 0],
+            [0, 2, 0, 0, 0, 0, 0, 0, 0],
+            [0, 2, 0, 0, 0, 0, 0, 0, 0],
+            [0, 0, 1, 1, 1, 1, 0, 2, 0]]
+        hints = self.game.hints("a")
+        self.assertEqual(hints["version"], self.game.version)
+        self.assertEqual(hints["wins"], [6])
+        self.assertEqual(hints["blocks"], [1])
+        hints = self.game.hints("b")
+        self.assertEqual(hints["wins"], [1])
+        self.assertEqual(hints["blocks"], [6])
+
+        self.game.winner = "a"
+        self.assertEqual(self.game.hints("b")["wins"], [])
+
+    def test_hints_win_zone_one(self):
+        # Any first drop wins, so every open column is a win and a block
+        game = connectpy_game.ConnectPyGame(
+            {"game_columns": 3, "game_rows": 2, "win_zone": 1})
+        game.players = {"a": 1, "b": 2}
+        game.start_game()
+        game.grid = [[0, 0, 0], [0, 1, 2]]
+        hints = game.hints("a")
+        self.assertEqual(hints["wins"], [0, 1, 2])
+        self.assertEqual(hints["blocks"], [0, 1, 2])
+
+    def test_line_counts_match_grid(self):
+        self.game.players = {"a": 1, "b": 2}
+        self.game.start_game()
+        for column_idx in (3, 3, 4, 2, 5, 0):
+            self.game.drop_disc(self.game.current_turn, column_idx)
+        counts = self.game.line_counts
+        self.game.grid = self.game.grid
+        self.assertEqual(self.game.line_counts, counts)
+
+        self.game.reset_game()
+        self.assertEqual(
+            [set(c) for c in self.game.line_counts.values()], [{0}, {0}])
+
+    def test_surrounding_diag_bounds(self):
+        mat = [[1, 2, 3], [4, 5, 6], [7, 8, 9]]
+        self.assertEqual(
+            connectpy_game.surrounding_diag(mat, 0, 0, 3), [9, 5, 1])
+        self.assertEqual(
+            connectpy_game.surrounding_diag(mat, 0, 2, 3, flip=True),
+            [7, 5, 3])
+
+    def test_version(self):
+        self.game.add_player("a")
+        self.game.add_player("b")
+        version = self.game.version
+        self.game.start_game()
+        self.assertGreater(self.game.version, version)
+
+        version = self.game.version
+        self.assertFalse(self.game.wait_for_change(version, 0))
+        self.game.drop_disc(self.game.current_turn, 0)
+        self.assertTrue(self.game.wait_for_change(version, 0))
+
+        version = self.game.version
+        self.game.close("a")
+        self.assertEqual(self.game.version, version + 1)
+
+    def test_changes_since(self):
+        self.game.add_player("a")
+        self.game.add_player("b")
+        self.game.start_game()
+        version = self.game.version
+        self.game.drop_disc(self.game.current_turn, 0)
+
+        delta = self.game.changes_since(version)
+        self.assertEqual(delta["version"], self.game.version)
+        self.assertEqual([e["type"] for e in delta["events"]], ["drop"])
+        self.assertEqual(self.game.changes_since(0)["events"], self.game.log)
+        self.assertIsNone(self.game.changes_since(self.game.version + 1))
+        self.assertIsNone(self.game.changes_since("1"))
+
+    def test_log_size(self):
+        game = connectpy_game.ConnectPyGame(
+            dict(self.config, game_log_size=3))
+        game.add_player("a")
+        game.add_player("b")
+        game.start_game()
+        for column in range(4):
+            game.drop_disc(game.current_turn, column)
+
+        self.assertEqual(len(game.log), 3)
+        self.assertEqual(game.log_start, game.version - 3)
+        self.assertIsNone(game.changes_since(game.version - 4))
+        delta = game.changes_since(game.version - 3)
+        self.assertEqual([e["type"] for e in delta["events"]], ["drop"] * 3)
+        self.assertEqual(delta["events"][-1]["version"], game.version)
+
+    def test_serialized(self):
+        self.game.add_player("a")
+        version, encoded = self.game.serialized()
+        self.assertEqual(version, self.game.version)
+        self.assertEqual(json.loads(encoded), self.game.dict)
+        self.assertIs(self.game.serialized(), self.game.serialized())
+
+        self.game.add_player("b")
+        version, encoded = self.game.serialized()
+        self.assertEqual(version, self.game.version)
+        self.assertEqual(json.loads(encoded)["players"], {"a": 1, "b": 2})
+
     def test_add_player(self):
         self.game.add_player("a")
         self.assertFalse(self.game.players_ready)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import tempfile
+import connectpy_game
+import connectpy_ai
+import connectpy_book
+import unittest
+
+from threading import Thread
+
+def new_game(columns=7, rows=6, win_zone=4, moves=()):
+    game = connectpy_game.ConnectPyGame({
+        "game_columns": columns,
+        "game_rows": rows,
+        "win_zone": win_zone
+    })
+    game.add_player("a")
+    game.add_player("b")
+    game.start_game()
+    for column in moves:
+        game.drop_disc(game.current_turn, column)
+    return game
+
+
+class TestConnectpyAI(unittest.TestCase):
+
+    def setUp(self):
+        self.bot = connectpy_ai.AIPlayer({
+            "ai_time_budget": 0.2,
+            "ai_tt_size": 1 << 12
+        })
+
+    def test_center_order(self):
+        self.assertEqual(
+            connectpy_ai.center_order(7), [3, 2, 4, 1, 5, 0, 6])
+        self.assertEqual(connectpy_ai.center_order(4), [1, 2, 0, 3])
+
+    def test_board_windows(self):
+        # 7x6 Connect 4 has 69 winning lines
+        windows = connectpy_ai.board_windows(7, 6, 4)
+        self.assertEqual(len(windows), 69)
+        self.assertTrue(all(connectpy_ai.popcount(w) == 4 for w in windows))
+
+    def test_takes_win(self):
+        game = new_game(moves=[0, 6, 1, 6, 2, 5])
+        self.assertEqual(self.bot.choose_move(game, "a"), 3)
+
+    def test_blocks_win(self):
+        game = new_game(moves=[0, 6, 1, 6, 2])
+        self.assertEqual(self.bot.choose_move(game, "b"), 3)
+
+    def test_full_board(self):
+        game = new_game(columns=2, rows=1, win_zone=2, moves=[0])
+        self.assertEqual(self.bot.choose_move(game, "b"), 1)
+        game.drop_disc("b", 1)
+        self.assertIsNone(self.bot.choose_move(game, "a"))
+
+    def test_position_play_undo(self):
+        game = new_game(moves=[3, 3, 2])
+        position = self.bot.position(game, game.current_turn)
+        state = (position.current, position.opponent, position.hash,
+                 list(position.heights), position.color)
+
+        position.play(4)
+        self.assertNotEqual(position.hash, state[2])
+        position.undo(4)
+        self.assertEqual(state, (
+            position.current, position.opponent, position.hash,
+            list(position.heights), position.color))
+
+    def test_search_deterministic(self):
+        game = new_game(moves=[3, 3])
+        first = self.bot.search(self.bot.position(game, "a"), 4)
+        second = self.bot.search(self.bot.position(game, "a"), 4)
+        self.assertEqual(first, second)
+        self.assertGreater(self.bot.nodes, 0)
+
+    def test_stats(self):
+        self.bot.choose_move(new_game(), "a")
+        self.assertGreaterEqual(self.bot.stats["depth"], 1)
+        self.assertGreater(self.bot.stats["nps"], 0)
+
+    def test_searcher_per_thread(self):
+        searchers = []
+        threads = [Thread(target=lambda: searchers.append(
+            (self.bot.searcher(), self.bot.searcher()))) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        (first, again), (second, _) = searchers
+        self.assertIs(first, again)
+        self.assertIsNot(first, second)
+        self.assertIsNot(first.tt, second.tt)
+        self.assertIsNot(first.tt, self.bot.tt)
+        # Only the read-only keys and books are shared
+        self.assertIs(first.zobrist, second.zobrist)
+        self.assertIs(first.books, self.bot.books)
+
+        game = new_game(moves=[0, 6, 1, 6, 2, 5])
+        self.assertEqual(first.choose_move(game, "a"), 3)
+
+    def test_transposition_table_replacement(self):
+        tt = connectpy_ai.TranspositionTable(4)
+        tt.new_search()
+        tt.put(1, 5, 10, connectpy_ai.EXACT, 3)
+        # A shallower result doesn't replace a deeper one from this search
+        tt.put(5, 2, 20, connectpy_ai.EXACT, 1)
+        self.assertEqual(tt.get(1)[2], 10)
+        self.assertIsNone(tt.get(5))
+
+        # Results from an earlier search are always replaced
+        tt.new_search()
+        tt.put(5, 2, 20, connectpy_ai.EXACT, 1)
+        self.assertEqual(tt.get(5)[2], 20)
+        self.assertIsNone(tt.get(1))
+        self.assertEqual(len(tt.entries), 4)
+
+    def test_play_bots(self):
+        game = connectpy_game.ConnectPyGame({
+            "game_columns": 7,
+            "game_rows": 6,
+            "win_zone": 4
+        })
+        game.add_player("a")
+        game.add_player("bot", bot=self.bot)
+        game.start_game()
+
+        version = game.version
+        game.drop_disc("a", 3)
+        self.assertFalse(game.play_bots())
+        self.assertEqual(game.current_turn, "a")
+        self.assertEqual(game.version, version + 2)
+        self.assertEqual(sum(game.heights), 2)
+
+
+class TestConnectpyParallelAI(unittest.TestCase):
+
+    def setUp(self):
+        self.serial = connectpy_ai.AIPlayer({"ai_tt_size": 1 << 12})
+        self.parallel = connectpy_ai.ParallelAIPlayer({
+            "ai_tt_size": 1 << 12,
+            "ai_workers": 2,
+            "ai_time_budget": 0.5
+        })
+
+    def tearDown(self):
+        self.parallel.close()
+
+    def test_same_move_as_serial(self):
+        for moves in ([], [3, 3], [3, 2, 4, 4, 1], [0, 6, 0, 6, 1]):
+            game = new_game(moves=moves)
+            player = game.current_turn
+            self.assertEqual(
+                self.parallel.search(self.parallel.position(game, player), 5),
+                self.serial.search(self.serial.position(game, player), 5))
+            self.assertGreater(self.parallel.nodes, 0)
+
+    def test_takes_and_blocks_win(self):
+        game = new_game(moves=[0, 6, 1, 6, 2, 5])
+        self.assertEqual(self.parallel.choose_move(game, "a"), 3)
+        game = new_game(moves=[0, 6, 1, 6, 2])
+        self.assertEqual(self.parallel.choose_move(game, "b"), 3)
+
+    def test_subtree_budget(self):
+        position = self.serial.position(new_game(), "a")
+        args = (position.columns, position.rows, position.win_zone,
+                position.current, position.opponent, position.heights, 3)
+        with self.assertRaises(connectpy_ai.SearchTimeout):
+            connectpy_ai.search_subtree(args + (10, 0, 1, 1 << 12))
+        score, nodes = connectpy_ai.search_subtree(
+            args + (3, None, 1, 1 << 12))
+        self.assertGreater(nodes, 0)
+
+    def test_time_budget(self):
+        game = new_game(columns=9, win_zone=5)
+        self.assertIsNotNone(self.parallel.choose_move(game, "a"))
+        self.assertGreaterEqual(self.parallel.stats["depth"], 1)
+
+
+class TestConnectpyBook(unittest.TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.book')
+        os.close(fd)
+        self.moves = connectpy_book.generate_book(7, 6, 4, plies=3, depth=4)
+        connectpy_book.write_book(self.path, 7, 6, 4, 3, self.moves)
+        self.book = connectpy_book.OpeningBook(self.path)
+
+    def tearDown(self):
+        self.book.close()
+        os.remove(self.path)
+
+    def test_mirror(self):
+        board = 1 << 0 | 1 << 1 | 1 << 7 * 2
+        mirrored = connectpy_book.mirror(board, 7, 6)
+        self.assertEqual(mirrored, 1 << 7 * 6 | 1 << 7 * 6 + 1 | 1 << 7 * 4)
+        self.assertEqual(connectpy_book.mirror(mirrored, 7, 6), board)
+
+    def test_canonical_key(self):
+        left = connectpy_book.canonical_key(1 << 0, 1 << 7, 7, 6)
+        right = connectpy_book.canonical_key(1 << 7 * 6, 1 << 7 * 5, 7, 6)
+        self.assertEqual(left[0], right[0])
+        self.assertNotEqual(left[1], right[1])
+
+    def test_book_positions(self):
+        # The empty board, 4 first moves and 25 replies up to mirroring
+        self.assertEqual(len(self.book), 1 + 4 + 25)
+        self.assertEqual(self.book.board, (7, 6, 4))
+        self.assertEqual(len(self.moves), len(self.book))
+
+    def test_lookup(self):
+        bot = connectpy_ai.AIPlayer({})
+        for moves in ([], [0], [6], [3, 1], [3, 5]):
+            game = new_game(moves=moves)
+            position = bot.position(game, game.current_turn)
+            self.assertEqual(
+                self.book.lookup(position.current, position.opponent),
+                bot.search(position, 4)[0])
+        self.assertIsNone(self.book.lookup(1 << 0 | 1 << 1, 1 << 7))
+
+    def test_mirrored_lookup(self):
+        bot = connectpy_ai.AIPlayer({})
+        left = new_game(moves=[1])
+        right = new_game(moves=[5])
+        left_move = self.book.lookup(
+            bot.position(left, "b").current, bot.position(left, "b").opponent)
+        right_move = self.book.lookup(
+            bot.position(right, "b").current,
+            bot.position(right, "b").opponent)
+        self.assertEqual(right_move, 6 - left_move)
+
+    def test_ai_uses_book(self):
+        bot = connectpy_ai.AIPlayer({})
+        bot.books = connectpy_book.load_books([self.path])
+        game = new_game(moves=[3])
+        position = bot.position(game, "b")
+        self.assertEqual(
+            bot.choose_move(game, "b"),
+            self.book.lookup(position.current, position.opponent))
+        self.assertTrue(bot.stats["book"])
+
+        # Past the book the bot searches as usual
+        game = new_game(moves=[3, 3, 2])
+        bot.choose_move(game, "b")
+        self.assertFalse(bot.stats["book"])
+
+    def test_not_a_book(self):
+        with tempfile.NamedTemporaryFile(suffix='.book') as f:
+            f.write(b'not a book')
+            f.flush()
+            with self.assertRaises(connectpy_book.OpeningBookException):
+                connectpy_book.OpeningBook(f.name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import shutil
+import tempfile
+import connectpy_analytics
+import connectpy_archive
+import connectpy_game
+import connectpy_server
+import mock
+import unittest
+
+from itertools import cycle
+
+
+def play_random_game(rng, config, game_id):
+    game = connectpy_game.ConnectPyGame(config, game_id=game_id)
+    game.add_player('p{}a'.format(game_id))
+    game.add_player('p{}b'.format(game_id))
+    game.start_game()
+    while True:
+        open_columns = [c for c, h in enumerate(game.heights)
+                        if h < game.rows]
+        if not open_columns or \
+                game.drop_disc(game.current_turn, rng.choice(open_columns)):
+            return game
+
+
+def replay(archived):
+    """Returns the grid and winner indicator of an ArchivedGame"""
+    game = connectpy_game.ConnectPyGame({
+        "game_columns": archived.columns,
+        "game_rows": archived.rows,
+        "win_zone": archived.win_zone
+    })
+    game.players = {1: 1, 2: 2}
+    game.reset_game()
+    game.player_cycle = cycle([archived.first, 3 - archived.first])
+    game.current_turn = game.next_player()
+    winner = 0
+    for column in archived.moves:
+        player = game.current_turn
+        if game.drop_disc(player, column):
+            winner = player
+    return game.grid, winner
+
+
+class TestConnectpyArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = {
+            "archive_path": self.path,
+            "archive_block_games": 10
+        }
+        self.rng = random.Random(4321)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def record_games(self, writer, count, start=0):
+        games = []
+        for n in range(start, start + count):
+            config = {
+                "game_columns": self.rng.randint(4, 9),
+                "game_rows": self.rng.randint(4, 7),
+                "win_zone": 4
+            }
+            game = play_random_game(self.rng, config, 'g{}'.format(n))
+            games.append((game.id, game.grid, game.moves))
+            writer.record(game)
+        return games
+
+    def test_new_archive(self):
+        self.assertIsNone(connectpy_archive.new_archive({}))
+        self.assertIsInstance(connectpy_archive.new_archive(self.config),
+                              connectpy_archive.ArchiveWriter)
+
+    def test_round_trip(self):
+        writer = connectpy_archive.ArchiveWriter(self.config)
+        games = self.record_games(writer, 35)
+        writer.close()
+
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 35)
+            self.assertEqual(archive.block_count, 4)
+            archived = list(archive)
+            for (game_id, grid, moves), game in zip(games, archived):
+                self.assertEqual(game.game_id, game_id)
+                self.assertEqual(list(game.moves), moves)
+                self.assertEqual(game.players,
+                                 (game_id.replace('g', 'pg') + 'a',
+                                  game_id.replace('g', 'pg') + 'b'))
+                self.assertEqual(replay(game), (grid, game.winner))
+
+            # Random access, backwards across blocks
+            for number in (34, 20, 19, 0, -1):
+                game = archive[number]
+                self.assertEqual(game.dict, archived[number].dict)
+            with self.assertRaises(IndexError):
+                archive[35]
+
+    def test_unfinished_writes_ignored(self):
+        writer = connectpy_archive.ArchiveWriter(self.config)
+        self.record_games(writer, 10)
+        writer.flush()
+        # A block written without its index entry and a torn index entry
+        with open(os.path.join(self.path, 'games.cpa'), 'ab') as f:
+            f.write(b'\x78\x9c' + os.urandom(40))
+        with open(os.path.join(self.path, 'games.cpi'), 'ab') as f:
+            f.write(b'\x00' * 10)
+
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 10)
+
+        games = self.record_games(writer, 10, start=10)
+        writer.close()
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 20)
+            self.assertEqual(archive[10].game_id, games[0][0])
+
+    def test_writers_share_archive(self):
+        first = connectpy_archive.ArchiveWriter(self.config)
+        second = connectpy_archive.ArchiveWriter(self.config)
+        self.record_games(first, 5)
+        self.record_games(second, 3, start=5)
+        second.close()
+        first.close()
+
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            self.assertEqual([game.game_id for game in archive],
+                             ['g5', 'g6', 'g7', 'g0', 'g1', 'g2', 'g3', 'g4'])
+            self.assertEqual(archive[3].game_id, 'g0')
+
+    def test_failed_write(self):
+        writer = connectpy_archive.ArchiveWriter(self.config)
+        write_block = writer.write_block
+        writer.write_block = mock.Mock(side_effect=OSError('disk full'))
+        self.record_games(writer, 15)
+        with self.assertLogs('connectpy.archive', 'ERROR'):
+            with self.assertRaises(connectpy_archive.ArchiveException):
+                writer.flush()
+
+        # The writer carries on with later blocks
+        writer.write_block = write_block
+        games = self.record_games(writer, 10, start=15)
+        writer.close()
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            self.assertEqual([game.game_id for game in archive],
+                             [game_id for game_id, _, _ in games])
+
+    def test_corrupt_block(self):
+        writer = connectpy_archive.ArchiveWriter(self.config)
+        self.record_games(writer, 10)
+        writer.close()
+        with open(os.path.join(self.path, 'games.cpa'), 'r+b') as f:
+            f.seek(connectpy_archive.HEADER.size + 4)
+            byte = f.read(1)
+            f.seek(-1, os.SEEK_CUR)
+            f.write(bytes([byte[0] ^ 0xff]))
+
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            with self.assertRaises(connectpy_archive.ArchiveException):
+                archive[0]
+
+    def test_not_an_archive(self):
+        with open(os.path.join(self.path, 'games.cpi'), 'wb') as f:
+            f.write(b'nope')
+        with self.assertRaises(connectpy_archive.ArchiveException):
+            connectpy_archive.ArchiveReader(self.path)
+
+    def test_move_archives_won_games(self):
+        app = connectpy_server.create_app()
+        app.archive = connectpy_archive.ArchiveWriter(
+            dict(self.config, archive_block_games=1))
+        client = app.test_client()
+        game_id = client.post('/join', json={'player_id': 'a'}).json[
+            'game_id']
+        state = client.post('/join', json={'player_id': 'b'}).json
+        turn = state['turn']
+        other = 'b' if turn == 'a' else 'a'
+
+        # Five in the first column against five in the second
+        for column in [0, 1] * 4 + [0]:
+            player = turn if column == 0 else other
+            rv = client.post('/move', json={
+                'player_id': player, 'game_id': game_id, 'column': column})
+            self.assertEqual(rv.status_code, 200)
+        app.archive.close()
+
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            self.assertEqual(len(archive), 1)
+            game = archive[0]
+        self.assertEqual(game.game_id, game_id)
+        self.assertEqual(game.winner_id, turn)
+        self.assertEqual(game.players[game.first - 1], turn)
+        self.assertEqual(list(game.moves), [0, 1] * 4 + [0])
+
+
+class TestConnectpyAnalytics(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.rng = random.Random(99)
+        self.games = []
+        writer = connectpy_archive.ArchiveWriter(
+            {"archive_path": self.path, "archive_block_games": 7})
+        for n in range(60):
+            config = {
+                "game_columns": self.rng.choice([5, 7]),
+                "game_rows": 6,
+                "win_zone": 4
+            }
+            game = play_random_game(self.rng, config, 'g{}'.format(n))
+            axis = game.winning_axis(
+                game.players[game.winner], game.last_drop) \
+                if game.winner else None
+            self.games.append((config, list(game.moves), axis))
+            writer.record(game)
+        writer.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_replay_axis(self):
+        for config, moves, axis in self.games:
+            board = (config["game_columns"], config["game_rows"],
+                     config["win_zone"])
+            self.assertEqual(
+                connectpy_analytics.replay_axis(*board, moves=moves), axis)
+            self.assertEqual(
+                connectpy_analytics.engine_axis(*board, moves=moves), axis)
+
+    def test_merge(self):
+        with connectpy_archive.ArchiveReader(self.path) as archive:
+            whole = connectpy_analytics.GameStats()
+            merged = connectpy_analytics.GameStats()
+            for block in archive.blocks():
+                connectpy_analytics.block_stats(block, stats=whole)
+                merged.merge(connectpy_analytics.block_stats(block))
+        self.assertEqual(merged.report(1), whole.report(1))
+
+    def test_run_analytics(self):
+        report = connectpy_analytics.run_analytics(
+            self.path, workers=2, task_blocks=2)
+        self.assertEqual(report["games"], 60)
+        self.assertEqual(report["moves"],
+                         sum(len(moves) for _, moves, _ in self.games))
+        self.assertEqual(sorted(report["boards"]), ['5x6-4', '7x6-4'])
+
+        small = [moves for config, moves, _ in self.games
+                 if config["game_columns"] == 5]
+        stats = report["boards"]['5x6-4']
+        self.assertEqual(stats["games"], len(small))
+        self.assertAlmostEqual(stats["average_length"],
+                               sum(map(len, small)) / len(small))
+        axes = [axis for _, _, axis in self.games if axis]
+        self.assertEqual(sum(report["boards"][board]["won"]
+                             for board in report["boards"]), len(axes))
+        self.assertAlmostEqual(sum(report["winning_axes"].values()), 1)
+        self.assertAlmostEqual(report["winning_axes"]["vertical"],
+                               axes.count('vertical') / len(axes))
+
+
+if __name__ == '__main__':
+    unittest.main()
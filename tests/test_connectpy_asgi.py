@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import asyncio
+import threading
+import time
+import connectpy_asgi
+import connectpy_client
+import unittest
+
+
+class TestConnectpyASGI(unittest.TestCase):
+
+    def setUp(self):
+        self.app = connectpy_asgi.ConnectPyASGI({
+            "game_columns": 9,
+            "game_rows": 6,
+            "win_zone": 5,
+            "ai_time_budget": 0.1,
+            "asgi_threads": 4
+        })
+
+    def call(self, method, url, json_body=None, headers=None):
+        return asyncio.run(connectpy_asgi.call(
+            self.app, method, url, json_body, headers))
+
+    def post(self, url, json_body=None, headers=None):
+        return self.call('POST', url, json_body, headers)
+
+    def join(self, player_id, **extra):
+        return self.post('/join', dict(extra, player_id=player_id)).json
+
+    def test_matchmaking(self):
+        first = self.join('a')
+        self.assertFalse(first['started'])
+        second = self.join('b')
+        self.assertEqual(first['game_id'], second['game_id'])
+        self.assertTrue(second['started'])
+
+        third = self.join('a')
+        self.assertNotEqual(first['game_id'], third['game_id'])
+        rv = self.post('/join', {'player_id': 'a'})
+        self.assertEqual(rv.status_code, 409)
+        self.assertEqual(len(self.app.lobby), 2)
+
+    def test_request_checks(self):
+        game_id = self.join('a')['game_id']
+        rv = self.post('/status', headers={'Content-Type': 'text/plain'})
+        self.assertEqual(rv.status_code, 415)
+        rv = self.post('/move', {'player_id': 'a'})
+        self.assertEqual(rv.status_code, 400)
+        self.assertEqual(rv.json['error'], "game_id,column field(s) required")
+        rv = self.post('/status', {'player_id': 'a', 'game_id': 'nope'})
+        self.assertEqual(rv.status_code, 404)
+        rv = self.post('/status', {'player_id': 'b', 'game_id': game_id})
+        self.assertEqual(rv.status_code, 403)
+        self.assertEqual(self.call('GET', '/join').status_code, 405)
+        self.assertEqual(self.post('/nope').status_code, 404)
+
+    def test_move(self):
+        game_id = self.join('a')['game_id']
+        state = self.join('b')
+        turn = state['turn']
+        other = 'b' if turn == 'a' else 'a'
+
+        data = {'player_id': other, 'game_id': game_id, 'column': 0}
+        self.assertEqual(self.post('/move', data).status_code, 420)
+        data['player_id'] = turn
+        data['column'] = 99
+        self.assertEqual(self.post('/move', data).status_code, 400)
+        data['column'] = 0
+        rv = self.post('/move', data)
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['last_drop'], [rv.json['rows'] - 1, 0])
+        self.assertEqual(rv.json['turn'], other)
+
+        # Deltas and ETags work as in the Flask app
+        rv = self.post('/status', {'player_id': 'a', 'game_id': game_id,
+                                   'since': state['version']})
+        self.assertEqual([e['type'] for e in rv.json['events']], ['drop'])
+        etag = rv.headers['etag']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(rv.headers['vary'], 'Accept, Accept-Encoding')
+        rv = self.post('/status', {'player_id': 'a', 'game_id': game_id},
+                       headers={'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['vary'], 'Accept, Accept-Encoding')
+
+        rv = self.post('/close', {'player_id': 'a', 'game_id': game_id})
+        self.assertTrue(rv.json['closed'])
+
+    def test_hints(self):
+        game_id = self.join('a')['game_id']
+        self.join('b')
+        rv = self.post('/hints', {'player_id': 'a', 'game_id': game_id})
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.json['wins'], [])
+        self.assertEqual(rv.json['blocks'], [])
+        rv = self.post('/hints', {'player_id': 'c', 'game_id': game_id})
+        self.assertEqual(rv.status_code, 403)
+
+    def test_metrics(self):
+        self.join('a')
+        rv = self.call('GET', '/metrics')
+        self.assertTrue(rv.headers['content-type'].startswith('text/plain'))
+        lines = rv.data.decode().split('\n')
+        self.assertIn('connectpy_active_players 1', lines)
+        self.assertTrue(any(line.startswith(
+            'connectpy_request_seconds_count{endpoint="/join",status="200"}')
+            for line in lines))
+
+    def test_binary_responses(self):
+        game_id = self.join('a')['game_id']
+        state = self.join('b')
+        rv = self.post('/status', {'player_id': 'a', 'game_id': game_id},
+                       headers={'Accept': connectpy_asgi.conn_wire.MIMETYPE})
+        self.assertEqual(rv.headers['content-type'],
+                         connectpy_asgi.conn_wire.MIMETYPE)
+        self.assertEqual(connectpy_asgi.conn_wire.decode(rv.data), state)
+
+    def test_bot_opponent(self):
+        state = self.join('a', opponent='bot')
+        self.assertTrue(state['started'])
+        self.assertIn(connectpy_asgi.conn_server.BOT_PLAYER_ID,
+                      state['players'])
+        self.assertEqual(state['turn'], 'a')
+
+        rv = self.post('/join', {
+            'player_id': connectpy_asgi.conn_server.BOT_PLAYER_ID})
+        self.assertEqual(rv.status_code, 400)
+
+    def test_status_long_poll(self):
+        state = self.join('a')
+        data = {'player_id': 'a', 'game_id': state['game_id'],
+                'version': state['version'], 'wait': 0.1}
+        started = time.monotonic()
+        rv = self.post('/status', data)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual(rv.json['version'], state['version'])
+
+        data['wait'] = 'soon'
+        self.assertEqual(self.post('/status', data).status_code, 400)
+        self.assertEqual(self.app.watches, {})
+
+    def test_idle_waiters(self):
+        state = self.join('a')
+        data = {'player_id': 'a', 'game_id': state['game_id'],
+                'version': state['version'], 'wait': 5}
+        threads = threading.active_count()
+
+        async def wait():
+            polls = [asyncio.ensure_future(connectpy_asgi.call(
+                self.app, 'POST', '/status', data)) for _ in range(1000)]
+            game = self.app.lobby.get_game(state['game_id'])
+            for _ in range(500):
+                await asyncio.sleep(0.01)
+                watch = self.app.watches.get(game.id)
+                if watch is not None and watch.waiters == 1000:
+                    break
+            # Every waiter shares one subscription and none holds a thread
+            self.assertEqual(self.app.watches[game.id].waiters, 1000)
+            self.assertEqual(len(game.subscribers), 1)
+            self.assertLessEqual(threading.active_count(), threads + 4)
+            await connectpy_asgi.call(
+                self.app, 'POST', '/join', {'player_id': 'b'})
+            return await asyncio.gather(*polls)
+
+        results = asyncio.run(wait())
+        self.assertTrue(all('b' in rv.json['players'] for rv in results))
+        self.assertEqual(self.app.watches, {})
+
+    def test_events_stream(self):
+        game_id = self.join('a')['game_id']
+
+        async def play():
+            stream = asyncio.ensure_future(connectpy_asgi.call(
+                self.app, 'POST', '/events',
+                {'player_id': 'a', 'game_id': game_id}))
+            await asyncio.sleep(0.05)
+            turn = (await connectpy_asgi.call(
+                self.app, 'POST', '/join', {'player_id': 'b'})).json['turn']
+            await connectpy_asgi.call(self.app, 'POST', '/move', {
+                'player_id': turn, 'game_id': game_id, 'column': 0})
+            await connectpy_asgi.call(self.app, 'POST', '/close', {
+                'player_id': 'b', 'game_id': game_id})
+            return await asyncio.wait_for(stream, 5)
+
+        rv = asyncio.run(play())
+        self.assertEqual(rv.headers['content-type'], 'text/event-stream')
+        events = list(connectpy_client.parse_events(
+            rv.data.decode().split('\n')))
+        self.assertEqual([event['type'] for event in events], [
+            'state', 'join', 'reset', 'start', 'drop', 'close'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+import time
+import connectpy_backend
+import connectpy_server
+import unittest
+
+from queue import Queue
+
+
+class TestSharedStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = connectpy_backend.SharedStore()
+
+    def test_values_and_lists(self):
+        self.store.set('game:a', '{}')
+        self.store.set('active:a', 1)
+        self.assertEqual(self.store.get('game:a'), '{}')
+        self.assertEqual(self.store.keys('game:'), ['game:a'])
+        self.assertEqual(self.store.rpush('log:a', 'x', 'y'), 2)
+        self.assertEqual(self.store.lrange('log:a', 1), ['y'])
+        self.assertEqual(self.store.llen('log:a'), 2)
+        self.store.delete('game:a', 'log:a')
+        self.assertIsNone(self.store.get('game:a'))
+        self.assertEqual(self.store.llen('log:a'), 0)
+
+    def test_counters_and_sorted_sets(self):
+        self.assertEqual(self.store.incr('count:a'), 1)
+        self.assertEqual(self.store.incr('count:a', -3), -2)
+        self.store.rpush('log:a', 'x', 'y', 'z')
+        self.store.ltrim('log:a', -2)
+        self.assertEqual(self.store.lrange('log:a'), ['y', 'z'])
+
+        for member, score in (('a', 3), ('b', 1), ('c', 2), ('a', 0)):
+            self.store.zadd('expiry', member, score)
+        self.assertEqual(self.store.zcard('expiry'), 3)
+        self.assertEqual(self.store.zrangebyscore('expiry', 1), ['a', 'b'])
+        self.assertEqual(
+            self.store.zrangebyscore('expiry', 5, count=1), ['a'])
+        self.store.zrem('expiry', 'a', 'missing')
+        self.assertEqual(self.store.zrangebyscore('expiry', 5), ['b', 'c'])
+
+    def test_lock(self):
+        token = self.store.lock('game:a', timeout=0)
+        self.assertTrue(token)
+        self.assertIsNone(self.store.lock('game:a', timeout=0.05))
+        self.assertFalse(self.store.unlock('game:a', 'not-the-token'))
+        self.assertTrue(self.store.unlock('game:a', token))
+        self.assertTrue(self.store.lock('game:a', timeout=0))
+
+    def test_lock_lease(self):
+        self.store.lock('game:a', lease=0.05)
+        started = time.monotonic()
+        # The holder never unlocks, so the lock is taken when its lease ends
+        self.assertTrue(self.store.lock('game:a', timeout=1))
+        self.assertLess(time.monotonic() - started, 0.5)
+
+
+class TestSharedLobby(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = connectpy_backend.BackendManager(
+            address=('127.0.0.1', 0), authkey=b'test')
+        self.manager.start()
+        self.config = {
+            "game_columns": 7,
+            "game_rows": 6,
+            "win_zone": 4,
+            "backend": "shared",
+            "backend_address": "{}:{}".format(*self.manager.address),
+            "backend_authkey": "test",
+            "backend_lock_timeout": 1,
+            "backend_poll_interval": 0.01
+        }
+        self.lobby = connectpy_backend.SharedLobby(self.config)
+        self.other = connectpy_backend.SharedLobby(self.config)
+
+    def tearDown(self):
+        self.manager.shutdown()
+
+    def new_app(self):
+        self.dir = os.path.dirname(os.path.abspath(__file__))
+        os.environ['CONNECTPY_SETTINGS'] = os.path.join(self.dir, 'test.cfg')
+        app = connectpy_server.create_app()
+        app.config.update(self.config)
+        connectpy_server.new_lobby(app)
+        return app.test_client()
+
+    def test_waiting_game(self):
+        game = self.lobby.waiting_game()
+        self.assertEqual(self.other.waiting_game().id, game.id)
+        with self.other.locked(game.id) as shared:
+            shared.add_player("a")
+            shared.add_player("b")
+        self.assertNotEqual(self.lobby.waiting_game().id, game.id)
+        self.assertEqual(len(self.lobby), 2)
+
+    def test_locked(self):
+        game = self.lobby.new_game()
+        with self.lobby.locked(game.id) as shared:
+            shared.add_player("a")
+        self.assertEqual(self.other.get_game(game.id).players, {"a": 1})
+
+        # Changes are dropped if the block raises
+        with self.assertRaises(ValueError):
+            with self.other.locked(game.id) as shared:
+                shared.add_player("b")
+                raise ValueError()
+        self.assertEqual(self.lobby.get_game(game.id).players, {"a": 1})
+
+    def test_locked_busy(self):
+        game = self.lobby.new_game()
+        with self.lobby.locked(game.id):
+            with self.assertRaises(
+                    connectpy_backend.conn_lobby.GameBusyException):
+                with self.other.locked(game.id):
+                    pass
+
+    def test_wait_for_change(self):
+        game = self.lobby.new_game()
+
+        def join():
+            time.sleep(0.05)
+            with self.other.locked(game.id) as shared:
+                shared.add_player("a")
+        threading.Thread(target=join).start()
+
+        changed = self.lobby.wait_for_change(game, game.version, 2)
+        self.assertEqual(changed.players, {"a": 1})
+        self.assertIs(self.lobby.wait_for_change(changed, 1, 0), changed)
+
+    def test_subscribe(self):
+        game = self.lobby.new_game()
+        queue = Queue()
+        self.lobby.subscribe(game, queue.put)
+        with self.other.locked(game.id) as shared:
+            shared.add_player("a")
+            shared.add_player("b")
+        self.assertEqual(queue.get(timeout=2)['type'], 'join')
+        self.assertEqual(queue.get(timeout=2)['player'], 'b')
+        self.lobby.unsubscribe(game, queue.put)
+
+    def test_log_trimmed(self):
+        self.config["game_log_size"] = 3
+        lobby = connectpy_backend.SharedLobby(self.config)
+        game = lobby.new_game()
+        with lobby.locked(game.id) as shared:
+            shared.add_player("a")
+            shared.add_player("b")
+            shared.start_game()
+            for column in range(3):
+                shared.drop_disc(shared.current_turn, column)
+        version = shared.version
+        self.assertEqual(lobby.shared.llen('log:{}'.format(game.id)), 3)
+
+        events = lobby.events_since(game.id, version - 2, version)
+        self.assertEqual([e['version'] for e in events],
+                         [version - 1, version])
+        # Subscribers that fell behind the log start from the full state
+        self.assertIsNone(lobby.events_since(game.id, 0, version))
+        self.assertIs(lobby.wait_for_change(shared, version, 0), shared)
+
+    def test_stats(self):
+        idle, closed = self.lobby.new_game(), self.lobby.new_game()
+        with self.lobby.locked(idle.id) as shared:
+            shared.add_player("a")
+        with self.other.locked(closed.id) as shared:
+            shared.add_player("b")
+            shared.add_player("c")
+        self.assertEqual(self.lobby.stats(), {"games": 2, "players": 3})
+
+        with self.other.locked(closed.id) as shared:
+            shared.close("b")
+            shared.close("c")
+        self.assertEqual(self.lobby.stats(), {"games": 1, "players": 1})
+        self.assertEqual(self.lobby.evict(time.time() + 60), 1)
+        self.assertEqual(len(self.lobby), 1)
+        self.assertEqual(self.lobby.evict(time.time() + 600), 1)
+        self.assertEqual(self.lobby.stats(), {"games": 0, "players": 0})
+
+    def test_evict_skips_locked_games(self):
+        game = self.lobby.new_game()
+        with self.lobby.locked(game.id) as shared:
+            shared.add_player("a")
+            self.assertEqual(self.other.evict(time.time() + 600), 0)
+        self.assertEqual(self.lobby.stats(), {"games": 1, "players": 1})
+
+        # Touched since the index was read, so no longer expired
+        self.assertFalse(self.other.remove_game(
+            game.id, expired_at=time.time() - 600))
+        self.assertTrue(self.other.remove_game(game.id))
+        self.assertEqual(self.lobby.stats(), {"games": 0, "players": 0})
+
+    def test_evict_on_access(self):
+        self.config["game_idle_timeout"] = 0.05
+        lobby = connectpy_backend.SharedLobby(self.config)
+        idle, active = lobby.new_game(), lobby.new_game()
+        time.sleep(0.1)
+        lobby.get_game(active.id)
+        with self.assertRaises(
+                connectpy_backend.conn_lobby.GameNotFoundException):
+            lobby.get_game(idle.id)
+        self.assertEqual(len(lobby), 1)
+        self.assertEqual(lobby.stats(), {"games": 1, "players": 0})
+
+    def test_evict(self):
+        self.config["max_games"] = 1
+        self.config["game_idle_timeout"] = 0
+        lobby = connectpy_backend.SharedLobby(self.config)
+        first = lobby.new_game()
+        second = lobby.new_game()
+        self.assertEqual(len(lobby), 1)
+        with self.assertRaises(
+                connectpy_backend.conn_lobby.GameNotFoundException):
+            lobby.get_game(first.id)
+        self.assertEqual(lobby.get_game(second.id).id, second.id)
+
+    def test_workers_share_games(self):
+        # Two apps stand in for two uWSGI worker processes
+        workers = [self.new_app(), self.new_app()]
+        a = workers[0].post('/join', json={'player_id': 'a'}).json
+        b = workers[1].post('/join', json={'player_id': 'b'}).json
+        self.assertEqual(a['game_id'], b['game_id'])
+        self.assertTrue(b['started'])
+
+        game_id, turn = b['game_id'], b['turn']
+        other = 'b' if turn == 'a' else 'a'
+        rv = workers[0].post('/move', json={
+            'player_id': other, 'game_id': game_id, 'column': 0})
+        self.assertEqual(rv.status_code, 420)
+        rv = workers[0].post('/move', json={
+            'player_id': turn, 'game_id': game_id, 'column': 0})
+        self.assertEqual(rv.status_code, 200)
+        rv = workers[1].post('/move', json={
+            'player_id': turn, 'game_id': game_id, 'column': 1})
+        self.assertEqual(rv.status_code, 420)
+        rv = workers[1].post('/move', json={
+            'player_id': other, 'game_id': game_id, 'column': 1})
+        self.assertEqual(rv.status_code, 200)
+
+        status = workers[0].post('/status', json={
+            'player_id': turn, 'game_id': game_id}).json
+        self.assertEqual(status['game'][-1][:3], [
+            b['players'][turn], b['players'][other], 0])
+        self.assertEqual(status['version'], rv.json['version'])
+
+
+if __name__ == '__main__':
+    unittest.main()
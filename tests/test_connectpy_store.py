@@ -0,0 +1,194 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import connectpy_game
+import connectpy_lobby
+import connectpy_store
+import mock
+import time
+import unittest
+
+
+class FakeBot(object):
+
+    def choose_move(self, game, player_id):
+        return game.heights.index(min(game.heights))
+
+
+class TestConnectpyStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.config = {
+            "game_columns": 7,
+            "game_rows": 6,
+            "win_zone": 4,
+            "store": "log",
+            "store_path": self.path,
+            "store_segment_records": 1000
+        }
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.path)
+
+    def new_lobby(self, bot=None):
+        store = connectpy_store.new_store(self.config)
+        self.stores.append(store)
+        lobby = connectpy_lobby.ConnectPyLobby(self.config, store=store)
+        lobby.recover(bot=bot)
+        return lobby
+
+    def restart(self, lobby, bot=None):
+        lobby.store.close()
+        return self.new_lobby(bot=bot)
+
+    def play(self, game, *columns):
+        for column in columns:
+            if game.drop_disc(game.current_turn, column):
+                game.reset_game()
+
+    def test_new_store(self):
+        self.assertIsNone(connectpy_store.new_store({}))
+        self.assertIsInstance(
+            connectpy_store.new_store(self.config), connectpy_store.LogStore)
+
+    def test_null_store(self):
+        lobby = connectpy_lobby.ConnectPyLobby(
+            self.config, store=connectpy_store.GameStore())
+        lobby.recover()
+        game = lobby.new_game()
+        self.assertIs(lobby.get_game(game.id), game)
+        self.assertEqual(connectpy_store.GameStore().recover(), [])
+
+    def test_recover(self):
+        lobby = self.new_lobby()
+        game = lobby.waiting_game()
+        game.add_player("a")
+        game.add_player("b")
+        game.start_game()
+        # "a" or "b" wins in column 0, then the game is reset
+        self.play(game, 0, 1, 0, 1, 0, 1, 0, 2, 3)
+        closed = lobby.waiting_game()
+        closed.add_player("c")
+        closed.close("c")
+        removed = lobby.waiting_game()
+        lobby.remove_game(removed.id)
+        waiting = lobby.waiting_game()
+        waiting.add_player("d")
+
+        recovered = self.restart(lobby)
+        self.assertEqual(list(recovered.games), [game.id, closed.id,
+                                                 waiting.id])
+        for original in (game, closed, waiting):
+            self.assertEqual(
+                recovered.get_game(original.id).dict, original.dict)
+        self.assertIs(recovered.waiting_game(), recovered.games[waiting.id])
+
+        # Play carries on where it left off, and is logged in turn
+        restored = recovered.get_game(game.id)
+        turn = restored.current_turn
+        self.play(restored, 4)
+        self.assertNotEqual(restored.current_turn, turn)
+        again = self.restart(recovered)
+        self.assertEqual(again.get_game(game.id).dict, restored.dict)
+
+    def test_snapshot(self):
+        self.config["store_segment_records"] = 5
+        lobby = self.new_lobby()
+        game = lobby.waiting_game()
+        game.add_player("a")
+        game.add_player("b")
+        game.start_game()
+        self.play(game, 0, 1, 2)
+        lobby.store.flush()
+        lobby.store.rotate()
+        self.play(game, 3, 4, 5)
+        lobby.store.flush()
+
+        store = lobby.store
+        self.assertTrue(os.path.exists(
+            os.path.join(self.path, connectpy_store.SNAPSHOT_NAME)))
+        # Only the segment written since the snapshot is left to replay
+        self.assertEqual(store.segments(), [store.segment])
+        recovered = self.restart(lobby)
+        self.assertEqual(recovered.get_game(game.id).dict, game.dict)
+
+    def test_torn_record(self):
+        lobby = self.new_lobby()
+        game = lobby.waiting_game()
+        game.add_player("a")
+        lobby.store.close()
+        segment = lobby.store.segment_path(lobby.store.segment)
+        with open(segment, 'a') as f:
+            f.write('{"type":"join","ga')
+
+        recovered = self.new_lobby()
+        self.assertEqual(recovered.get_game(game.id).dict, game.dict)
+
+    def test_failed_commit(self):
+        self.config["store_retry_interval"] = 0.01
+        lobby = self.new_lobby()
+        game = lobby.waiting_game()
+        store = lobby.store
+        segment = store.segment
+        fsync = os.fsync
+        calls = []
+
+        def fail_once(fd):
+            calls.append(fd)
+            if len(calls) == 1:
+                raise OSError(5, 'Input/output error')
+            fsync(fd)
+
+        with mock.patch.object(connectpy_store.os, 'fsync', fail_once):
+            with self.assertLogs('connectpy.store', 'ERROR'):
+                game.add_player("a")
+                game.add_player("b")
+                deadline = time.monotonic() + 2
+                while (store.buffer or not store.failed) and \
+                        time.monotonic() < deadline:
+                    time.sleep(0.01)
+        self.assertEqual(store.failed, 1)
+        self.assertEqual(store.segment, segment + 1)
+        game.start_game()
+        self.play(game, 3)
+
+        # The failed records were written again, to a fresh segment
+        recovered = self.restart(lobby)
+        self.assertEqual(recovered.get_game(game.id).dict, game.dict)
+
+    def test_recover_bot(self):
+        bot = FakeBot()
+        lobby = self.new_lobby(bot=bot)
+        game = lobby.new_game()
+        game.add_player("a")
+        game.add_player("bot", bot=bot)
+        game.start_game()
+        game.play_bots()
+
+        recovered = self.restart(lobby, bot=bot)
+        restored = recovered.get_game(game.id)
+        self.assertIs(restored.bots["bot"], bot)
+        self.assertEqual(restored.dict, game.dict)
+
+    def test_changes_since_snapshot(self):
+        game = connectpy_game.ConnectPyGame(self.config, game_id="g")
+        game.add_player("a")
+        game.add_player("b")
+        restored = connectpy_game.ConnectPyGame.from_snapshot(game.snapshot())
+        self.assertEqual(restored.version, 2)
+        self.assertIsNone(restored.changes_since(1))
+        restored.start_game()
+        self.assertEqual(
+            [e['type'] for e in restored.changes_since(2)['events']],
+            ['reset', 'start'])
+
+
+if __name__ == '__main__':
+    unittest.main()